@@ -1,8 +1,25 @@
-from geopayment.providers import (
-    CredoProvider,
-    IPayProvider,
-    TBCProvider,
-    TBCInstallmentProvider,
-)
+from importlib import import_module
+
 
 __version__ = "0.6.3"
+
+_PROVIDERS = (
+    'CredoProvider',
+    'IPayProvider',
+    'TBCProvider',
+    'TBCInstallmentProvider',
+)
+
+__all__ = list(_PROVIDERS)
+
+
+def __getattr__(name):
+    if name not in _PROVIDERS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module('geopayment.providers'), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,4 @@
+"""
+Offline benchmarks for geopayment, every module is runnable with
+`python -m geopayment.benchmarks.<name>`.
+"""
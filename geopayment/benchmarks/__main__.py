@@ -0,0 +1,6 @@
+import sys
+
+from geopayment.benchmarks.runner import main
+
+
+sys.exit(main())
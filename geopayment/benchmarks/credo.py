@@ -0,0 +1,79 @@
+"""
+Credo installment signing throughput.
+
+    $ python -m geopayment.benchmarks.credo --skus 100000 --processes 4
+"""
+import argparse
+import time
+from decimal import Decimal
+from typing import Dict, Iterator, List, Optional
+
+from geopayment.benchmarks.fixtures import BenchCredoProvider
+
+
+def generate_orders(skus: int, per_order: int = 1) -> Iterator[List[Dict]]:
+    """
+    :param skus: total number of products
+    :param per_order: products per product list
+    :return: product lists, generated lazily
+    """
+
+    order = list()
+    for i in range(skus):
+        order.append({
+            'id': str(i),
+            'title': f'PHILIPS HP{i:06d}/00',
+            'amount': '1',
+            'price': Decimal(i % 5000) + Decimal('0.99'),
+            'type': '0',
+        })
+        if len(order) == per_order:
+            yield order
+            order = list()
+    if order:
+        yield order
+
+
+def run(skus: int = 100000, per_order: int = 1,
+        processes: Optional[int] = None, chunksize: int = 512) -> Dict:
+    """
+    :return: benchmark result, `skus_per_second` is the headline number
+    """
+
+    provider = BenchCredoProvider()
+    orders = generate_orders(skus, per_order)
+    started = time.perf_counter()
+    count = 0
+    for _ in provider.sign_many(orders, processes=processes,
+                                chunksize=chunksize):
+        count += 1
+    elapsed = time.perf_counter() - started
+    return {
+        'name': 'credo.sign_many',
+        'skus': skus,
+        'orders': count,
+        'processes': processes or 1,
+        'seconds': elapsed,
+        'skus_per_second': skus / elapsed if elapsed else float('inf'),
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0]
+    )
+    parser.add_argument('--skus', type=int, default=100000)
+    parser.add_argument('--per-order', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=512)
+    args = parser.parse_args(argv)
+    result = run(args.skus, args.per_order, args.processes, args.chunksize)
+    print(
+        f"{result['name']}: {result['skus']} skus in "
+        f"{result['seconds']:.3f}s with {result['processes']} process(es), "
+        f"{result['skus_per_second']:.0f} skus/s"
+    )
+
+
+if __name__ == '__main__':
+    main()
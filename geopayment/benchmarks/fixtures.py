@@ -0,0 +1,135 @@
+"""
+Offline providers and payloads shared by benchmarks.
+"""
+from decimal import Decimal
+from typing import Dict, List
+
+from geopayment.providers.bog import IPayProvider
+from geopayment.providers.credo import CredoProvider
+from geopayment.providers.tbc import TBCProvider, TBCInstallmentProvider
+from geopayment.providers.tbc.installment import AuthData
+
+
+class BenchTBCProvider(TBCProvider):
+
+    @property
+    def description(self) -> str:
+        return 'benchmark description'
+
+    @property
+    def client_ip(self) -> str:
+        return '127.0.0.1'
+
+    @property
+    def service_url(self) -> str:
+        return 'https://localhost:18443/ecomm2/MerchantHandler'
+
+    @property
+    def cert(self):
+        return None
+
+
+class BenchIPayProvider(IPayProvider):
+    access = {'access_token': 'benchmark-token'}
+
+    @property
+    def client_id(self) -> str:
+        return '1006'
+
+    @property
+    def secret_key(self) -> str:
+        return 'benchmark-secret'
+
+    @property
+    def service_url(self) -> str:
+        return 'https://localhost/opay/api/v1/'
+
+    @property
+    def redirect_url(self) -> str:
+        return 'https://localhost/success'
+
+
+class BenchTBCInstallmentProvider(TBCInstallmentProvider):
+    auth = AuthData(
+        access_token='benchmark-token', token_type='Bearer',
+        scope='online_installments', issued_at='0', expires_in=7775999,
+        HTTP_STATUS_CODE=200
+    )
+    session_id = 'e4ff7785-0be7-46f7-aca7-12691a521091'
+
+    @property
+    def merchant_key(self) -> str:
+        return 'MerchantIntegrationTesting'
+
+    @property
+    def campaign_id(self) -> str:
+        return '204'
+
+    @property
+    def key(self) -> str:
+        return 'benchmark-key'
+
+    @property
+    def secret(self) -> str:
+        return 'benchmark-secret'
+
+    @property
+    def service_url(self) -> str:
+        return 'https://localhost/'
+
+
+class BenchCredoProvider(CredoProvider):
+
+    @property
+    def merchant_id(self) -> str:
+        return '7220'
+
+    @property
+    def password(self) -> str:
+        return 'benchmark-password'
+
+
+def bog_items(count: int) -> List[Dict]:
+    return [
+        {
+            'amount': Decimal(i % 500) + Decimal('0.45'),
+            'description': f'item {i}',
+            'quantity': 1,
+            'product_id': str(i),
+        }
+        for i in range(count)
+    ]
+
+
+def tbc_installment_products(count: int) -> List[Dict]:
+    return [
+        {'name': f'product {i}', 'price': Decimal(i % 500) + Decimal('0.45'),
+         'quantity': 1}
+        for i in range(count)
+    ]
+
+
+def credo_products(count: int) -> List[Dict]:
+    return [
+        {'id': str(i), 'title': f'PHILIPS HP{i:06d}/00', 'amount': '1',
+         'price': Decimal(i % 500) + Decimal('0.99'), 'type': '0'}
+        for i in range(count)
+    ]
+
+
+def ecomm_body(fields: int = 2) -> str:
+    lines = ['RESULT: OK', 'RESULT_CODE: 000']
+    lines.extend(f'FLD_{i:03d}: {i}' for i in range(fields - 2))
+    return '\n'.join(lines)
+
+
+def json_body(count: int = 1) -> Dict:
+    return {
+        'status': 'CREATED',
+        'order_id': '8d6ad5a2-8fdc-47b3-a1c6-fd48e1f07a21',
+        'links': [
+            {'href': f'https://localhost/orders/{i}', 'rel': 'approve',
+             'method': 'REDIRECT'}
+            for i in range(count)
+        ],
+    }
@@ -0,0 +1,307 @@
+"""
+Benchmark cases for the provider hot paths, representative and large
+payloads. Network is replaced with a `StubTransport`.
+"""
+import logging
+from decimal import Decimal
+
+from geopayment.benchmarks.fixtures import (
+    BenchCredoProvider,
+    BenchIPayProvider,
+    BenchTBCInstallmentProvider,
+    BenchTBCProvider,
+    bog_items,
+    credo_products,
+    ecomm_body,
+    json_body,
+    tbc_installment_products,
+)
+from geopayment.benchmarks.runner import case
+from geopayment.providers import (
+    client_ip,
+    log,
+    metrics,
+    profiling,
+    quantiles,
+)
+from geopayment.providers.transport import StubTransport, make_response
+from geopayment.providers.utils import (
+    _request,
+    bog_params,
+    gel_to_tetri,
+    get_currency_code,
+    parse_response,
+    perform_http_response,
+    tbc_installment_params,
+    tbc_params,
+)
+
+
+def _payload(self, **kwargs):
+    return kwargs['payload']
+
+
+def _result(self, **kwargs):
+    return kwargs['result']
+
+
+def _stubbed(provider_class, response):
+    transport = StubTransport(lambda params: response)
+    return type(
+        f'Stubbed{provider_class.__name__}', (provider_class,),
+        {'transport': transport}
+    )()
+
+
+@case('tbc_params.get_trans_id')
+def bench_tbc_params():
+    f = tbc_params('amount', 'currency', 'client_ip_addr', 'description',
+                   command='v', language='ka', msg_type='SMS')(_payload)
+    provider = BenchTBCProvider()
+    return lambda: f(provider, amount=Decimal('23.45'), currency='GEL')
+
+
+@case('tbc_params.end_of_business_day')
+def bench_tbc_params_eod():
+    f = tbc_params(command='b')(_payload)
+    provider = BenchTBCProvider()
+    return lambda: f(provider)
+
+
+def _bench_bog_checkout(count):
+    f = bog_params(currency_code='GEL', endpoint='checkout/orders',
+                   api='checkout')(_payload)
+    provider = BenchIPayProvider()
+    items = bog_items(count)
+    return lambda: f(provider, items=items, shop_order_id='1')
+
+
+@case('bog_params.checkout[3]')
+def bench_bog_params():
+    return _bench_bog_checkout(3)
+
+
+@case('bog_params.checkout[1000]')
+def bench_bog_params_large():
+    return _bench_bog_checkout(1000)
+
+
+@case('bog_params.auth')
+def bench_bog_params_auth():
+    f = bog_params(endpoint='oauth2/token', api='auth')(_payload)
+    provider = BenchIPayProvider()
+    return lambda: f(provider)
+
+
+def _bench_tbc_installment_create(count):
+    f = tbc_installment_params(
+        endpoint='v1/online-installments/applications', api='create'
+    )(_payload)
+    provider = BenchTBCInstallmentProvider()
+    products = tbc_installment_products(count)
+    return lambda: f(provider, products=products, invoice_id='1')
+
+
+@case('tbc_installment_params.create[3]')
+def bench_tbc_installment_params():
+    return _bench_tbc_installment_create(3)
+
+
+@case('tbc_installment_params.create[1000]')
+def bench_tbc_installment_params_large():
+    return _bench_tbc_installment_create(1000)
+
+
+@case('_request.ecomm')
+def bench_request_ecomm():
+    f = _request(verify=False, timeout=(3, 10), method='post')(_result)
+    provider = _stubbed(BenchTBCProvider, make_response(200, ecomm_body()))
+    payload = {
+        'data': {'command': 'c', 'trans_id': 'NMQfTRLUTne3eywr9YnAU78Qxxw='}
+    }
+    return lambda: f(provider, payload=dict(payload))
+
+
+@case('_request.json[100]')
+def bench_request_json():
+    f = _request(verify=True, timeout=(3, 10), method='post')(_result)
+    provider = _stubbed(BenchIPayProvider, make_response(200, json_body(100)))
+    items = bog_items(100)
+    return lambda: f(provider, payload={'json': {'items': items}})
+
+
+@case('TBCProvider.get_trans_id')
+def bench_get_trans_id():
+    provider = _stubbed(
+        BenchTBCProvider,
+        make_response(200, 'TRANSACTION_ID: NMQfTRLUTne3eywr9YnAU78Qxxw=')
+    )
+    return lambda: provider.get_trans_id(amount=Decimal('23.45'),
+                                         currency='GEL')
+
+
+@case('TBCProvider.get_trans_id.profiled')
+def bench_get_trans_id_profiled():
+    provider = _stubbed(
+        BenchTBCProvider,
+        make_response(200, 'TRANSACTION_ID: NMQfTRLUTne3eywr9YnAU78Qxxw=')
+    )
+
+    def call():
+        # flag only, the case measures the enabled call path
+        profiling.enabled = True
+        try:
+            provider.get_trans_id(amount=Decimal('23.45'), currency='GEL')
+        finally:
+            profiling.enabled = False
+
+    return call
+
+
+@case('TBCProvider.get_trans_id.metered')
+def bench_get_trans_id_metered():
+    provider = _stubbed(
+        BenchTBCProvider,
+        make_response(200, 'TRANSACTION_ID: NMQfTRLUTne3eywr9YnAU78Qxxw=')
+    )
+
+    def call():
+        # flag only, the case measures the enabled call path
+        metrics.enabled = True
+        try:
+            provider.get_trans_id(amount=Decimal('23.45'), currency='GEL')
+        finally:
+            metrics.enabled = False
+
+    return call
+
+
+class _FormattingHandler(logging.Handler):
+
+    def emit(self, record):
+        self.format(record)
+
+
+def _bench_get_trans_id_logged(rates):
+    provider = _stubbed(
+        BenchTBCProvider,
+        make_response(200, 'TRANSACTION_ID: NMQfTRLUTne3eywr9YnAU78Qxxw=')
+    )
+    logger = logging.getLogger('geopayment.benchmarks.log')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(_FormattingHandler())
+
+    def call():
+        default, log.logger = log.logger, logger
+        log.sample_rates = rates
+        try:
+            provider.get_trans_id(amount=Decimal('23.45'), currency='GEL')
+        finally:
+            log.logger, log.sample_rates = default, dict()
+
+    return call
+
+
+@case('TBCProvider.get_trans_id.logged')
+def bench_get_trans_id_logged():
+    return _bench_get_trans_id_logged(dict())
+
+
+@case('TBCProvider.get_trans_id.logged[1%]')
+def bench_get_trans_id_logged_sampled():
+    return _bench_get_trans_id_logged({logging.INFO: 0.01})
+
+
+@case('perform_http_response.json')
+def bench_perform_http_response_json():
+    response = make_response(200, json_body(1))
+    return lambda: perform_http_response(response)
+
+
+@case('perform_http_response.json[1000]')
+def bench_perform_http_response_json_large():
+    response = make_response(200, json_body(1000))
+    return lambda: perform_http_response(response)
+
+
+@case('perform_http_response.ecomm')
+def bench_perform_http_response_ecomm():
+    response = make_response(200, ecomm_body(10))
+    return lambda: perform_http_response(response)
+
+
+@case('parse_response.small')
+def bench_parse_response():
+    body = ecomm_body(2)
+    return lambda: parse_response(body)
+
+
+@case('parse_response.large')
+def bench_parse_response_large():
+    body = ecomm_body(1000)
+    return lambda: parse_response(body)
+
+
+@case('client_ip.resolve')
+def bench_client_ip_resolve():
+    environ = {
+        'HTTP_X_FORWARDED_FOR': '198.51.100.1, 203.0.113.7, 10.0.0.5',
+        'REMOTE_ADDR': '10.0.0.2',
+    }
+    return lambda: client_ip.resolve(environ)
+
+
+@case('quantiles.observe')
+def bench_quantiles_observe():
+    return lambda: quantiles.observe(
+        0.0873, 'BenchTBCProvider', 'get_trans_id', 'localhost:18443'
+    )
+
+
+@case('gel_to_tetri.decimal')
+def bench_gel_to_tetri_decimal():
+    amount = Decimal('23.45')
+    return lambda: gel_to_tetri(amount)
+
+
+@case('gel_to_tetri.float')
+def bench_gel_to_tetri_float():
+    return lambda: gel_to_tetri(23.45)
+
+
+@case('gel_to_tetri.int')
+def bench_gel_to_tetri_int():
+    return lambda: gel_to_tetri(23)
+
+
+@case('get_currency_code.symbol')
+def bench_get_currency_code_symbol():
+    return lambda: get_currency_code('EUR')
+
+
+@case('get_currency_code.code')
+def bench_get_currency_code_code():
+    return lambda: get_currency_code(978)
+
+
+@case('credo.check[3]')
+def bench_credo_check():
+    provider = BenchCredoProvider()
+    products = credo_products(3)
+    return lambda: provider.check(products=products)
+
+
+@case('credo.check[1000]')
+def bench_credo_check_large():
+    provider = BenchCredoProvider()
+    products = credo_products(1000)
+    return lambda: provider.check(products=products)
+
+
+@case('credo.form.render_form[100]')
+def bench_credo_form():
+    provider = BenchCredoProvider()
+    data = provider.set_installment_data(products=credo_products(100))
+    form = provider.form(data=data)
+    return lambda: (form.render_form(), form.input)
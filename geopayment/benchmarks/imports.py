@@ -0,0 +1,101 @@
+"""
+Cold import time of geopayment entry points, measured in fresh interpreters.
+
+    $ python -m geopayment.benchmarks.imports --threshold-ms 50
+
+Exits with status 1 when an entry point is slower than the threshold or
+loads a module it should not (e.g. `requests` for Credo signing).
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+
+# loaded by the opt-in features (journal, limits, logging, ...) only
+FEATURES = ('logging', 'mmap', 'socket')
+
+# (statement, modules that must stay unloaded after it)
+ENTRY_POINTS: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ('import geopayment', ('requests', 'urllib3', 'OpenSSL')),
+    ('from geopayment.providers.credo import CredoProvider',
+     ('requests', 'urllib3', 'OpenSSL') + FEATURES),
+    ('from geopayment import TBCProvider',
+     ('requests', 'OpenSSL') + FEATURES),
+    ('from geopayment import IPayProvider',
+     ('requests', 'OpenSSL') + FEATURES),
+    ('from geopayment.crypto import p12_to_pem', ('OpenSSL',)),
+)
+
+_PROBE = (
+    'import sys, time; started = time.perf_counter(); {statement}; '
+    'elapsed = time.perf_counter() - started; '
+    'print(elapsed, ",".join(m for m in {forbidden!r} if m in sys.modules))'
+)
+
+
+def measure(statement: str, forbidden: Tuple[str, ...],
+            repeat: int = 7) -> Dict:
+    """
+    :param statement: import statement
+    :param forbidden: modules which must not be loaded by `statement`
+    :param repeat: fresh interpreters to start
+    :return: median import time in milliseconds and leaked modules
+    """
+
+    samples: List[float] = list()
+    leaked = set()
+    code = _PROBE.format(statement=statement, forbidden=forbidden)
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, '-c', code], check=True,
+            stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout.split()
+        samples.append(float(out[0]) * 1000)
+        if len(out) > 1:
+            leaked.update(out[1].split(','))
+    return {
+        'statement': statement,
+        'median_ms': statistics.median(samples),
+        'min_ms': min(samples),
+        'leaked': sorted(leaked),
+    }
+
+
+def run(threshold_ms: float = 50.0, repeat: int = 7) -> List[Dict]:
+    results = list()
+    for statement, forbidden in ENTRY_POINTS:
+        result = measure(statement, forbidden, repeat)
+        result['ok'] = (
+            result['median_ms'] <= threshold_ms and not result['leaked']
+        )
+        results.append(result)
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='geopayment import time')
+    parser.add_argument('--threshold-ms', type=float, default=50.0)
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+    started = time.perf_counter()
+    results = run(args.threshold_ms, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            leaked = f" leaked={','.join(r['leaked'])}" if r['leaked'] else ''
+            print(
+                f"{'ok  ' if r['ok'] else 'FAIL'} {r['median_ms']:7.2f}ms "
+                f"{r['statement']}{leaked}"
+            )
+        print(f'done in {time.perf_counter() - started:.1f}s')
+    return 0 if all(r['ok'] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+Micro-benchmark runner, measures per-call CPU time and allocations of the
+registered cases and compares them against a saved baseline.
+
+    $ python -m geopayment.benchmarks --output baseline.json
+    $ python -m geopayment.benchmarks --compare baseline.json
+"""
+import argparse
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+
+__all__ = ['Case', 'CASES', 'case', 'measure', 'run', 'compare', 'main']
+
+
+class Case(object):
+    __slots__ = ('name', 'factory')
+
+    def __init__(self, name: str, factory: Callable[[], Callable]) -> None:
+        self.name = name
+        self.factory = factory
+
+
+CASES: List[Case] = list()
+
+
+def case(name: str):
+    """
+    Register a benchmark case, the decorated factory does the setup and
+    returns a zero argument callable which is measured.
+    """
+
+    def wrapper(factory):
+        CASES.append(Case(name, factory))
+        return factory
+
+    return wrapper
+
+
+def _timeit(func: Callable, number: int) -> float:
+    clock = time.process_time
+    started = clock()
+    for _ in range(number):
+        func()
+    return clock() - started
+
+
+def measure(func: Callable, min_time: float = 0.2,
+            repeat: int = 5) -> Dict:
+    """
+    :param func: zero argument callable
+    :param min_time: minimal CPU seconds of one round
+    :param repeat: measured rounds, the fastest one is reported
+    :return: per call cpu time and allocations
+    """
+
+    func()
+    number = 1
+    while True:
+        elapsed = _timeit(func, number)
+        if elapsed >= min_time / 5 or number >= 10 ** 7:
+            break
+        number *= 10
+    number = max(1, int(number * (min_time / 5) / max(elapsed, 1e-9)))
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        rounds = [_timeit(func, number) / number for _ in range(repeat)]
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'cpu_ns': min(rounds) * 1e9,
+        'cpu_ns_median': statistics.median(rounds) * 1e9,
+        'calls': number * repeat,
+        'peak_bytes': peak - before,
+        'retained_bytes': current - before,
+    }
+
+
+def run(cases: Optional[List[Case]] = None, pattern: str = None,
+        min_time: float = 0.2, repeat: int = 5) -> Dict:
+    """
+    :return: machine readable results keyed by case name
+    """
+    import geopayment
+
+    results = dict()
+    for c in cases or CASES:
+        if pattern and pattern not in c.name:
+            continue
+        results[c.name] = measure(c.factory(), min_time, repeat)
+    return {
+        'meta': {
+            'geopayment': geopayment.__version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+
+
+def compare(current: Dict, baseline: Dict,
+            tolerance: float = 0.1) -> List[Dict]:
+    """
+    :param current: results of `run`
+    :param baseline: saved results of `run`
+    :param tolerance: allowed relative slowdown before a case regresses
+    :return: per case comparison
+    """
+
+    rows = list()
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = result['cpu_ns'] / base['cpu_ns'] if base['cpu_ns'] else 1.0
+        rows.append({
+            'name': name,
+            'baseline_ns': base['cpu_ns'],
+            'current_ns': result['cpu_ns'],
+            'ratio': ratio,
+            'peak_bytes_delta': result['peak_bytes'] - base['peak_bytes'],
+            'regression': ratio > 1 + tolerance,
+        })
+    return rows
+
+
+def _print_results(results: Dict) -> None:
+    width = max((len(n) for n in results['results']), default=10)
+    for name, r in results['results'].items():
+        print(
+            f"{name:<{width}}  {r['cpu_ns']:>12.0f} ns/call  "
+            f"{r['peak_bytes']:>9} B peak  {r['retained_bytes']:>7} B kept"
+        )
+
+
+def _print_comparison(rows: List[Dict]) -> None:
+    width = max((len(r['name']) for r in rows), default=10)
+    for r in rows:
+        print(
+            f"{r['name']:<{width}}  {r['baseline_ns']:>12.0f} -> "
+            f"{r['current_ns']:>12.0f} ns  x{r['ratio']:.2f}"
+            f"{'  REGRESSION' if r['regression'] else ''}"
+        )
+
+
+def main(argv=None) -> int:
+    # importing registers the cases
+    from geopayment.benchmarks import hotpaths  # noqa: F401
+
+    parser = argparse.ArgumentParser(description='geopayment benchmarks')
+    parser.add_argument('-k', dest='pattern', help='run matching cases only')
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write json results to file')
+    parser.add_argument('--compare', help='baseline json results file')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--json', action='store_true',
+                        help='print json results to stdout')
+    args = parser.parse_args(argv)
+
+    results = run(pattern=args.pattern, min_time=args.min_time,
+                  repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif not args.compare:
+        _print_results(results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.tolerance)
+        _print_comparison(rows)
+        if any(r['regression'] for r in rows):
+            return 1
+    return 0
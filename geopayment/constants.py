@@ -6,6 +6,8 @@ Created on Jul 14, 2017
 @author: Lasha Gogua
 """
 
+from decimal import ROUND_HALF_EVEN, ROUND_UP
+
 # currency codes (ISO 4217)
 # https://en.wikipedia.org/wiki/ISO_4217
 
@@ -22,3 +24,19 @@ BOG_INSTALLMENT_ITEM_KEYS = (
     'item_vendor_code', 'product_image_url', 'item_site_detail_url'
 )
 TBC_INSTALLMENT_ITEM_KEYS = ('name', 'quantity', 'price')
+
+# rounding of amounts with more than two decimal places
+TBC_ROUNDING = ROUND_HALF_EVEN
+TBC_INSTALLMENT_ROUNDING = ROUND_HALF_EVEN
+BOG_ROUNDING = ROUND_UP
+CREDO_ROUNDING = ROUND_HALF_EVEN
+
+# results after which the bank reports the same status until we refund,
+# reverse, confirm or cancel the payment ourselves
+TBC_FINAL_RESULTS = (
+    'OK', 'FAILED', 'DECLINED', 'REVERSED', 'AUTOREVERSED', 'TIMEOUT'
+)
+BOG_FINAL_STATUSES = (
+    'success', 'error', 'rejected', 'completed', 'performed', 'refunded'
+)
+TBC_INSTALLMENT_FINAL_STATUS_IDS = (5, 7, 9)
@@ -6,8 +6,6 @@ Created on Jul 14, 2017
 @author: Lasha Gogua
 """
 
-from OpenSSL import crypto
-
 
 def p12_to_pem(cert=None, password=None, file_name=None, output=str()):
     """
@@ -19,6 +17,9 @@ def p12_to_pem(cert=None, password=None, file_name=None, output=str()):
     :return: certificate and key in pem format
     """
 
+    # pyOpenSSL is only needed here, keep it out of the import path
+    from OpenSSL import crypto
+
     if not (cert or password):
         cert = input('Enter Certificate absolute path: \n')
         password = input('Enter Certificate passphrase: \n')
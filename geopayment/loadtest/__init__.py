@@ -0,0 +1,25 @@
+"""
+Load tests of the provider flows, how many checkouts per second a worker
+drives through the SDK before it runs out of CPU or connections.
+
+    $ python -m geopayment.loadtest tbc-sms --simulator --duration 10
+    $ python -m geopayment.loadtest bog-checkout --simulator --rate 200 \
+        --concurrency 32 --simulator-latency lognormal:0.03,0.5 --pooled
+    $ python -m geopayment.loadtest tbc-dms \
+        --url https://localhost:18443/ecomm2/MerchantHandler \
+        --cert client.pem --cert-key client-key.pem --json
+
+Flows: `tbc-sms`, `tbc-dms`, `bog-checkout` and `tbc-installment`
+(create, status and confirm). The report has the throughput, the
+latency percentiles of the flows and of every step, the CPU utilization
+and the errors by step and kind.
+
+`--simulator` runs the stand-in server in the load test process, it
+shares the CPU, start `python -m geopayment.simulator` elsewhere and
+pass its `--url` to measure the SDK alone.
+"""
+from geopayment.loadtest.flows import FLOWS, make_provider
+from geopayment.loadtest.runner import format_report, run
+
+
+__all__ = ['FLOWS', 'format_report', 'make_provider', 'run']
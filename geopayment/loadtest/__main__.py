@@ -0,0 +1,6 @@
+import sys
+
+from geopayment.loadtest.runner import main
+
+
+sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+Scripted payment flows of the load tests.
+
+A flow is a function of the flow context, a `step` callable and the
+iteration number. `step(name, method, **kwargs)` calls a provider method,
+records its latency and raises `StepFailed` when the bank answered with
+an error, which ends the iteration.
+"""
+import uuid
+from decimal import Decimal
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from geopayment.providers.metrics import result_code
+
+
+__all__ = [
+    'FLOWS',
+    'SERVICE_PATHS',
+    'StepFailed',
+    'error_kind',
+    'make_provider',
+]
+
+# service url path of the banks on a stand-in server
+SERVICE_PATHS = {
+    'tbc': '/ecomm2/MerchantHandler',
+    'tbc-installment': '/',
+    'bog': '/opay/api/v1/',
+}
+
+
+class StepFailed(Exception):
+
+    def __init__(self, step: str, kind: str) -> None:
+        super().__init__(f'{step}: {kind}')
+        self.step = step
+        self.kind = kind
+
+
+def error_kind(result: Any) -> Optional[str]:
+    """
+    :param result: result of a provider method
+    :return: `None` for a success, otherwise the HTTP status, bank result
+             code, `transport_error` or `malformed_response`
+    """
+    if not isinstance(result, dict):
+        return None
+    status = result.get('HTTP_STATUS_CODE')
+    code = result_code(result)
+    if 'ERROR' in result and status in (None, 'N/A'):
+        return 'transport_error'
+    if isinstance(status, int) and status >= 400:
+        return f'HTTP {status}'
+    if 'fault' in result or 'error' in result or 'ERROR' in result or \
+            result.get('RESULT') == 'FAILED':
+        return code or 'failed'
+    return None
+
+
+def make_provider(bank: str, service_url: str, cert: Any = None,
+                  client_id: str = 'loadtest', secret: str = 'loadtest',
+                  transport: Any = None) -> Any:
+    """
+    :param bank: `tbc`, `tbc-installment` or `bog`
+    :param service_url: service url of the bank, a stand-in server too
+    :param cert: TBC ECOMM client certificate
+    :param client_id: OAuth client id (key) of BOG and TBC installments
+    :param secret: OAuth client secret
+    :return: stateless provider instance, shared by the load test threads
+    """
+    attributes = {'stateless': True, 'service_url': service_url}
+    if transport is not None:
+        attributes['transport'] = transport
+    if bank == 'tbc':
+        from geopayment.providers.tbc import TBCProvider
+
+        attributes.update({
+            'description': 'load test', 'client_ip': '127.0.0.1',
+            'cert': cert,
+        })
+        return type('LoadTestTBCProvider', (TBCProvider,), attributes)()
+    if bank == 'tbc-installment':
+        from geopayment.providers.tbc import TBCInstallmentProvider
+
+        attributes.update({
+            'merchant_key': 'loadtest', 'campaign_id': '1',
+            'key': client_id, 'secret': secret,
+        })
+        return type(
+            'LoadTestTBCInstallmentProvider', (TBCInstallmentProvider,),
+            attributes
+        )()
+    if bank == 'bog':
+        from geopayment.providers.bog import IPayProvider
+
+        attributes.update({
+            'client_id': client_id, 'secret_key': secret,
+            'redirect_url': 'https://localhost/loadtest',
+        })
+        return type('LoadTestIPayProvider', (IPayProvider,), attributes)()
+    raise ValueError(f'Invalid params, unknown bank `{bank}`.')
+
+
+def _tbc_sms(context: Dict[str, Any], step: Callable, i: int) -> None:
+    provider = context['provider']
+    result = step('get_trans_id', provider.get_trans_id,
+                  amount=Decimal('10.50'), currency='GEL')
+    step('check_trans_status', provider.check_trans_status,
+         trans_id=result['TRANSACTION_ID'])
+
+
+def _tbc_dms(context: Dict[str, Any], step: Callable, i: int) -> None:
+    provider = context['provider']
+    result = step('pre_auth_trans', provider.pre_auth_trans,
+                  amount=Decimal('10.50'), currency='GEL')
+    # the card holder authorized the amount
+    step('check_trans_status', provider.check_trans_status,
+         trans_id=result['TRANSACTION_ID'])
+    step('confirm_pre_auth_trans', provider.confirm_pre_auth_trans,
+         trans_id=result['TRANSACTION_ID'], amount=Decimal('10.50'),
+         currency='GEL')
+
+
+def _bog_setup(context: Dict[str, Any]) -> None:
+    result = context['provider'].get_auth()
+    kind = error_kind(result)
+    if kind is not None:
+        raise StepFailed('get_auth', kind)
+    context['access_token'] = result['access_token']
+
+
+def _bog_checkout(context: Dict[str, Any], step: Callable, i: int) -> None:
+    provider, token = context['provider'], context['access_token']
+    order = step(
+        'checkout', provider.checkout, access_token=token,
+        shop_order_id=f'loadtest-{i}',
+        items=[{'amount': Decimal('10.50'), 'description': 'load test',
+                'quantity': 1, 'product_id': str(i)}]
+    )
+    step('checkout_status', provider.checkout_status, access_token=token,
+         order_id=order['order_id'])
+
+
+def _tbc_installment_setup(context: Dict[str, Any]) -> None:
+    provider = context['provider']
+    auth = type(provider).auth(provider)
+    kind = error_kind(auth)
+    if kind is not None:
+        raise StepFailed('auth', kind)
+    context['access_token'] = auth.access_token
+
+
+def _tbc_installment(context: Dict[str, Any], step: Callable,
+                     i: int) -> None:
+    provider, token = context['provider'], context['access_token']
+    application = step(
+        'create', provider.create, access_token=token,
+        invoice_id=f'loadtest-{i}-{uuid.uuid4().hex[:8]}',
+        products=[{'name': 'load test', 'price': Decimal('150.30'),
+                   'quantity': 1}]
+    )
+    session_id = application['session_id']
+    step('status', provider.status, access_token=token,
+         session_id=session_id, cached=False)
+    step('confirm', provider.confirm, access_token=token,
+         session_id=session_id)
+
+
+# flow name: (bank, flow, setup run once per load test)
+FLOWS: Dict[str, Tuple[str, Callable, Optional[Callable]]] = {
+    'tbc-sms': ('tbc', _tbc_sms, None),
+    'tbc-dms': ('tbc', _tbc_dms, None),
+    'bog-checkout': ('bog', _bog_checkout, _bog_setup),
+    'tbc-installment': (
+        'tbc-installment', _tbc_installment, _tbc_installment_setup
+    ),
+}
@@ -0,0 +1,277 @@
+"""
+Closed and open loop load generation of the scripted flows.
+
+Closed loop, `concurrency` threads run flows back to back. Open loop,
+flows start at `rate` per second on up to `concurrency` threads, their
+latency is counted from the scheduled start, so a saturated worker shows
+up as queueing time instead of a lower request rate.
+"""
+import argparse
+import itertools
+import json
+import math
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from geopayment.loadtest.flows import (
+    FLOWS,
+    SERVICE_PATHS,
+    StepFailed,
+    error_kind,
+    make_provider,
+)
+
+
+__all__ = ['PERCENTILES', 'Recorder', 'format_report', 'main', 'run']
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """
+    :param ordered: sorted values
+    :param q: percentile, 0-100
+    :return: nearest rank percentile, 0 without values
+    """
+    if not ordered:
+        return 0.0
+    rank = math.ceil(len(ordered) * q / 100) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    summary = {'count': len(ordered)}
+    for q in PERCENTILES:
+        summary[f'p{q:g}'] = round(percentile(ordered, q) * 1000, 3)
+    summary['max'] = round(ordered[-1] * 1000, 3) if ordered else 0.0
+    return summary
+
+
+class Recorder(object):
+    """
+    Latencies of the flows and their steps, and errors by step and kind.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flows: List[float] = list()
+        self.steps: Dict[str, List[float]] = dict()
+        self.errors: Counter = Counter()
+        self.failed = 0
+
+    def step(self, name: str, method: Callable, **kwargs: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            result = method(**kwargs)
+        except Exception as e:
+            self._step(name, time.perf_counter() - started)
+            raise StepFailed(name, type(e).__name__) from e
+        self._step(name, time.perf_counter() - started)
+        kind = error_kind(result)
+        if kind is not None:
+            raise StepFailed(name, kind)
+        return result
+
+    def _step(self, name: str, elapsed: float) -> None:
+        with self.lock:
+            self.steps.setdefault(name, list()).append(elapsed)
+
+    def flow(self, elapsed: float, error: Optional[StepFailed]) -> None:
+        with self.lock:
+            self.flows.append(elapsed)
+            if error is not None:
+                self.failed += 1
+                self.errors[f'{error.step}: {error.kind}'] += 1
+
+
+def run(flow: str, provider: Any, duration: float = 10.0,
+        concurrency: int = 8, rate: Optional[float] = None) -> Dict[str, Any]:
+    """
+    :param flow: name of a flow in `FLOWS`
+    :param provider: provider of the flow's bank, see `make_provider`
+    :param duration: seconds new flows are started
+    :param concurrency: threads running flows
+    :param rate: flows started per second, closed loop when `None`
+    :return: report, see `format_report`
+    """
+    _, script, setup = FLOWS[flow]
+    context = {'provider': provider}
+    if setup is not None:
+        setup(context)
+    recorder = Recorder()
+    counter = itertools.count()
+
+    def iteration(scheduled: float) -> None:
+        error = None
+        try:
+            script(context, recorder.step, next(counter))
+        except StepFailed as e:
+            error = e
+        recorder.flow(time.perf_counter() - scheduled, error)
+
+    cpu, started = time.process_time(), time.perf_counter()
+    stop_at = started + duration
+    if rate is None:
+        def loop() -> None:
+            while time.perf_counter() < stop_at:
+                iteration(time.perf_counter())
+
+        threads = [threading.Thread(target=loop, daemon=True)
+                   for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        interval = 1.0 / rate
+        with ThreadPoolExecutor(concurrency) as executor:
+            scheduled = started
+            while scheduled < stop_at:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(iteration, scheduled)
+                scheduled += interval
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+
+    return {
+        'flow': flow,
+        'mode': 'closed' if rate is None else 'open',
+        'concurrency': concurrency,
+        'target_rate': rate,
+        'elapsed': round(elapsed, 3),
+        'flows': len(recorder.flows),
+        'failed': recorder.failed,
+        'throughput': round(len(recorder.flows) / elapsed, 2),
+        'requests_per_second': round(
+            sum(len(v) for v in recorder.steps.values()) / elapsed, 2
+        ),
+        'cpu_utilization': round(cpu / elapsed, 3),
+        'latency_ms': _summary(recorder.flows),
+        'steps_ms': {
+            name: _summary(values) for name, values in recorder.steps.items()
+        },
+        'errors': dict(recorder.errors.most_common()),
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    rate = report['target_rate']
+    lines = [
+        f"{report['flow']}: {report['flows']} flows in "
+        f"{report['elapsed']}s, {report['failed']} failed, "
+        f"{report['mode']} loop, concurrency {report['concurrency']}"
+        + (f', target {rate}/s' if rate else ''),
+        f"throughput {report['throughput']} flows/s, "
+        f"{report['requests_per_second']} requests/s, "
+        f"cpu {report['cpu_utilization'] * 100:.0f}%",
+        '',
+        f"{'latency ms':<28}" + ''.join(
+            f'{f"p{q:g}":>10}' for q in PERCENTILES
+        ) + f"{'max':>10}{'count':>10}",
+    ]
+    rows = [('flow', report['latency_ms'])]
+    rows.extend(sorted(report['steps_ms'].items()))
+    for name, summary in rows:
+        lines.append(
+            f'{name:<28}' + ''.join(
+                f"{summary[f'p{q:g}']:>10.2f}" for q in PERCENTILES
+            ) + f"{summary['max']:>10.2f}{summary['count']:>10}"
+        )
+    if report['errors']:
+        lines.extend(['', 'errors'])
+        for kind, count in report['errors'].items():
+            lines.append(f'  {kind:<40}{count:>10}')
+    if report.get('faults_injected'):
+        lines.extend(['', 'faults injected'])
+        for kind, count in report['faults_injected'].items():
+            lines.append(f'  {kind:<40}{count:>10}')
+    return '\n'.join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='geopayment load test')
+    parser.add_argument('flow', choices=sorted(FLOWS))
+    parser.add_argument('--url', help='service url of the bank')
+    parser.add_argument('--simulator', action='store_true',
+                        help='run against a local stand-in server')
+    parser.add_argument('--simulator-latency',
+                        help='e.g. fixed:0.02, lognormal:0.03,0.5')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float,
+                        help='flows per second, closed loop when not set')
+    parser.add_argument('--cert', help='TBC ECOMM client certificate')
+    parser.add_argument('--cert-key', help='TBC ECOMM client key')
+    parser.add_argument('--client-id', default='loadtest')
+    parser.add_argument('--secret', default='loadtest')
+    parser.add_argument('--pooled', action='store_true',
+                        help='keep connections open between calls')
+    parser.add_argument('--faults',
+                        help='JSON file of fault injection rules')
+    parser.add_argument('--fault-seed',
+                        help='seed of the faults, overrides the file')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+    if not args.url and not args.simulator:
+        parser.error('either --url or --simulator is required')
+
+    bank = FLOWS[args.flow][0]
+    server = None
+    url = args.url
+    if args.simulator:
+        from geopayment.simulator import (
+            SIMULATORS,
+            Behaviour,
+            SimulatorServer,
+        )
+        from geopayment.simulator.base import parse_latency
+
+        behaviour = Behaviour(latency=parse_latency(args.simulator_latency))
+        server = SimulatorServer(SIMULATORS[bank](behaviour=behaviour))
+        server.start()
+        url = f'{server.url}{SERVICE_PATHS[bank]}'
+    cert = args.cert
+    if cert and args.cert_key:
+        cert = (cert, args.cert_key)
+    transport = None
+    if args.pooled:
+        from geopayment.providers.transport import PooledTransport
+
+        transport = PooledTransport(pool_maxsize=args.concurrency)
+    faults = None
+    if args.faults:
+        from geopayment.providers.faults import FaultTransport
+
+        with open(args.faults) as f:
+            config = json.load(f)
+        if args.fault_seed is not None:
+            config['seed'] = args.fault_seed
+        transport = faults = FaultTransport.from_config(config, transport)
+    provider = make_provider(
+        bank, url, cert=cert, client_id=args.client_id, secret=args.secret,
+        transport=transport
+    )
+    try:
+        report = run(
+            args.flow, provider, duration=args.duration,
+            concurrency=args.concurrency, rate=args.rate
+        )
+    except StepFailed as e:
+        print(f'{args.flow} setup failed, {e}')
+        return 1
+    finally:
+        if server is not None:
+            server.stop()
+    if faults is not None:
+        report['faults_injected'] = dict(faults.injected.most_common())
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+    return 0
@@ -0,0 +1,288 @@
+"""
+Fixed-point money in integer minor units (tetri, cents).
+
+Integers and Money are handled with integer arithmetic only, other
+amounts are rounded once with an explicit rounding policy. Floats are read
+by their shortest repr, `23.45` is 2345 tetri and not 2344.99...
+
+>>> Money.parse('23.45')
+Money(2345, 'GEL')
+>>> Money.sum(['0.10', 0.2, Decimal('1')]).to_major()
+'1.30'
+"""
+from decimal import (
+    Decimal,
+    InvalidOperation,
+    ROUND_DOWN,
+    ROUND_HALF_EVEN,
+    ROUND_HALF_UP,
+    ROUND_UP,
+)
+from typing import Iterable, Union
+
+from geopayment.constants import ALLOW_CURRENCY_CODES, CURRENCY_CODES
+
+
+__all__ = [
+    'Money',
+    'to_minor',
+    'ROUND_DOWN',
+    'ROUND_HALF_EVEN',
+    'ROUND_HALF_UP',
+    'ROUND_UP',
+]
+
+Amount = Union['Money', int, float, str, Decimal]
+
+_SCALE = 100
+_CODE_SYMBOLS = dict(zip(CURRENCY_CODES, ALLOW_CURRENCY_CODES))
+
+
+def _decimal(amount) -> Decimal:
+    cls = type(amount)
+    if cls is Decimal:
+        return amount
+    if cls is float:
+        amount = repr(amount)
+    elif cls is not str:
+        if isinstance(amount, bool) or not isinstance(
+                amount, (str, int, float, Decimal)):
+            raise ValueError(f'Invalid amount {amount!r}')
+        if isinstance(amount, float):
+            amount = repr(float(amount))
+    try:
+        return Decimal(amount)
+    except (InvalidOperation, ValueError):
+        raise ValueError(f'Invalid amount {amount!r}')
+
+
+def _currency(currency) -> str:
+    """
+    :param currency: currency symbol, any case, or ISO 4217 numeric code
+    :return: currency symbol
+    """
+    code = currency
+    if type(code) is str:
+        code = code.strip().upper()
+        if code in ALLOW_CURRENCY_CODES:
+            return code
+        if code.isdigit():
+            code = int(code)
+    if type(code) is int and code in _CODE_SYMBOLS:
+        return _CODE_SYMBOLS[code]
+    raise ValueError(
+        f'Invalid currency code {currency!r}, Allowed codes: GEL, USD, EUR'
+    )
+
+
+def _round(value: Decimal, rounding: str) -> int:
+    try:
+        return int(value.scaleb(2).to_integral_value(rounding))
+    except (ArithmeticError, ValueError):
+        raise ValueError(f'Invalid amount {value!r}')
+
+
+def to_minor(amount: Amount, rounding: str = ROUND_HALF_EVEN) -> int:
+    """
+    :param amount: amount in major units, or Money
+    :param rounding: decimal rounding mode for more than two decimal places
+    :return: amount in minor units
+
+    >>> to_minor('0.125', ROUND_HALF_UP)
+    13
+    """
+    cls = type(amount)
+    if cls is int:
+        return amount * _SCALE
+    if cls is Money:
+        return amount.minor
+    if cls is not Decimal:
+        amount = _decimal(amount)
+    try:
+        return int(amount.scaleb(2).to_integral_value(rounding))
+    except (ArithmeticError, ValueError):
+        raise ValueError(f'Invalid amount {amount!r}')
+
+
+def _check_currency(money: 'Money', currency) -> None:
+    if money.currency == currency:
+        return
+    currency = _currency(currency)
+    if money.currency != currency:
+        raise ValueError(
+            f'Currency mismatch, {money.currency} and {currency}'
+        )
+
+
+class Money(object):
+    """
+    Immutable amount of integer minor units in a currency.
+    """
+
+    __slots__ = ('minor', 'currency')
+
+    def __init__(self, minor: int, currency: str = 'GEL') -> None:
+        if type(minor) is not int:
+            raise ValueError('Invalid amount, `minor` must be integer.')
+        if currency not in ALLOW_CURRENCY_CODES:
+            currency = _currency(currency)
+        _set_minor(self, minor)
+        _set_currency(self, currency)
+
+    @classmethod
+    def parse(cls, amount: Amount, currency: str = 'GEL',
+              rounding: str = ROUND_HALF_EVEN) -> 'Money':
+        """
+        :param amount: amount in major units (lari, dollars), or Money
+        :param currency: currency symbol or ISO 4217 code
+        :param rounding: decimal rounding mode for more than two decimals
+        """
+        if type(amount) is cls:
+            _check_currency(amount, currency)
+            return amount
+        return cls(to_minor(amount, rounding), currency)
+
+    @classmethod
+    def sum(cls, amounts: Iterable[Amount], currency: str = 'GEL',
+            rounding: str = ROUND_HALF_EVEN) -> 'Money':
+        """
+        Exact sum rounded once, so rounding is applied to the total and
+        not to every amount. Money amounts must be in `currency`.
+        """
+        if currency not in ALLOW_CURRENCY_CODES:
+            currency = _currency(currency)
+        total = 0
+        # non integer amounts are summed exactly and rounded once
+        rest = None
+        for amount in amounts:
+            cls_ = type(amount)
+            if cls_ is int:
+                total += amount * _SCALE
+            elif cls_ is Money:
+                _check_currency(amount, currency)
+                total += amount.minor
+            else:
+                if cls_ is not Decimal:
+                    amount = _decimal(amount)
+                rest = amount if rest is None else rest + amount
+        if rest is not None:
+            total += _round(rest, rounding)
+        return cls(total, currency)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Money is immutable')
+
+    def __reduce__(self):
+        return type(self), (self.minor, self.currency)
+
+    def _other(self, other) -> int:
+        if type(other) is Money:
+            if other.currency != self.currency:
+                raise ValueError(
+                    f'Currency mismatch, {self.currency} and {other.currency}'
+                )
+            return other.minor
+        if other == 0:
+            return 0
+        return NotImplemented
+
+    def __add__(self, other):
+        minor = self._other(other)
+        if minor is NotImplemented:
+            return minor
+        return Money(self.minor + minor, self.currency)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        minor = self._other(other)
+        if minor is NotImplemented:
+            return minor
+        return Money(self.minor - minor, self.currency)
+
+    def __mul__(self, other):
+        if type(other) is not int:
+            return NotImplemented
+        return Money(self.minor * other, self.currency)
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return Money(-self.minor, self.currency)
+
+    def __abs__(self):
+        return Money(abs(self.minor), self.currency)
+
+    def __bool__(self) -> bool:
+        return self.minor != 0
+
+    def __eq__(self, other) -> bool:
+        if type(other) is not Money:
+            return NotImplemented
+        return self.minor == other.minor and self.currency == other.currency
+
+    def __lt__(self, other) -> bool:
+        minor = self._other(other)
+        if minor is NotImplemented:
+            return minor
+        return self.minor < minor
+
+    def __le__(self, other) -> bool:
+        minor = self._other(other)
+        if minor is NotImplemented:
+            return minor
+        return self.minor <= minor
+
+    def __gt__(self, other) -> bool:
+        minor = self._other(other)
+        if minor is NotImplemented:
+            return minor
+        return self.minor > minor
+
+    def __ge__(self, other) -> bool:
+        minor = self._other(other)
+        if minor is NotImplemented:
+            return minor
+        return self.minor >= minor
+
+    def __hash__(self) -> int:
+        return hash((self.minor, self.currency))
+
+    def __repr__(self) -> str:
+        return f'Money({self.minor}, {self.currency!r})'
+
+    def __str__(self) -> str:
+        return self.to_major()
+
+    def to_minor(self) -> int:
+        """
+        :return: integer minor units, TBC ECOMM `amount` and Credo `price`
+        """
+        return self.minor
+
+    def to_major(self) -> str:
+        """
+        :return: two decimal places string, BOG `value` and TBC
+                 installment `priceTotal`
+        """
+        minor = self.minor
+        if minor < 0:
+            whole, frac = divmod(-minor, _SCALE)
+            return f'-{whole}.{frac:02d}'
+        whole, frac = divmod(minor, _SCALE)
+        return f'{whole}.{frac:02d}'
+
+    def to_decimal(self) -> Decimal:
+        return Decimal(self.minor).scaleb(-2)
+
+    @property
+    def currency_code(self) -> int:
+        """
+        :return: ISO 4217 numeric currency code
+        """
+        return ALLOW_CURRENCY_CODES[self.currency]
+
+
+# slot setters bypass the immutable __setattr__
+_set_minor = Money.minor.__set__
+_set_currency = Money.currency.__set__
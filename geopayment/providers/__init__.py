@@ -1,3 +1,26 @@
-from geopayment.providers.credo import CredoProvider
-from geopayment.providers.tbc import TBCProvider, TBCInstallmentProvider
-from geopayment.providers.bog import IPayProvider, IPayInstallmentProvider
+from importlib import import_module
+
+
+# providers are imported on first access, so `import geopayment` does not
+# pay for `requests` and every provider module up front
+_PROVIDERS = {
+    'CredoProvider': 'geopayment.providers.credo',
+    'TBCProvider': 'geopayment.providers.tbc',
+    'TBCInstallmentProvider': 'geopayment.providers.tbc',
+    'IPayProvider': 'geopayment.providers.bog',
+    'IPayInstallmentProvider': 'geopayment.providers.bog',
+}
+
+__all__ = list(_PROVIDERS)
+
+
+def __getattr__(name):
+    if name not in _PROVIDERS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(_PROVIDERS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,89 @@
+"""
+requests adapter whose connections report DNS, TCP connect and TLS
+handshake timings to the running call profile.
+"""
+import socket
+from time import perf_counter
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from geopayment.providers import profiling
+
+
+__all__ = ['ProfilingHTTPAdapter']
+
+
+class _ProfiledConnectionMixin(object):
+
+    def _new_conn(self):
+        profile = profiling.current()
+        if profile is None:
+            return super()._new_conn()
+
+        host = self._dns_host
+        started = perf_counter()
+        try:
+            address = socket.getaddrinfo(
+                host, self.port, 0, socket.SOCK_STREAM
+            )[0][4][0]
+        except (OSError, IndexError):
+            address = None
+        resolved = perf_counter()
+        profile.dns += resolved - started
+        if address is None:
+            sock = super()._new_conn()
+        else:
+            # connect to the resolved address, TLS still uses the host name
+            self._dns_host = address
+            try:
+                sock = super()._new_conn()
+            except OSError:
+                self._dns_host = host
+                sock = super()._new_conn()
+            finally:
+                self._dns_host = host
+        profile.connect += perf_counter() - resolved
+        return sock
+
+    def connect(self):
+        profile = profiling.current()
+        if profile is None:
+            return super().connect()
+
+        setup = profile.dns + profile.connect
+        started = perf_counter()
+        try:
+            return super().connect()
+        finally:
+            elapsed = perf_counter() - started
+            profile.tls += max(
+                0.0, elapsed - (profile.dns + profile.connect - setup)
+            )
+
+
+class ProfiledHTTPConnection(_ProfiledConnectionMixin, HTTPConnection):
+    pass
+
+
+class ProfiledHTTPSConnection(_ProfiledConnectionMixin, HTTPSConnection):
+    pass
+
+
+class ProfiledHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = ProfiledHTTPConnection
+
+
+class ProfiledHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = ProfiledHTTPSConnection
+
+
+class ProfilingHTTPAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': ProfiledHTTPConnectionPool,
+            'https': ProfiledHTTPSConnectionPool,
+        }
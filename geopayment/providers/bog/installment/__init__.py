@@ -1,7 +1,7 @@
 from typing import Optional, Any, Dict
 
 from geopayment.providers.bog.provider import IPayProvider
-from geopayment.providers.utils import _request, bog_params
+from geopayment.providers.utils import _request, bog_params, is_stateless
 
 
 class IPayInstallmentProvider(IPayProvider):
@@ -17,6 +17,8 @@ class IPayInstallmentProvider(IPayProvider):
         """
 
         result = kwargs['result']
+        if is_stateless(self, kwargs):
+            return result
         if 'status' in result:
             self.order_status = result['status']
         if 'links' in result and self.order_status:
@@ -28,7 +30,7 @@ class IPayInstallmentProvider(IPayProvider):
         return result
 
     @bog_params(currency_code='GEL', endpoint='services/installment/calculate', api='installment-calculate')
-    @_request(verify=True, timeout=(3, 10), method='post')
+    @_request(verify=True, timeout=(3, 10), method='post', coalesce=True)
     def calculate(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         installment calculate api docs: https://api.bog.ge/docs/installment/get-discounts
@@ -9,7 +9,8 @@ Created on Apr 14, 2020
 from base64 import b64encode
 from typing import Optional, Any, Dict
 
-from geopayment.providers.utils import _request, bog_params
+from geopayment.providers.cache import bog_final
+from geopayment.providers.utils import _request, bog_params, is_stateless
 
 
 __all__ = ['IPayProvider']
@@ -19,6 +20,9 @@ class BaseIPayProvider(object):
     access: Dict = None
     rel_approve: str = None
     order_status: str = None
+    # methods return their results without storing them on the instance,
+    # can be overridden per call with `stateless=True/False`
+    stateless: bool = False
 
     def __init__(self) -> None:
         assert callable(self.client_id) is False, \
@@ -86,8 +90,10 @@ class IPayProvider(BaseIPayProvider):
         :return: result
         """
 
-        self.access = kwargs['result']
-        return self.access
+        result = kwargs['result']
+        if not is_stateless(self, kwargs):
+            self.access = result
+        return result
 
     @bog_params(currency_code='GEL', endpoint='checkout/orders', api='checkout')
     @_request(verify=True, timeout=(3, 10), method='post')
@@ -99,6 +105,8 @@ class IPayProvider(BaseIPayProvider):
         """
 
         result = kwargs['result']
+        if is_stateless(self, kwargs):
+            return result
         if 'status' in result:
             self.order_status = result['status']
         if 'links' in result and self.order_status:
@@ -110,7 +118,8 @@ class IPayProvider(BaseIPayProvider):
         return result
 
     @bog_params(endpoint='checkout/refund', api='refund')
-    @_request(verify=True, timeout=(3, 10), method='post')
+    @_request(verify=True, timeout=(3, 10), method='post',
+              invalidates='order_id')
     def refund(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
 
@@ -121,7 +130,8 @@ class IPayProvider(BaseIPayProvider):
         return kwargs['result']
 
     @bog_params(endpoint='checkout/orders/status/{order_id}', api='status')
-    @_request(verify=True, timeout=(3, 10), method='get')
+    @_request(verify=True, timeout=(3, 10), method='get', coalesce=True,
+              cache_by='order_id', final=bog_final)
     def checkout_status(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
 
@@ -132,7 +142,8 @@ class IPayProvider(BaseIPayProvider):
         return kwargs['result']
 
     @bog_params(endpoint='checkout/orders/{order_id}', api='details')
-    @_request(verify=True, timeout=(3, 10), method='get')
+    @_request(verify=True, timeout=(3, 10), method='get', coalesce=True,
+              cache_by='order_id', final=bog_final)
     def checkout_details(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
 
@@ -143,7 +154,8 @@ class IPayProvider(BaseIPayProvider):
         return kwargs['result']
 
     @bog_params(endpoint='checkout/payment/{order_id}', api='payment')
-    @_request(verify=True, timeout=(3, 10), method='get')
+    @_request(verify=True, timeout=(3, 10), method='get', coalesce=True,
+              cache_by='order_id', final=bog_final)
     def payment_details(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
 
@@ -0,0 +1,327 @@
+"""
+Finality-aware cache of status and detail lookups.
+
+A provider with a `response_cache` keeps lookup responses by payment id:
+final ones (TBC `RESULT` OK/FAILED/..., BOG order completed or rejected,
+TBC installment terminal `statusId`) indefinitely, the others for
+`ttl` seconds, failed requests are never cached. Refunds, reversals,
+confirmations and cancellations of a payment drop its cached responses.
+
+>>> class MyIPayProvider(IPayProvider):
+...     response_cache = LRUCache(maxsize=10000, ttl=5)
+>>> provider.checkout_status(order_id='X')              # bank
+>>> provider.checkout_status(order_id='X')              # cache
+>>> provider.checkout_status(order_id='X', cached=False)  # bank, stored
+
+Responses are kept per merchant account, the key holds a fingerprint of
+the provider credentials (service url, certificate, client id, merchant
+key, tenant), providers of different accounts sharing a backend never
+see each other's responses. The fingerprint is computed once per
+provider instance.
+
+A lookup in flight while a refund of the same payment invalidates its
+responses never stores its own: every key has a generation bumped on
+invalidation, a response is dropped when the generation changed since
+the request was sent. Generations are kept per process, a refund in
+another process sharing the backend does not stop the store.
+
+Any object with `get(key)`, `set(key, value, ttl)` and `delete(key)`
+works as a backend, values are JSON strings, `ttl` is `None` for final
+responses. `SQLiteCache` shares responses between processes on a host,
+expired rows are purged on write every `purge_interval` seconds,
+`RedisCache` wraps a redis-py compatible client.
+"""
+import hashlib
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from geopayment.constants import (
+    BOG_FINAL_STATUSES,
+    TBC_FINAL_RESULTS,
+    TBC_INSTALLMENT_FINAL_STATUS_IDS,
+)
+from geopayment.providers import forksafe, metrics, tenants
+
+
+__all__ = [
+    'LRUCache',
+    'SQLiteCache',
+    'RedisCache',
+    'tbc_final',
+    'bog_final',
+    'tbc_installment_final',
+]
+
+# names of the cached provider methods, all of them are dropped on
+# invalidation of a payment id
+_methods: Set[str] = set()
+# provider attributes telling merchant accounts apart
+CREDENTIALS = (
+    'tenant', 'service_url', 'cert', 'client_id', 'merchant_id',
+    'merchant_key', 'campaign_id', 'key',
+)
+# generations of the cache keys, hashed to a fixed number of slots, a
+# collision only drops a response that could have been stored
+_GENERATION_SLOTS = 4096
+_generations = [0] * _GENERATION_SLOTS
+_counter = itertools.count(1)
+
+
+def tbc_final(result: Dict) -> bool:
+    return result.get('RESULT') in TBC_FINAL_RESULTS
+
+
+def bog_final(result: Dict) -> bool:
+    return str(result.get('status', '')).lower() in BOG_FINAL_STATUSES
+
+
+def tbc_installment_final(result: Dict) -> bool:
+    return result.get('statusId') in TBC_INSTALLMENT_FINAL_STATUS_IDS
+
+
+class LRUCache(object):
+    """
+    In-memory cache of one process, least recently used responses are
+    evicted above `maxsize`.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 5.0) -> None:
+        """
+        :param maxsize: kept responses
+        :param ttl: seconds a non-final response is kept
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: 'OrderedDict[str, Tuple[str, Optional[float]]]' = \
+            OrderedDict()
+        forksafe.register(self)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: Optional[float]) -> None:
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache(object):
+    """
+    Cache in a SQLite database, shared by the processes of a host.
+    """
+
+    def __init__(self, path: str, ttl: float = 5.0,
+                 purge_interval: float = 60.0) -> None:
+        """
+        :param path: database file
+        :param ttl: seconds a non-final response is kept
+        :param purge_interval: seconds between purges of expired rows
+        """
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._purge_at = time.monotonic() + purge_interval
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS geopayment_cache '
+                '(key TEXT PRIMARY KEY, value TEXT, expires REAL)'
+            )
+        forksafe.register(self)
+
+    def _after_fork(self) -> None:
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            # a SQLite connection must not cross a fork, it is neither
+            # used nor closed in the child
+            forksafe.abandon(connection)
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            import sqlite3
+
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            'SELECT value, expires FROM geopayment_cache WHERE key = ?',
+            (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: Optional[float]) -> None:
+        expires = None if ttl is None else time.time() + ttl
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO geopayment_cache VALUES (?, ?, ?)',
+                (key, value, expires)
+            )
+        if time.monotonic() >= self._purge_at:
+            self.purge()
+
+    def purge(self) -> int:
+        """
+        Delete the expired rows.
+
+        :return: rows deleted
+        """
+        self._purge_at = time.monotonic() + self.purge_interval
+        with self._connection() as connection:
+            return connection.execute(
+                'DELETE FROM geopayment_cache WHERE expires <= ?',
+                (time.time(),)
+            ).rowcount
+
+    def delete(self, key: str) -> None:
+        with self._connection() as connection:
+            connection.execute(
+                'DELETE FROM geopayment_cache WHERE key = ?', (key,)
+            )
+
+
+class RedisCache(object):
+    """
+    Cache in redis, `client` is a redis-py compatible client.
+    """
+
+    def __init__(self, client: Any, ttl: float = 5.0,
+                 prefix: str = 'geopayment:') -> None:
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.client.get(f'{self.prefix}{key}')
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return value
+
+    def set(self, key: str, value: str, ttl: Optional[float]) -> None:
+        px = None if ttl is None else max(1, int(ttl * 1000))
+        self.client.set(f'{self.prefix}{key}', value, px=px)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(f'{self.prefix}{key}')
+
+
+def register(name: str) -> None:
+    """
+    Called by `_request` for methods decorated with `cache_by`.
+    """
+    _methods.add(name)
+
+
+def fingerprint(klass) -> str:
+    """
+    :param klass: provider instance
+    :return: digest of the credentials of the merchant account
+    """
+    digest = getattr(klass, '_cache_fingerprint', None)
+    if digest is not None:
+        return digest
+    values = list()
+    for attr in CREDENTIALS:
+        try:
+            values.append(getattr(klass, attr, None))
+        except NotImplementedError:
+            values.append(None)
+    digest = hashlib.sha256(
+        json.dumps(values, default=str).encode('utf-8')
+    ).hexdigest()[:16]
+    try:
+        klass._cache_fingerprint = digest
+    except AttributeError:
+        pass
+    return digest
+
+
+def key(klass, name: str, payment_id: Any) -> str:
+    return f'{tenants.name(klass)}:{fingerprint(klass)}:{name}:{payment_id}'
+
+
+def generation(cache_key: str) -> int:
+    """
+    Read before the request is sent, passed to `store`.
+    """
+    return _generations[hash(cache_key) % _GENERATION_SLOTS]
+
+
+def lookup(backend, cache_key: str, provider: str, name: str):
+    """
+    :return: cached HTTP status, headers and response, or `None`
+    """
+    value = backend.get(cache_key)
+    if metrics.enabled:
+        counter = metrics.CACHE_MISSES if value is None else \
+            metrics.CACHE_HITS
+        counter.inc(provider, name)
+    if value is None:
+        return None
+    status, headers, result = json.loads(value)
+    return status, headers, result
+
+
+def store(backend, cache_key: str, status, headers, result,
+          final: Callable[[Dict], bool],
+          sent_generation: Optional[int] = None) -> None:
+    """
+    :param sent_generation: `generation(cache_key)` when the request was
+        sent, the response is dropped if the key was invalidated since
+    """
+    if sent_generation is not None and \
+            generation(cache_key) != sent_generation:
+        return
+    if status != 200 or not isinstance(result, dict) or 'ERROR' in result:
+        return
+    try:
+        value = json.dumps([status, dict(headers), result])
+    except (TypeError, ValueError):
+        return
+    ttl = None if final(result) else getattr(backend, 'ttl', 5.0)
+    backend.set(cache_key, value, ttl)
+
+
+def invalidate(backend, klass, payment_id: Any) -> None:
+    """
+    Drop every cached response of the payment.
+    """
+    if payment_id is None:
+        return
+    for name in _methods:
+        cache_key = key(klass, name, payment_id)
+        _generations[hash(cache_key) % _GENERATION_SLOTS] = next(_counter)
+        backend.delete(cache_key)
@@ -0,0 +1,225 @@
+"""
+Client IP address of an incoming request behind trusted reverse proxies.
+
+`X-Forwarded-For` is walked right to left starting at the peer address,
+hops of trusted proxies are skipped and the first other address is the
+client, addresses a client put in the header itself are never reached.
+When every hop is trusted the leftmost one is returned.
+
+Django requests, Starlette requests and ASGI scopes, Flask requests and
+WSGI environs are understood, plain header mappings too:
+
+>>> resolver = ClientIPResolver(['10.0.0.0/8', '2001:db8::/32'])
+>>> resolver.resolve(request)
+'203.0.113.7'
+>>> resolver.resolve({'X-Forwarded-For': '203.0.113.7'}, '10.0.0.2')
+'203.0.113.7'
+
+Trusted networks are indexed by prefix length, checking an address costs
+one set lookup per distinct prefix length and addresses seen recently are
+cached, the resolver is cheap enough for every checkout request.
+"""
+import socket
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+
+__all__ = ['ClientIPResolver', 'DEFAULT_TRUSTED_PROXIES', 'configure',
+           'resolve']
+
+# loopback and private networks, where reverse proxies usually live
+DEFAULT_TRUSTED_PROXIES = (
+    '127.0.0.0/8',
+    '10.0.0.0/8',
+    '172.16.0.0/12',
+    '192.168.0.0/16',
+    '::1/128',
+    'fc00::/7',
+)
+
+_V4_MAPPED = b'\x00' * 10 + b'\xff' * 2
+_BITS = {4: 32, 6: 128}
+
+
+def _parse(address: str) -> Optional[Tuple[int, int]]:
+    """
+    :return: IP version and integer value of the address, `None` when
+             it is not an address
+    """
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address),
+                                 'big')
+    except (OSError, ValueError):
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, address)
+    except (OSError, ValueError):
+        return None
+    if packed[:12] == _V4_MAPPED:
+        return 4, int.from_bytes(packed[12:], 'big')
+    return 6, int.from_bytes(packed, 'big')
+
+
+def _strip(hop: str) -> str:
+    """
+    :return: address of a header hop without spaces, brackets and port
+    """
+    hop = hop.strip()
+    if hop.startswith('['):
+        return hop[1:hop.find(']')]
+    if hop.count(':') == 1:
+        return hop.split(':', 1)[0]
+    return hop
+
+
+class ClientIPResolver(object):
+
+    def __init__(self, trusted_proxies: Iterable[str] =
+                 DEFAULT_TRUSTED_PROXIES,
+                 header: str = 'X-Forwarded-For',
+                 cache_size: int = 4096) -> None:
+        """
+        :param trusted_proxies: addresses and CIDR networks of the reverse
+                                proxies in front of the application
+        :param header: header listing the forwarded hops
+        :param cache_size: addresses whose classification is cached
+        """
+        # a generator is read once
+        proxies = tuple(trusted_proxies)
+        index: Dict[int, Dict[int, set]] = {4: dict(), 6: dict()}
+        for network in proxies:
+            address, _, prefix = str(network).strip().partition('/')
+            parsed = _parse(address)
+            if parsed is None:
+                raise ValueError(
+                    f'Invalid params, `{network}` is not a proxy network.'
+                )
+            version, value = parsed
+            bits = _BITS[version]
+            if ':' in address and version == 4 and prefix:
+                # IPv4-mapped network, prefix counts the IPv6 bits
+                prefix = str(int(prefix) - 96)
+            if prefix and (not prefix.isdigit() or int(prefix) > bits):
+                raise ValueError(
+                    f'Invalid params, `{network}` is not a proxy network.'
+                )
+            length = int(prefix) if prefix else bits
+            mask = ((1 << length) - 1) << (bits - length)
+            index[version].setdefault(mask, set()).add(value & mask)
+        self.trusted_proxies = proxies
+        self.header = header
+        self._index: Dict[int, List[Tuple[int, FrozenSet[int]]]] = {
+            version: [(mask, frozenset(values))
+                      for mask, values in masks.items()]
+            for version, masks in index.items()
+        }
+        self._environ_key = 'HTTP_' + header.upper().replace('-', '_')
+        self._asgi_key = header.lower().encode('latin-1')
+        self._classify = lru_cache(maxsize=cache_size)(self._classify_hop)
+
+    def is_trusted(self, address: str) -> bool:
+        """
+        :return: whether the address belongs to a trusted proxy
+        """
+        entry = self._classify(address)
+        return entry is not None and entry[1]
+
+    def _classify_hop(self, hop: str) -> Optional[Tuple[str, bool]]:
+        """
+        :return: address of the hop and whether it is trusted, `None` when
+                 the hop is not an address
+        """
+        address = _strip(hop)
+        parsed = _parse(address)
+        if parsed is None:
+            return None
+        version, value = parsed
+        for mask, values in self._index[version]:
+            if value & mask in values:
+                return address, True
+        return address, False
+
+    def _extract(self, source: Any) -> Tuple[Optional[str], Optional[str]]:
+        """
+        :return: forwarded header and peer address of the request
+        """
+        meta = getattr(source, 'META', None)
+        if meta is None:
+            # Starlette request, Flask/Werkzeug request
+            meta = getattr(source, 'scope', None)
+            if meta is None:
+                meta = getattr(source, 'environ', None)
+        if meta is None:
+            meta = source
+        if 'headers' in meta and 'type' in meta:
+            # ASGI scope, repeated headers are joined
+            values = [value.decode('latin-1')
+                      for name, value in meta['headers']
+                      if name.lower() == self._asgi_key]
+            client = meta.get('client')
+            return ', '.join(values) or None, client[0] if client else None
+        if 'REMOTE_ADDR' in meta or self._environ_key in meta:
+            # Django META, WSGI environ
+            return meta.get(self._environ_key), meta.get('REMOTE_ADDR')
+        value = meta.get(self.header)
+        if value is None:
+            lower = self.header.lower()
+            for name, item in meta.items():
+                if name.lower() == lower:
+                    value = item
+                    break
+        return value, None
+
+    def resolve(self, request: Any,
+                remote_addr: Optional[str] = None) -> Optional[str]:
+        """
+        :param request: Django/Starlette/Flask request, ASGI scope, WSGI
+                        environ or a mapping of headers
+        :param remote_addr: peer address, overrides the one of the request,
+                            without any the nearest hop is taken as a
+                            trusted proxy
+        :return: client ip address, `None` when the request has none
+        """
+        forwarded, peer = self._extract(request)
+        if remote_addr is not None:
+            peer = remote_addr
+        client = None
+        if peer:
+            entry = self._classify(peer)
+            if entry is None:
+                return peer
+            client, trusted = entry
+            if not trusted:
+                return client
+        if forwarded:
+            for hop in reversed(forwarded.split(',')):
+                entry = self._classify(hop)
+                if entry is None:
+                    # garbage from the client, keep the last proxy
+                    break
+                client, trusted = entry
+                if not trusted:
+                    break
+        return client
+
+    __call__ = resolve
+
+
+_resolver = ClientIPResolver()
+
+
+def configure(trusted_proxies: Iterable[str] = DEFAULT_TRUSTED_PROXIES,
+              header: str = 'X-Forwarded-For') -> None:
+    """
+    Replace the resolver of `resolve` and `utils.get_client_ip`.
+    """
+    global _resolver
+    _resolver = ClientIPResolver(trusted_proxies, header=header)
+
+
+def resolve(request: Any, remote_addr: Optional[str] = None
+            ) -> Optional[str]:
+    """
+    :return: client ip address of the request, see `ClientIPResolver`
+    """
+    return _resolver.resolve(request, remote_addr)
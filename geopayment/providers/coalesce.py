@@ -0,0 +1,181 @@
+"""
+Single-flight coalescing of identical concurrent read-only bank calls.
+
+Methods decorated with `_request(..., coalesce=True)` (status and detail
+lookups) share one in-flight request between concurrent calls with the
+same provider, endpoint and request params, every caller gets its own
+copy of the response. Calls which joined another one are counted in
+`geopayment_coalesced_total{provider, method}`. The client address
+(`client_ip_addr` of TBC ECOMM) is left out of the key, a status does
+not depend on who asks for it.
+
+A joined call waits at most the request timeouts of its own call, cut to
+the remaining time of its deadline, then it sends its own request, which
+fails fast once the deadline is spent.
+
+Threads coalesce inside `_request`, asyncio code can coalesce in the
+event loop before a thread is taken:
+
+>>> status = await coalesce.call(provider.checkout_status, order_id='X')
+"""
+import copy
+import json
+import threading
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from geopayment.providers import forksafe, metrics, tenants
+
+
+__all__ = ['call', 'do', 'key', 'in_flight', 'patience']
+
+# params of the caller, not of the request, left out of the key
+PER_CALLER = frozenset({'client_ip_addr'})
+
+
+class _Flight(object):
+    __slots__ = ('done', 'value', 'error', 'joined')
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.joined = 0
+
+
+_lock = threading.Lock()
+_flights: Dict[Hashable, _Flight] = dict()
+# asyncio futures per event loop
+_async_flights: Dict[Hashable, Any] = dict()
+
+
+@forksafe.at_fork
+def _after_fork() -> None:
+    global _lock, _flights, _async_flights
+    # the leaders of the parent's flights do not exist in the child
+    _lock, _flights, _async_flights = threading.Lock(), dict(), dict()
+
+
+def key(klass, name: str, request_params: Dict[str, Any]) -> Tuple:
+    """
+    :param klass: provider instance
+    :param name: provider method name
+    :param request_params: transport request params
+    :return: key of identical requests, credentials included
+    """
+    params = {k: v for k, v in request_params.items() if k != 'timeout'}
+    for field in ('data', 'params', 'json'):
+        value = params.get(field)
+        if isinstance(value, dict) and not PER_CALLER.isdisjoint(value):
+            params[field] = {
+                k: v for k, v in value.items() if k not in PER_CALLER
+            }
+    return (
+        tenants.name(klass), name,
+        json.dumps(params, sort_keys=True, default=str)
+    )
+
+
+def patience(timeout: Any, call_deadline: Any = None) -> Optional[float]:
+    """
+    :param timeout: transport timeout of the call, seconds or
+                    `(connect, read)`
+    :param call_deadline: `Deadline` of the call
+    :return: longest wait for an identical call in flight, `None` waits
+             until it is done
+    """
+    if isinstance(timeout, (tuple, list)):
+        timeout = None if None in timeout else sum(timeout)
+    if call_deadline is not None:
+        left = max(0.0, call_deadline.remaining())
+        timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+
+def _absorbed(flight_key: Tuple) -> None:
+    if metrics.enabled:
+        metrics.COALESCED.inc(str(flight_key[0]), str(flight_key[1]))
+
+
+def do(flight_key: Hashable, func: Callable, *args: Any,
+       timeout: Optional[float] = None) -> Any:
+    """
+    Call `func(*args)`, or wait for the identical call in flight.
+
+    :param timeout: longest wait for the call in flight, `func` is called
+                    once it passes
+    :return: result of the call, a copy for callers which joined it
+    """
+    with _lock:
+        flight = _flights.get(flight_key)
+        leader = flight is None
+        if leader:
+            flight = _flights[flight_key] = _Flight()
+        else:
+            flight.joined += 1
+    if not leader:
+        _absorbed(flight_key)
+        if not flight.done.wait(timeout):
+            return func(*args)
+        if flight.error is not None:
+            raise flight.error
+        return copy.deepcopy(flight.value)
+
+    value = None
+    try:
+        value = func(*args)
+        return value
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            del _flights[flight_key]
+        if flight.joined:
+            # the leader may change its result once it returns
+            flight.value = copy.deepcopy(value)
+        flight.done.set()
+
+
+def in_flight() -> int:
+    """
+    :return: requests currently shared by concurrent calls
+    """
+    return len(_flights) + len(_async_flights)
+
+
+async def call(method: Callable, **kwargs: Any) -> Any:
+    """
+    Call a read-only provider method in the default executor, concurrent
+    identical calls on the same provider wait for the first one.
+
+    :param method: bound provider method, e.g. `provider.checkout_status`
+    :return: result of the method, a copy for calls which joined it
+    """
+    import asyncio
+    import contextvars
+
+    if not getattr(method, 'coalesce', False):
+        raise ValueError(
+            f'Invalid params, `{method.__name__}` is not a read-only method.'
+        )
+    loop = asyncio.get_running_loop()
+    provider = method.__self__
+    flight_key = (
+        tenants.name(provider), method.__name__, id(provider), id(loop),
+        json.dumps(kwargs, sort_keys=True, default=str)
+    )
+    future = _async_flights.get(flight_key)
+    if future is not None:
+        _absorbed(flight_key)
+    else:
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(
+            None, partial(context.run, method, **kwargs)
+        )
+        _async_flights[flight_key] = future
+        future.add_done_callback(
+            lambda _: _async_flights.pop(flight_key, None)
+        )
+    # every caller, the first one too, gets its own copy
+    return copy.deepcopy(await asyncio.shield(future))
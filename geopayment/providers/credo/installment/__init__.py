@@ -1,13 +1,48 @@
 import json
 import hashlib
+from collections import deque
+from functools import partial
+from itertools import islice
 from time import time
-from typing import Dict, Union
+from typing import Dict, Union, Iterable, Iterator, List, Optional
 
+from geopayment.constants import CREDO_ROUNDING
 from geopayment.providers.utils import gel_to_tetri
 from geopayment.providers.credo.installment.form import InstallmentForm
 
 
-__all__ = ('Installment',)
+__all__ = ('Installment', 'sign_products')
+
+
+def sign_products(products: Iterable[Dict], password: str,
+                  to_tetri: bool = True) -> str:
+    """
+    Side-effect free variant of `Installment.check`, products are never
+    modified, prices are converted to tetri only for the check itself.
+
+    :param products: iterable of product dicts (id, title, amount, price, type)
+    :param password: merchant password
+    :param to_tetri: convert product price from GEL to tetri
+    :return: md5 check
+    """
+
+    md5 = hashlib.md5()
+    update = md5.update
+    for p in products:
+        price = (
+            gel_to_tetri(p['price'], rounding=CREDO_ROUNDING)
+            if to_tetri is True else p['price']
+        )
+        update(
+            f"{p['id']}{p['title']}{p['amount']}{price}{p['type']}".encode()
+        )
+    update(f'{password}'.encode())
+    return md5.hexdigest()
+
+
+def _sign_batch(batch: List[List[Dict]], password: str,
+                to_tetri: bool) -> List[str]:
+    return [sign_products(products, password, to_tetri) for products in batch]
 
 
 class Installment(object):
@@ -39,8 +74,16 @@ class Installment(object):
         }
         """
 
+        to_tetri = kwargs.pop('to_tetri', True)
+        if to_tetri is True and 'products' in kwargs:
+            kwargs['products'] = [
+                dict(p, price=gel_to_tetri(
+                    p['price'], rounding=CREDO_ROUNDING
+                ))
+                for p in kwargs['products']
+            ]
         kwargs['merchantId'] = self.merchant_id
-        kwargs['check'] = self.check(**kwargs)
+        kwargs['check'] = self.check(to_tetri=False, **kwargs)
         if 'orderCode' not in kwargs:
             kwargs['orderCode'] = int(time())
         kwargs['installmentLength'] = 1
@@ -55,7 +98,7 @@ class Installment(object):
     def check(self, **params):
         """
         product information transformed to md5, in case of several products
-        it should be collected together
+        it should be collected together, products are not modified
 
         :param password: type of string
         :param params: type of dict
@@ -66,15 +109,53 @@ class Installment(object):
         """
 
         to_tetri = params.pop('to_tetri', True)
-        data = params.pop('products_str', list())
+        data = params.pop('products_str', None)
         if not data:
-            for p in params['products']:
-                if to_tetri is True:
-                    p['price'] = gel_to_tetri(p['price'])
-                data.append(
-                    f"{p['id']}{p['title']}{p['amount']}{p['price']}{p['type']}"
-                )
-            data = ''.join(data)
+            return sign_products(params['products'], self.password, to_tetri)
 
         data = f'{data}{self.password}'
         return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+    def sign_many(self, orders: Iterable[List[Dict]], to_tetri: bool = True,
+                  processes: Optional[int] = None,
+                  chunksize: int = 512) -> Iterator[str]:
+        """
+        Lazily compute checks for many product lists, results are yielded
+        in the same order as `orders`.
+
+        :param orders: iterable of product lists, may be a generator
+        :param to_tetri: convert product prices from GEL to tetri
+        :param processes: fan out over a process pool with this many workers
+        :param chunksize: product lists sent to a worker at once
+        :return: iterator of md5 checks
+
+        >>> provider = MyCredoProvider()
+        >>> list(provider.sign_many([[product], [product, other]]))
+        ['f61136837ebe753b4a1e9b9f9893f805', '...']
+        """
+
+        sign = partial(sign_products, password=self.password,
+                       to_tetri=to_tetri)
+        if not processes or processes < 2:
+            for products in orders:
+                yield sign(products)
+            return
+
+        # keep a bounded window of batches in flight, so `orders` is
+        # consumed lazily instead of being submitted all at once
+        from concurrent.futures import ProcessPoolExecutor
+
+        orders = iter(orders)
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            while True:
+                while len(pending) < processes * 2:
+                    batch = list(islice(orders, chunksize))
+                    if not batch:
+                        break
+                    pending.append(executor.submit(
+                        _sign_batch, batch, self.password, to_tetri
+                    ))
+                if not pending:
+                    return
+                yield from pending.popleft().result()
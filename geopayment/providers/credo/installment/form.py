@@ -1,8 +1,48 @@
+import json
+from functools import lru_cache
+from html import escape
+from typing import Any, Iterable, Iterator, Tuple
+
+from geopayment.providers.utils import JsonEncoder
+
+
 __all__ = ('InstallmentForm',)
 
 
+@lru_cache(maxsize=2048)
+def escape_value(value: str) -> str:
+    """
+    html attribute escaped payload, cached by payload hash so repeated
+    renders of the same installment data are not escaped again
+    """
+    return escape(value, quote=True)
+
+
+@lru_cache(maxsize=64)
+def compile_template(fields: Tuple[str, ...]) -> Tuple[str, str]:
+    """
+    form fields and hidden input, compiled once per tuple of fields
+
+    :return: html before and after the escaped payload
+    """
+    return (
+        f'{"".join(fields)}<input type="hidden" name="credoinstallment" '
+        f'value="',
+        '">'
+    )
+
+
+def serialize_value(value: Any) -> str:
+    if value is None:
+        return str()
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False, cls=JsonEncoder)
+
+
 class InstallmentForm(object):
     form_fields = None
+    form_method = 'post'
 
     def __init__(self, data=None):
         self.value = data
@@ -13,13 +53,67 @@ class InstallmentForm(object):
     def __str__(self) -> str:
         return self.render()
 
+    @property
+    def value(self) -> Any:
+        return self._value
+
+    @value.setter
+    def value(self, data: Any) -> None:
+        self._value = data
+        self._escaped = None
+
+    @property
+    def escaped(self) -> str:
+        """
+        serialized and escaped payload, computed once per form, `render`,
+        `render_form` and `input` reuse it
+        """
+        if self._escaped is None:
+            self._escaped = escape_value(serialize_value(self._value))
+        return self._escaped
+
+    def template(self) -> Tuple[str, str]:
+        """
+        the `form_fields` of the form, of the instance or of its class,
+        and hidden input, compiled once per fields
+
+        :return: html before and after the escaped payload
+        """
+        return compile_template(tuple(self.form_fields or ()))
+
     def render(self) -> str:
-        form = list()
-        for field in self.form_fields or list():
-            form.append(field)
+        head, tail = self.template()
+        return f'{head}{self.escaped}{tail}'
+
+    def render_form(self) -> str:
+        """
+        :return: rendered fields wrapped into form tag
+        """
+        return f'{self.form_tag}{self.render()}</form>'
+
+    @classmethod
+    def stream(cls, payloads: Iterable[Any]) -> Iterator[str]:
+        """
+        Render one form per payload lazily, suitable for streaming
+        responses with many products.
 
-        form.append(self.input)
-        return ''.join(form)
+        >>> response = StreamingHttpResponse(InstallmentForm.stream(payloads))
+        """
+        form = cls()
+        head, tail = form.template()
+        form_tag = form.form_tag
+        for payload in payloads:
+            yield (
+                f'{form_tag}{head}'
+                f'{escape_value(serialize_value(payload))}{tail}</form>'
+            )
+
+    @property
+    def form_tag(self) -> str:
+        return (
+            f'<form action="{escape(self.action, quote=True)}" '
+            f'method="{self.form_method}">'
+        )
 
     @property
     def action(self):
@@ -30,4 +124,7 @@ class InstallmentForm(object):
 
     @property
     def input(self):
-        return f'<input type="hidden" name="credoinstallment" value="{self.value}">'
+        return (
+            f'<input type="hidden" name="credoinstallment" '
+            f'value="{self.escaped}">'
+        )
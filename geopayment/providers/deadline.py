@@ -0,0 +1,117 @@
+"""
+Time budget of a multi-step payment flow, e.g. `auth` -> `create` of a
+TBC installment or `get_auth` -> `checkout` of BOG iPay.
+
+Every request of a provider call made within the budget gets its
+connect and read timeouts shrunk to the remaining time, once the budget
+is spent calls fail fast without a network request, they get
+`{'ERROR': 'Deadline exceeded, ...'}` like on a network error. Rate limit
+waits are shortened too.
+
+>>> with budget(8):
+...     provider.get_auth()
+...     provider.checkout(...)
+
+A single call takes a budget in seconds or a `Deadline` with the
+`deadline` param, the earlier of it and the running budget applies:
+
+>>> provider.checkout_status(order_id=order_id, deadline=2.5)
+"""
+import time
+from contextvars import ContextVar
+from typing import Any, Optional, Union
+
+
+__all__ = ['Deadline', 'DeadlineExceeded', 'budget', 'current', 'remaining']
+
+
+_current: ContextVar = ContextVar('geopayment_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    """
+    Point in time, on the monotonic clock, a flow must be done by.
+    """
+    __slots__ = ('expires',)
+
+    def __init__(self, seconds: float) -> None:
+        """
+        :param seconds: budget from now
+        """
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """
+        :return: seconds left, negative once spent
+        """
+        return self.expires - time.monotonic()
+
+    def __repr__(self) -> str:
+        return f'Deadline(remaining={self.remaining():.3f})'
+
+
+class budget(object):
+    """
+    Context manager running the calls inside it within `seconds`, nested
+    budgets never extend the outer one.
+    """
+
+    def __init__(self, seconds: Union[float, Deadline]) -> None:
+        self.deadline = seconds if isinstance(seconds, Deadline) else \
+            Deadline(seconds)
+        self._token = None
+
+    def __enter__(self) -> Deadline:
+        deadline = current(self.deadline)
+        self._token = _current.set(deadline)
+        return deadline
+
+    def __exit__(self, *exc_info) -> None:
+        _current.reset(self._token)
+
+    async def __aenter__(self) -> Deadline:
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.__exit__(*exc_info)
+
+
+def current(deadline: Union[None, float, Deadline] = None
+            ) -> Optional[Deadline]:
+    """
+    :param deadline: `deadline` param of a call
+    :return: earlier of the call deadline and the running budget
+    """
+    running = _current.get()
+    if deadline is None:
+        return running
+    if not isinstance(deadline, Deadline):
+        deadline = Deadline(float(deadline))
+    if running is not None and running.expires < deadline.expires:
+        return running
+    return deadline
+
+
+def remaining(deadline: Optional[Deadline] = None) -> Optional[float]:
+    """
+    :return: seconds left of the deadline or the running budget, `None`
+             without any
+    """
+    deadline = deadline or _current.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def shrink(timeout: Any, seconds: float) -> Any:
+    """
+    :param timeout: `requests` timeout, seconds or `(connect, read)`
+    :param seconds: time left
+    :return: timeout not longer than `seconds`
+    """
+    if isinstance(timeout, tuple):
+        return tuple(seconds if t is None else min(t, seconds)
+                     for t in timeout)
+    return seconds if timeout is None else min(timeout, seconds)
@@ -0,0 +1,277 @@
+"""
+Fault injection transport for chaos and resilience tests.
+
+`FaultTransport` wraps the transport of a provider and injects faults
+into the requests matching a rule, by probability or by a schedule of
+the matching calls:
+
+    connect_timeout  waits `delay` (the connect timeout by default) and
+                     raises `ConnectTimeout`
+    stall            waits `delay` before the response, raises
+                     `ReadTimeout` at the read timeout
+    reset            raises `ConnectionError`, connection reset by peer
+    status           answers `status` (503 by default) with `body` and
+                     `headers`, e.g. `{'Retry-After': '1'}` with 429
+    malformed        answers a malformed ECOMM body, for `parse_response`
+    truncate         forwards the request, cuts the body at `fraction`
+
+>>> transport = FaultTransport(PooledTransport(), [
+...     Fault('status', endpoint='checkout/orders$', probability=0.1),
+...     Fault('stall', command='c', delay=2.0, every=5),
+...     Fault('reset', after=100, times=3),
+... ], seed=42)
+>>> class ChaosIPayProvider(MyIPayProvider):
+...     transport = transport
+>>> transport.injected
+Counter({'status': 12, 'stall': 8, 'reset': 3})
+
+`endpoint` is a regular expression searched in the url path, `command`
+matches the TBC ECOMM command (`v` `get_trans_id`, `c` status, `r`
+refund, ...). Every rule counts the calls it matches, the first rule
+which fires wins. Rules draw from their own random generator seeded
+with `seed`, the same calls in the same order get the same faults.
+Rules are also read from JSON:
+
+>>> FaultTransport.from_config({'seed': 42, 'faults': [
+...     {'kind': 'status', 'status': 429, 'probability': 0.2}]})
+"""
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+from geopayment.providers import forksafe
+from geopayment.providers.transport import (
+    Transport,
+    get_transport,
+    make_response,
+)
+
+
+__all__ = ['FAULT_KINDS', 'MALFORMED_BODIES', 'Fault', 'FaultTransport']
+
+FAULT_KINDS = ('connect_timeout', 'stall', 'reset', 'status', 'malformed',
+               'truncate')
+
+# bodies a broken bank or proxy answered with
+MALFORMED_BODIES = (
+    'RESULT OK',
+    'TRANSACTION_ID',
+    'RESULT: OK\nRESULT_CODE',
+    'RESULT: OK: 000',
+    '<html><body><h1>502 Bad Gateway</h1></body></html>',
+    '\x00\x1f\x8b\x08',
+)
+
+
+class Fault(object):
+
+    def __init__(self, kind: str, endpoint: Optional[str] = None,
+                 command: Optional[str] = None,
+                 http_method: Optional[str] = None,
+                 probability: Optional[float] = None,
+                 every: Optional[int] = None, after: int = 0,
+                 times: Optional[int] = None,
+                 calls: Optional[Sequence[int]] = None,
+                 **params: Any) -> None:
+        """
+        :param kind: one of `FAULT_KINDS`
+        :param endpoint: regular expression searched in the url path
+        :param command: TBC ECOMM command
+        :param http_method: `get`, `post`, ...
+        :param probability: chance of injecting into a matching call
+        :param every: inject into every n-th matching call
+        :param after: matching calls passed before injecting
+        :param times: most injections
+        :param calls: numbers of the matching calls to inject into, from 1
+        :param params: `delay`, `status`, `body`, `headers`, `fraction`
+        """
+        if kind not in FAULT_KINDS:
+            raise ValueError(f'Invalid params, unknown fault `{kind}`.')
+        if probability is not None and not 0 <= probability <= 1:
+            raise ValueError(
+                'Invalid params, `probability` must be in [0, 1].'
+            )
+        self.kind = kind
+        self.endpoint = re.compile(endpoint) if endpoint else None
+        self.command = command
+        self.http_method = http_method.lower() if http_method else None
+        self.probability = probability
+        self.every = every
+        self.after = after
+        self.times = times
+        self.calls = frozenset(calls) if calls is not None else None
+        self.params = params
+        self.matched = 0
+        self.injected = 0
+        self.random = random.Random()
+
+    def matches(self, params: Dict[str, Any]) -> bool:
+        if self.http_method and \
+                str(params.get('method', '')).lower() != self.http_method:
+            return False
+        if self.command is not None:
+            data = params.get('data')
+            if not isinstance(data, dict) or \
+                    data.get('command') != self.command:
+                return False
+        if self.endpoint is not None:
+            url = str(params.get('url', ''))
+            path = url.split('//', 1)[-1].partition('/')[2].split('?')[0]
+            if not self.endpoint.search(f'/{path}'):
+                return False
+        return True
+
+    def fires(self) -> bool:
+        """
+        Count a matching call, called with the transport lock held.
+        """
+        self.matched += 1
+        n = self.matched
+        if n <= self.after:
+            return False
+        if self.times is not None and self.injected >= self.times:
+            return False
+        if self.calls is not None and n not in self.calls:
+            return False
+        if self.every is not None and (n - self.after) % self.every:
+            return False
+        if self.probability is not None and \
+                self.random.random() >= self.probability:
+            return False
+        return True
+
+    def __repr__(self) -> str:
+        return f'Fault({self.kind!r}, matched={self.matched}, ' \
+               f'injected={self.injected})'
+
+
+def _timeouts(timeout: Any):
+    if isinstance(timeout, (tuple, list)):
+        return timeout[0], timeout[1]
+    return timeout, timeout
+
+
+class FaultTransport(Transport):
+
+    def __init__(self, transport: Optional[Transport] = None,
+                 faults: Iterable[Fault] = (), seed: Any = 0) -> None:
+        """
+        :param transport: transport of the requests passed through, the
+                          default transport when `None`
+        :param faults: rules, the first one firing is injected
+        :param seed: seed of the random generators of the rules
+        """
+        self.transport = transport
+        self.faults: List[Fault] = list(faults)
+        self.seed = seed
+        self.calls = 0
+        self.injected: Counter = Counter()
+        self._lock = threading.Lock()
+        self.reseed(seed)
+        forksafe.register(self)
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any],
+                    transport: Optional[Transport] = None
+                    ) -> 'FaultTransport':
+        """
+        :param config: `seed` and `faults`, a list of `Fault` params
+        """
+        return cls(
+            transport, [Fault(**fault) for fault in config.get('faults', ())],
+            seed=config.get('seed', 0)
+        )
+
+    def reseed(self, seed: Any = None) -> None:
+        """
+        Start the rules over, the same calls get the same faults again.
+        """
+        with self._lock:
+            if seed is not None:
+                self.seed = seed
+            for i, fault in enumerate(self.faults):
+                fault.random.seed(f'{self.seed}:{i}')
+                fault.matched = fault.injected = 0
+            self.calls = 0
+            self.injected.clear()
+
+    def _inner(self) -> Transport:
+        return self.transport or get_transport(None)
+
+    def request(self, **params: Any):
+        with self._lock:
+            self.calls += 1
+            fault = None
+            # every rule counts its matching calls, its schedule does not
+            # depend on the rules before it
+            for rule in self.faults:
+                if rule.matches(params) and rule.fires() and fault is None:
+                    fault = rule
+            if fault is None:
+                body = None
+            else:
+                fault.injected += 1
+                self.injected[fault.kind] += 1
+                body = fault.random.choice(MALFORMED_BODIES) \
+                    if fault.kind == 'malformed' else None
+        if fault is None:
+            return self._inner().request(**params)
+        return getattr(self, f'_{fault.kind}')(fault, params, body)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def _connect_timeout(self, fault: Fault, params: Dict[str, Any],
+                         body: str):
+        from requests.exceptions import ConnectTimeout
+
+        connect, _ = _timeouts(params.get('timeout'))
+        delay = fault.params.get('delay', connect)
+        if delay:
+            time.sleep(delay)
+        raise ConnectTimeout(f"Injected connect timeout, {params['url']}")
+
+    def _stall(self, fault: Fault, params: Dict[str, Any], body: str):
+        from requests.exceptions import ReadTimeout
+
+        _, read = _timeouts(params.get('timeout'))
+        delay = fault.params.get('delay', 1.0)
+        if read is not None and delay >= read:
+            time.sleep(read)
+            raise ReadTimeout(f"Injected read timeout, {params['url']}")
+        time.sleep(delay)
+        return self._inner().request(**params)
+
+    def _reset(self, fault: Fault, params: Dict[str, Any], body: str):
+        from requests.exceptions import ConnectionError
+
+        raise ConnectionError(ConnectionResetError(
+            104, f"Injected connection reset by peer, {params['url']}"
+        ))
+
+    def _status(self, fault: Fault, params: Dict[str, Any], body: str):
+        return make_response(
+            fault.params.get('status', 503), fault.params.get('body', ''),
+            fault.params.get('headers'), params.get('url')
+        )
+
+    def _malformed(self, fault: Fault, params: Dict[str, Any], body: str):
+        return make_response(
+            fault.params.get('status', 200), fault.params.get('body', body),
+            None, params.get('url')
+        )
+
+    def _truncate(self, fault: Fault, params: Dict[str, Any], body: str):
+        response = self._inner().request(**params)
+        content = response.content
+        headers = {
+            k: v for k, v in response.headers.items()
+            if k.lower() != 'content-length'
+        }
+        cut = int(len(content) * fault.params.get('fraction', 0.5))
+        return make_response(
+            response.status_code, content[:cut], headers, params.get('url')
+        )
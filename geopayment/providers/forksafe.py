@@ -0,0 +1,137 @@
+"""
+Runtime state of the SDK made safe for `fork`, gunicorn `--preload` and
+other pre-forking servers.
+
+Providers, transports, caches and limits may be created, and warmed, in
+the master process. In every forked child, before any other code runs:
+
+- pooled connections are dropped, the child opens its own; the
+  sessions, adapters and their SSL contexts are kept,
+- locks, semaphores and events are created again, a thread of the parent
+  may have held them,
+- in-flight coalesced calls, metrics, quantiles and profiling stats of
+  the parent are forgotten,
+- SQLite connections are opened again, the parent's are never closed,
+- shared memory limits reopen their file, `flock` would not exclude the
+  parent otherwise,
+- OAuth tokens fetched in the parent are kept, unless `inherit_tokens`
+  is off:
+
+>>> forksafe.inherit_tokens = False
+
+Objects with state of their own call `register(self)` and implement
+`_after_fork()`, modules register a function with `at_fork`.
+"""
+import itertools
+import os
+import warnings
+import weakref
+from typing import Any, Callable, List
+
+
+__all__ = [
+    'TOKEN_ATTRIBUTES',
+    'abandon',
+    'alive',
+    'at_fork',
+    'register',
+    'reinit',
+    'track_tokens',
+]
+
+# provider attributes holding an OAuth token, BOG iPay and TBC installments
+TOKEN_ATTRIBUTES = ('access', 'auth')
+
+# keep the tokens of the parent in the children
+inherit_tokens = True
+
+_ids = itertools.count()
+_hooks: List[Callable[[], None]] = list()
+_objects: 'weakref.WeakValueDictionary[int, Any]' = \
+    weakref.WeakValueDictionary()
+_token_holders: 'weakref.WeakValueDictionary[int, Any]' = \
+    weakref.WeakValueDictionary()
+# SQLite connections and other handles of the parent, kept referenced
+# in the child so they are never closed there
+_abandoned: List[Any] = list()
+
+
+def at_fork(func: Callable[[], None]) -> Callable[[], None]:
+    """
+    Run `func` in the child after a fork, usable as a decorator.
+    """
+    _hooks.append(func)
+    return func
+
+
+def register(obj: Any) -> Any:
+    """
+    Call `obj._after_fork()` in the child after a fork, `obj` is not kept
+    alive by the registration.
+    """
+    _objects[next(_ids)] = obj
+    return obj
+
+
+def track_tokens(provider: Any) -> None:
+    """
+    Drop the token attributes of `provider` in the children, unless
+    `inherit_tokens`. Called when a provider fetches a token.
+    """
+    try:
+        _token_holders[id(provider)] = provider
+    except TypeError:
+        # not weak referenceable, e.g. `__slots__` without `__weakref__`
+        pass
+
+
+def abandon(handle: Any) -> None:
+    """
+    Keep a handle of the parent referenced in the child, never closed.
+    """
+    _abandoned.append(handle)
+
+
+def alive(pid: int) -> bool:
+    """
+    :return: whether a process of the host has the pid, e.g. a worker
+             whose files or slots are shared
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # a process of another user
+        return True
+    return True
+
+
+def reinit() -> None:
+    """
+    Reset the state of the SDK in a forked child, called automatically on
+    platforms with `os.register_at_fork`.
+    """
+    for hook in list(_hooks):
+        _run(hook)
+    for obj in list(_objects.values()):
+        _run(obj._after_fork)
+    if not inherit_tokens:
+        for provider in list(_token_holders.values()):
+            for name in TOKEN_ATTRIBUTES:
+                vars(provider).pop(name, None)
+        _token_holders.clear()
+
+
+def _run(hook: Callable[[], None]) -> None:
+    try:
+        hook()
+    except Exception as e:
+        warnings.warn(
+            f'geopayment: after fork hook {hook!r} failed, {e!r}',
+            RuntimeWarning
+        )
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reinit)
@@ -0,0 +1,549 @@
+"""
+Append-only audit journal of bank calls, with the full history of a
+payment looked up by its id.
+
+A provider with a `journal` appends one record per request sent, the
+redacted request and response, to the current segment file of the
+journal directory. Segments rotate at `segment_size` bytes and are never
+rewritten. Every record carries a hash of the previous record and its own
+content, `verify()` detects edited, removed and reordered records; keep
+`head` somewhere else now and then to detect a rewritten tail too.
+
+>>> class MyTBCProvider(TBCProvider):
+...     journal = Journal('/var/lib/shop/geopayment-journal')
+>>> MyTBCProvider.journal.history('NMQfTRLUTne3eywr9YnAU78Qxxw=')
+[{'p': 'MyTBCProvider', 'm': 'get_trans_id', ...},
+ {'p': 'MyTBCProvider', 'm': 'check_trans_status', ...}]
+
+Records are JSON lines:
+
+    c   hash chain, 32 hex digits
+    t   unix time
+    p   provider class name, with the tenant of a snapshot
+    m   provider method name
+    ids payment ids, from the params (`trans_id`, `order_id`, ...) and
+        the response (`TRANSACTION_ID`, `order_id`, `sessionId`, ...)
+    b   location of the previous record of every id, `null` for the first
+    st  HTTP status
+    ms  milliseconds spent on the call
+    rq  request, `method`, `url`, `headers` and `body`
+    rs  response
+
+A memory mapped hash table maps every payment id to its latest record,
+which points back to the previous one, so a lookup costs one probe and
+one read per record of the payment, whatever the size of the journal.
+The table is rebuilt from the segments with `reindex()`, e.g. after a
+crash, it is not synced to disk.
+
+A call which could not be recorded, e.g. on a full disk, raises
+`JournalError` once the bank answered, its `result` is the parsed
+response. A journal made with `strict=False` logs the error to the
+`geopayment.providers` logger instead and the call returns as usual,
+the record is lost.
+
+Records are written with a single `write`, the segment is synced at most
+every `fsync_interval` seconds, a background thread syncs the tail.
+Processes of a host share a journal directory, appends are serialized
+with `flock`.
+"""
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from geopayment.providers import forksafe, log
+
+
+__all__ = [
+    'Journal',
+    'JournalError',
+    'REQUEST_IDS',
+    'RESPONSE_IDS',
+    'payment_ids',
+    'record',
+]
+
+# params and response fields identifying a payment
+REQUEST_IDS = ('trans_id', 'order_id', 'session_id', 'shop_order_id',
+               'invoice_id')
+RESPONSE_IDS = ('TRANSACTION_ID', 'REFUND_TRANS_ID', 'order_id',
+                'sessionId', 'session_id')
+
+# magic, current segment, index generation, indexed ids, hash chain head
+_STATE = struct.Struct('<8sIIQ16s')
+_MAGIC = b'GPJRNL01'
+# id hash, segment, padding, offset
+_SLOT = struct.Struct('<QIIQ')
+_EMPTY_CHAIN = bytes(16)
+# `{"c":"` + 32 hex digits + `",`
+_CHAIN_PREFIX = 40
+_SEGMENT = re.compile(r'^segment-(\d{6})\.jsonl$')
+
+Location = Tuple[int, int]
+
+
+def _hash(payment_id: str) -> int:
+    digest = hashlib.blake2b(payment_id.encode(), digest_size=8).digest()
+    # 0 marks an empty slot
+    return int.from_bytes(digest, 'little') or 1
+
+
+def _chain(previous: bytes, body: bytes) -> bytes:
+    return hashlib.blake2b(previous + body, digest_size=16).digest()
+
+
+class JournalError(Exception):
+    """
+    A bank call was not recorded, `result` is the parsed bank response.
+    """
+
+    def __init__(self, message: str, result: Any = None) -> None:
+        super().__init__(message)
+        self.result = result
+
+
+class Journal(object):
+
+    def __init__(self, directory: str, segment_size: int = 64 * 2 ** 20,
+                 fsync_interval: Optional[float] = 1.0,
+                 index_capacity: int = 2 ** 16,
+                 strict: bool = True) -> None:
+        """
+        :param directory: journal directory, created when missing
+        :param segment_size: bytes after which a new segment is started
+        :param fsync_interval: seconds between syncs of the segment, 0
+                               syncs every record, `None` leaves it to the
+                               operating system
+        :param index_capacity: initial slots of the id index, doubled when
+                               70% full
+        :param strict: raise `JournalError` from calls which were not
+                       recorded, otherwise log the error
+        """
+        if index_capacity < 8 or index_capacity & (index_capacity - 1):
+            raise ValueError(
+                'Invalid params, `index_capacity` must be a power of 2.'
+            )
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.index_capacity = index_capacity
+        self.strict = strict
+        os.makedirs(directory, exist_ok=True)
+        self._synced_at = time.monotonic()
+        self._dirty = False
+        self._flusher: Optional[threading.Thread] = None
+        self._open()
+        forksafe.register(self)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _open(self) -> None:
+        import fcntl
+
+        self._fcntl = fcntl
+        self._lock = threading.Lock()
+        self._lock_fd = os.open(
+            self._path('lock'), os.O_RDWR | os.O_CREAT, 0o600
+        )
+        self._segment, self._segment_fd = None, None
+        self._generation, self._index = None, None
+        with self._locked():
+            state_fd = os.open(
+                self._path('state'), os.O_RDWR | os.O_CREAT, 0o600
+            )
+            try:
+                if os.fstat(state_fd).st_size < _STATE.size:
+                    os.ftruncate(state_fd, _STATE.size)
+                self._state = mmap.mmap(state_fd, _STATE.size)
+            finally:
+                os.close(state_fd)
+            if self._state[:8] != _MAGIC:
+                self._new_index(0, self.index_capacity).close()
+                _STATE.pack_into(self._state, 0, _MAGIC, 1, 0, 0,
+                                 _EMPTY_CHAIN)
+            self._sync_files()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            self._fcntl.flock(self._lock_fd, self._fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self._fcntl.flock(self._lock_fd, self._fcntl.LOCK_UN)
+
+    def _read_state(self) -> Tuple[int, int, int, bytes]:
+        return _STATE.unpack_from(self._state)[1:]
+
+    def _write_state(self, segment: int, generation: int, count: int,
+                     chain: bytes) -> None:
+        _STATE.pack_into(self._state, 0, _MAGIC, segment, generation, count,
+                         chain)
+
+    def _new_index(self, generation: int, capacity: int) -> mmap.mmap:
+        fd = os.open(
+            self._path(f'index-{generation}.map'),
+            os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        try:
+            os.ftruncate(fd, capacity * _SLOT.size)
+            return mmap.mmap(fd, capacity * _SLOT.size)
+        finally:
+            os.close(fd)
+
+    def _sync_files(self) -> None:
+        """
+        Follow segment rotations and index growths of other processes,
+        called with the lock held.
+        """
+        segment, generation, _, _ = self._read_state()
+        if segment != self._segment:
+            if self._segment_fd is not None:
+                if self._dirty and self.fsync_interval is not None:
+                    os.fsync(self._segment_fd)
+                os.close(self._segment_fd)
+            self._segment_fd = os.open(
+                self._path(f'segment-{segment:06d}.jsonl'),
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600
+            )
+            self._segment = segment
+        if generation != self._generation:
+            if self._index is not None:
+                self._index.close()
+            fd = os.open(self._path(f'index-{generation}.map'), os.O_RDWR)
+            try:
+                self._index = mmap.mmap(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+            self._generation = generation
+
+    def _find(self, index: mmap.mmap, key: int) -> Tuple[int, bool]:
+        """
+        :return: slot of `key`, or the empty slot it goes to, and whether
+                 the key is in the index
+        """
+        mask = len(index) // _SLOT.size - 1
+        slot = key & mask
+        while True:
+            stored = _SLOT.unpack_from(index, slot * _SLOT.size)[0]
+            if stored == key:
+                return slot, True
+            if stored == 0:
+                return slot, False
+            slot = (slot + 1) & mask
+
+    def _lookup(self, payment_id: str) -> Optional[Location]:
+        slot, found = self._find(self._index, _hash(payment_id))
+        if not found:
+            return None
+        _, segment, _, offset = _SLOT.unpack_from(
+            self._index, slot * _SLOT.size
+        )
+        return segment, offset
+
+    def _put(self, payment_id: str, location: Location) -> None:
+        key = _hash(payment_id)
+        slot, found = self._find(self._index, key)
+        _SLOT.pack_into(self._index, slot * _SLOT.size, key, location[0], 0,
+                        location[1])
+        if found:
+            return
+        segment, generation, count, chain = self._read_state()
+        count += 1
+        self._write_state(segment, generation, count, chain)
+        if count * 10 > len(self._index) // _SLOT.size * 7:
+            self._grow(len(self._index) // _SLOT.size * 2)
+
+    def _grow(self, capacity: int, entries: Iterator = None) -> None:
+        segment, generation, count, chain = self._read_state()
+        index = self._new_index(generation + 1, capacity)
+        if entries is None:
+            entries = (
+                _SLOT.unpack_from(self._index, slot * _SLOT.size)
+                for slot in range(len(self._index) // _SLOT.size)
+            )
+        count = 0
+        for key, entry_segment, _, offset in entries:
+            if not key:
+                continue
+            slot, found = self._find(index, key)
+            _SLOT.pack_into(index, slot * _SLOT.size, key, entry_segment, 0,
+                            offset)
+            count += 0 if found else 1
+        index.flush()
+        self._index.close()
+        old = self._path(f'index-{generation}.map')
+        self._index, self._generation = index, generation + 1
+        self._write_state(segment, generation + 1, count, chain)
+        os.unlink(old)
+
+    def append(self, entry: Dict[str, Any], ids: List[str]) -> Location:
+        """
+        :param entry: redacted record fields, see module docs
+        :param ids: payment ids indexing the record
+        :return: segment and offset of the record
+        """
+        with self._locked():
+            self._sync_files()
+            offset = os.fstat(self._segment_fd).st_size
+            if offset >= self.segment_size:
+                segment, generation, count, chain = self._read_state()
+                self._write_state(segment + 1, generation, count, chain)
+                self._sync_files()
+                offset = 0
+            location = (self._segment, offset)
+            entry = dict(entry, ids=ids, b=[
+                self._lookup(payment_id) for payment_id in ids
+            ])
+            body = json.dumps(
+                entry, separators=(',', ':'), default=str
+            ).encode('utf-8')
+            segment, generation, count, previous = self._read_state()
+            chain = _chain(previous, body)
+            os.write(
+                self._segment_fd,
+                b'{"c":"%s",%s\n' % (chain.hex().encode(), body[1:])
+            )
+            self._write_state(segment, generation, count, chain)
+            for payment_id in ids:
+                self._put(payment_id, location)
+            self._dirty = True
+            self._maybe_sync()
+        return location
+
+    def _maybe_sync(self) -> None:
+        if self.fsync_interval is None:
+            return
+        if time.monotonic() - self._synced_at >= self.fsync_interval:
+            self._sync()
+        elif self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name='geopayment-journal',
+                daemon=True
+            )
+            self._flusher.start()
+
+    def _sync(self) -> None:
+        os.fsync(self._segment_fd)
+        self._synced_at = time.monotonic()
+        self._dirty = False
+
+    def _flush_loop(self) -> None:
+        while self._segment_fd is not None:
+            time.sleep(self.fsync_interval)
+            with self._lock:
+                if self._dirty and self._segment_fd is not None:
+                    self._sync()
+
+    def sync(self) -> None:
+        """
+        Write the appended records to disk now.
+        """
+        with self._lock:
+            if self._segment_fd is not None:
+                self._sync()
+
+    @property
+    def head(self) -> str:
+        """
+        :return: hash chain of the last record, anchor it outside of the
+                 journal to detect a rewritten journal
+        """
+        with self._locked():
+            return self._read_state()[3].hex()
+
+    def _read(self, location: Location) -> Dict[str, Any]:
+        segment, offset = location
+        fd = os.open(self._path(f'segment-{segment:06d}.jsonl'), os.O_RDONLY)
+        try:
+            chunks = list()
+            while True:
+                chunk = os.pread(fd, 65536, offset)
+                if not chunk:
+                    break
+                end = chunk.find(b'\n')
+                if end >= 0:
+                    chunks.append(chunk[:end])
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+        finally:
+            os.close(fd)
+        return json.loads(b''.join(chunks))
+
+    def history(self, payment_id: str) -> List[Dict[str, Any]]:
+        """
+        :return: records of the payment, oldest first
+        """
+        payment_id = str(payment_id)
+        with self._locked():
+            self._sync_files()
+            location = self._lookup(payment_id)
+        records = list()
+        while location is not None:
+            entry = self._read(tuple(location))
+            if payment_id not in entry['ids']:
+                # a different id with the same 64 bit hash
+                break
+            records.append(entry)
+            location = entry['b'][entry['ids'].index(payment_id)]
+        records.reverse()
+        return records
+
+    def _segments(self) -> List[int]:
+        return sorted(
+            int(match.group(1)) for match in map(
+                _SEGMENT.match, os.listdir(self.directory)
+            ) if match
+        )
+
+    def _scan(self) -> Iterator[Tuple[Location, bytes]]:
+        for segment in self._segments():
+            offset = 0
+            with open(self._path(f'segment-{segment:06d}.jsonl'), 'rb') as f:
+                for line in f:
+                    yield (segment, offset), line
+                    offset += len(line)
+
+    def verify(self) -> Dict[str, Any]:
+        """
+        Check the hash chain of every record.
+
+        :return: `ok`, checked `records` and the `location` and `error` of
+                 the first broken record
+        """
+        previous, records = _EMPTY_CHAIN, 0
+        with self._locked():
+            head = self._read_state()[3]
+            for location, line in self._scan():
+                error = None
+                if not line.endswith(b'\n'):
+                    error = 'incomplete record'
+                else:
+                    body = b'{' + line[_CHAIN_PREFIX:-1]
+                    chain = _chain(previous, body)
+                    if line[6:_CHAIN_PREFIX - 2] != chain.hex().encode():
+                        error = 'hash chain mismatch'
+                if error is not None:
+                    return {'ok': False, 'records': records,
+                            'location': location, 'error': error}
+                previous, records = chain, records + 1
+        if previous != head:
+            return {'ok': False, 'records': records, 'location': None,
+                    'error': 'records missing at the end'}
+        return {'ok': True, 'records': records, 'location': None,
+                'error': None}
+
+    def reindex(self) -> int:
+        """
+        Rebuild the id index from the segments.
+
+        :return: indexed ids
+        """
+        with self._locked():
+            self._sync_files()
+            latest: Dict[int, Location] = dict()
+            for location, line in self._scan():
+                if not line.endswith(b'\n'):
+                    continue
+                for payment_id in json.loads(line)['ids']:
+                    latest[_hash(payment_id)] = location
+            capacity = self.index_capacity
+            while len(latest) * 10 > capacity * 7:
+                capacity *= 2
+            self._grow(capacity, (
+                (key, segment, 0, offset)
+                for key, (segment, offset) in latest.items()
+            ))
+            return len(latest)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._segment_fd is None:
+                return
+            if self._dirty:
+                self._sync()
+            os.close(self._segment_fd)
+            self._segment_fd = None
+            self._index.close()
+            self._state.close()
+            os.close(self._lock_fd)
+
+    def _after_fork(self) -> None:
+        if self._segment_fd is None:
+            return
+        # the lock file description, and so its `flock`, is shared with
+        # the parent after a fork
+        os.close(self._lock_fd)
+        if self._segment_fd is not None:
+            os.close(self._segment_fd)
+        self._index.close()
+        self._state.close()
+        self._flusher = None
+        self._open()
+
+
+def payment_ids(request_params: Dict[str, Any], kwargs: Dict[str, Any],
+                result: Any) -> List[str]:
+    """
+    :return: payment ids of a call, see `REQUEST_IDS` and `RESPONSE_IDS`
+    """
+    ids = list()
+    data = request_params.get('data')
+    for source, names in ((kwargs, REQUEST_IDS), (data, REQUEST_IDS),
+                          (result, RESPONSE_IDS)):
+        if not isinstance(source, dict):
+            continue
+        for name in names:
+            value = source.get(name)
+            if value and isinstance(value, (str, int)) and \
+                    str(value) not in ids:
+                ids.append(str(value))
+    return ids
+
+
+def record(journal: Journal, provider: str, method: str,
+           request_params: Dict[str, Any], kwargs: Dict[str, Any], status,
+           result, elapsed: float) -> None:
+    """
+    Append a provider call to the journal, called by `_request`.
+
+    :raises JournalError: when the call was not recorded, unless the
+                          journal is not `strict`, then it is logged
+    """
+    body = request_params.get('data')
+    if body is None:
+        body = request_params.get('json')
+    try:
+        journal.append({
+            't': round(time.time(), 6),
+            'p': provider,
+            'm': method,
+            'st': status,
+            'ms': round(elapsed * 1000, 3),
+            'rq': {
+                'method': request_params['method'],
+                'url': log.redact_url(str(request_params['url'])),
+                'headers': log.redact(
+                    dict(request_params.get('headers') or dict())
+                ),
+                'body': log.redact(body),
+            },
+            'rs': log.redact(result),
+        }, payment_ids(request_params, kwargs, result))
+    except (OSError, ValueError, TypeError) as e:
+        if getattr(journal, 'strict', True):
+            raise JournalError(
+                f'Journal error, {provider}.{method} was sent but not '
+                f'recorded: {e}', result
+            ) from e
+        log.logger.exception(
+            'geopayment journal: %s.%s was not recorded', provider, method
+        )
@@ -0,0 +1,436 @@
+"""
+Token bucket rate limiter and concurrency bulkhead per provider method,
+applied by `_request` before a request is sent.
+
+A provider lists its limits in the `limits` attribute, keyed by method
+name, `*` applies to methods without their own limit. A `Limit` is shared
+by every instance (and thread) using it:
+
+>>> class MyTBCProvider(TBCProvider):
+...     limits = {
+...         'get_trans_id': Limit(rate=50, burst=20, concurrency=20),
+...         '*': Limit(concurrency=10, timeout=2),
+...     }
+
+A call waits at most `timeout` seconds for a token and a free slot,
+otherwise it is rejected like on a network error: the method gets
+`{'ERROR': 'Rejected, ...', 'SENT': False}` as the result and
+`HTTP_STATUS_CODE='N/A'` in its kwargs. A rejected call gives its token
+back. `Limit(..., shared='tbc-ecomm')` keeps the bucket and the bulkhead
+in shared memory, every process on the host using the same name shares
+them (POSIX only). Slots are recorded
+per process, the slots of a process which died holding them, killed or
+out of memory, are taken back once the bulkhead is full.
+
+asyncio, admit the call in the event loop and run it in a thread which
+inherits the context, `_request` does not wait again:
+
+>>> async with admit(provider, 'get_trans_id'):
+...     await asyncio.to_thread(provider.get_trans_id, amount=1)
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from geopayment.providers import forksafe, metrics
+
+
+__all__ = ['Limit', 'Rejected', 'admit', 'find']
+
+
+_admitted: ContextVar = ContextVar('geopayment_admitted', default=None)
+
+
+class Rejected(Exception):
+    pass
+
+
+class _LocalState(object):
+    """
+    Bucket and bulkhead state of one process.
+    """
+
+    def __init__(self, burst: float) -> None:
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.in_flight = 0
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            yield self
+
+    def close(self) -> None:
+        pass
+
+    def _after_fork(self) -> None:
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+
+class _SharedState(object):
+    """
+    Bucket and bulkhead state in a memory mapped file of `/dev/shm`,
+    guarded by a thread lock and `flock`. The bucket is followed by a
+    table of the processes holding slots and their slot counts.
+    """
+    _layout = struct.Struct('ddq?')
+    _holder = struct.Struct('iI')
+
+    def __init__(self, name: str, burst: float, capacity: int = 0) -> None:
+        """
+        :param capacity: processes holding slots at once, the concurrency
+        """
+        import fcntl
+        import tempfile
+
+        self._fcntl = fcntl
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else \
+            tempfile.gettempdir()
+        self.path = os.path.join(directory, f'geopayment-limit-{name}')
+        self.burst = burst
+        self.capacity = capacity
+        self._open()
+
+    def _open(self) -> None:
+        fcntl = self._fcntl
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self._layout.size + self.capacity * self._holder.size
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.fd).st_size < size:
+                    os.ftruncate(self.fd, size)
+                self.memory = mmap.mmap(self.fd, size)
+                if not self._layout.unpack_from(self.memory)[3]:
+                    self._layout.pack_into(
+                        self.memory, 0, self.burst, time.monotonic(), 0,
+                        True
+                    )
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            self._fcntl.flock(self.fd, self._fcntl.LOCK_EX)
+            try:
+                values = self._layout.unpack_from(self.memory)
+                self.tokens, self.updated, self.in_flight = values[:3]
+                yield self
+                self._layout.pack_into(
+                    self.memory, 0, self.tokens, self.updated,
+                    self.in_flight, True
+                )
+            finally:
+                self._fcntl.flock(self.fd, self._fcntl.LOCK_UN)
+
+    def _holders(self):
+        offset = self._layout.size
+        for _ in range(self.capacity):
+            pid, count = self._holder.unpack_from(self.memory, offset)
+            yield offset, pid, count
+            offset += self._holder.size
+
+    def _reclaim(self) -> None:
+        """
+        Drop the slots of dead processes, `in_flight` is counted again
+        from the table. Called with the state locked.
+        """
+        in_flight = 0
+        for offset, pid, count in self._holders():
+            if not pid:
+                continue
+            if count and forksafe.alive(pid):
+                in_flight += count
+            else:
+                self._holder.pack_into(self.memory, offset, 0, 0)
+        self.in_flight = in_flight
+
+    def take(self, concurrency: int) -> bool:
+        """
+        Take a slot for this process, called with the state locked.
+        """
+        if self.in_flight >= concurrency:
+            self._reclaim()
+            if self.in_flight >= concurrency:
+                return False
+        free = None
+        for offset, pid, count in self._holders():
+            if pid == self.pid:
+                self._holder.pack_into(
+                    self.memory, offset, pid, count + 1
+                )
+                break
+            if free is None and not count:
+                free = offset
+        else:
+            if free is None:
+                return False
+            self._holder.pack_into(self.memory, free, self.pid, 1)
+        self.in_flight += 1
+        return True
+
+    def give(self) -> None:
+        """
+        Give a slot of this process back, called with the state locked.
+        """
+        for offset, pid, count in self._holders():
+            if pid == self.pid:
+                self._holder.pack_into(
+                    self.memory, offset, pid if count > 1 else 0,
+                    max(0, count - 1)
+                )
+                break
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def close(self) -> None:
+        self.memory.close()
+        os.close(self.fd)
+
+    def _after_fork(self) -> None:
+        # `flock` locks belong to the open file, shared with the parent
+        # after a fork, the child needs its own to exclude the parent
+        self.close()
+        self._open()
+
+
+class Limit(object):
+    """
+    Rate limit and concurrency bulkhead of one provider method.
+    """
+
+    def __init__(self, rate: Optional[float] = None,
+                 burst: Optional[float] = None,
+                 concurrency: Optional[int] = None,
+                 timeout: float = 1.0,
+                 shared: Optional[str] = None) -> None:
+        """
+        :param rate: requests per second, `None` does not limit the rate
+        :param burst: bucket size, defaults to one second of `rate`
+        :param concurrency: requests in flight, `None` does not limit them
+        :param timeout: longest wait for a token and a slot, in seconds
+        :param shared: name of the shared memory state, across processes
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError('Invalid params, `rate` must be positive.')
+        if concurrency is not None and concurrency < 1:
+            raise ValueError(
+                'Invalid params, `concurrency` must be at least 1.'
+            )
+        self.rate = rate
+        self.burst = burst or max(1.0, rate or 1.0)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.shared = shared
+        if shared:
+            self._state = _SharedState(
+                shared, self.burst, concurrency or 0
+            )
+        else:
+            self._state = _LocalState(self.burst)
+        self._slots = None
+        if concurrency and not shared:
+            self._slots = threading.BoundedSemaphore(concurrency)
+        forksafe.register(self)
+
+    def _after_fork(self) -> None:
+        self._state._after_fork()
+        if self._slots is not None:
+            # slots taken by the parent's calls are never released here
+            self._slots = threading.BoundedSemaphore(self.concurrency)
+
+    def reserve(self, timeout: float) -> float:
+        """
+        Take a token, waiting in line when the bucket is empty.
+
+        :return: seconds to wait before the request may be sent
+        """
+        if self.rate is None:
+            return 0.0
+        with self._state.locked() as state:
+            now = time.monotonic()
+            tokens = min(
+                self.burst, state.tokens + (now - state.updated) * self.rate
+            )
+            wait = max(0.0, (1 - tokens) / self.rate)
+            if wait > timeout:
+                raise Rejected('rate')
+            state.tokens, state.updated = tokens - 1, now
+        return wait
+
+    def refund(self) -> None:
+        """
+        Give back the token of a call rejected after `reserve`.
+        """
+        if self.rate is None:
+            return
+        with self._state.locked() as state:
+            state.tokens = min(self.burst, state.tokens + 1)
+
+    def try_enter(self) -> bool:
+        """
+        Take a bulkhead slot if one is free.
+        """
+        if self.concurrency is None:
+            return True
+        if self._slots is not None:
+            return self._slots.acquire(blocking=False)
+        with self._state.locked() as state:
+            return state.take(self.concurrency)
+
+    def enter(self, timeout: float) -> None:
+        if self._slots is not None:
+            if not self._slots.acquire(timeout=max(0.0, timeout)):
+                raise Rejected('concurrency')
+            return
+        deadline = time.monotonic() + timeout
+        delay = 0.001
+        while not self.try_enter():
+            if time.monotonic() + delay > deadline:
+                raise Rejected('concurrency')
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def leave(self) -> None:
+        if self.concurrency is None:
+            return
+        if self._slots is not None:
+            self._slots.release()
+            return
+        with self._state.locked() as state:
+            state.give()
+
+    def acquire(self, timeout: Optional[float] = None) -> float:
+        """
+        Wait for a token and a slot, blocking the thread.
+
+        :param timeout: longest wait, `timeout` of the limit by default
+        :return: seconds waited
+        """
+        if timeout is None:
+            timeout = self.timeout
+        started = time.monotonic()
+        wait = self.reserve(timeout)
+        if wait:
+            time.sleep(wait)
+        try:
+            self.enter(timeout - (time.monotonic() - started))
+        except Rejected:
+            self.refund()
+            raise
+        return time.monotonic() - started
+
+    async def acquire_async(self) -> float:
+        """
+        `acquire` for asyncio, waits without blocking the event loop.
+        """
+        import asyncio
+
+        started = time.monotonic()
+        wait = self.reserve(self.timeout)
+        if wait:
+            await asyncio.sleep(wait)
+        deadline = started + self.timeout
+        delay = 0.001
+        while not self.try_enter():
+            if time.monotonic() + delay > deadline:
+                self.refund()
+                raise Rejected('concurrency')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        return time.monotonic() - started
+
+    def __repr__(self) -> str:
+        return (
+            f'Limit(rate={self.rate}, burst={self.burst}, '
+            f'concurrency={self.concurrency}, timeout={self.timeout})'
+        )
+
+
+def find(limits: Dict[str, Limit], method: str) -> Optional[Limit]:
+    """
+    :param limits: provider `limits`
+    :param method: provider method name
+    :return: limit of the method, or the `*` one
+    """
+    limit = limits.get(method)
+    if limit is None:
+        limit = limits.get('*')
+    return limit
+
+
+def _record(provider: str, method: str, waited: float,
+            reason: Optional[str] = None) -> None:
+    if not metrics.enabled:
+        return
+    if reason is None:
+        metrics.LIMIT_WAIT.observe(waited, provider, method)
+    else:
+        metrics.LIMIT_REJECTIONS.inc(provider, method, reason)
+
+
+def enter(limit: Limit, provider: str, method: str,
+          deadline: Any = None) -> bool:
+    """
+    Called by `_request`, waits for the limit unless the call is admitted.
+
+    :param deadline: `Deadline` of the call, shortens the wait
+    :return: whether the bulkhead slot must be released by the caller
+    """
+    if _admitted.get() is limit:
+        return False
+    timeout = None
+    if deadline is not None:
+        timeout = min(limit.timeout, max(0.0, deadline.remaining()))
+    try:
+        waited = limit.acquire(timeout)
+    except Rejected as e:
+        _record(provider, method, 0.0, str(e))
+        raise Rejected(
+            f'Rejected, {provider}.{method} {e} limit exceeded.'
+        ) from None
+    _record(provider, method, waited)
+    return True
+
+
+class admit(object):
+    """
+    Async context manager taking the limit of a provider method in the
+    event loop, see module docs.
+    """
+
+    def __init__(self, provider: Any, method: str) -> None:
+        self.provider = type(provider).__name__
+        self.method = method
+        limits = getattr(provider, 'limits', None)
+        self.limit = find(limits, method) if limits else None
+        self._token = None
+
+    async def __aenter__(self):
+        if self.limit is None:
+            return self
+        try:
+            waited = await self.limit.acquire_async()
+        except Rejected as e:
+            _record(self.provider, self.method, 0.0, str(e))
+            raise Rejected(
+                f'Rejected, {self.provider}.{self.method} {e} limit exceeded.'
+            ) from None
+        _record(self.provider, self.method, waited)
+        self._token = _admitted.set(self.limit)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self.limit is None:
+            return
+        _admitted.reset(self._token)
+        self.limit.leave()
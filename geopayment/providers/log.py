@@ -0,0 +1,193 @@
+"""
+Structured logging of provider calls to the `geopayment.providers` logger.
+
+Every call is logged once its response is parsed: successes at INFO,
+bank errors (HTTP status >= 400, `fault`, `error`, failed result codes)
+at WARNING and transport errors at ERROR. Messages are formatted only
+when a handler emits the record, the fields are on `record.event`:
+
+    provider, method, http_method, url, status, code, elapsed_ms,
+    headers, payload, error
+
+Tokens, secrets, passwords, card data, signatures and certificate paths
+are redacted before anything leaves the process.
+
+>>> import logging
+>>> logging.basicConfig(level=logging.INFO)
+>>> log.configure(sample_rates={logging.INFO: 0.01})
+INFO:geopayment.providers:MyTBCProvider.get_trans_id status=200 code= ...
+"""
+import logging
+import random
+import re
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from geopayment.providers.metrics import result_code
+
+
+__all__ = [
+    'CallEvent',
+    'REDACTED',
+    'configure',
+    'redact',
+    'redact_url',
+    'logger',
+]
+
+REDACTED = '***'
+
+# payload, header and query keys whose values are never logged
+SECRET_KEYS = re.compile(
+    r'authorization|token|secret|passw|signature|hash|cert|key|card|cvv|'
+    r'cvc|expiry|exp_date|^pan$|^check$',
+    re.IGNORECASE
+)
+_CARD_NUMBER = re.compile(r'\b(\d{6})\d{3,9}(\d{4})\b')
+_CREDENTIALS = re.compile(r'\b(Basic|Bearer)\s+\S+', re.IGNORECASE)
+_QUERY_VALUE = re.compile(r'([?&][^=&#]+)=([^&#]*)')
+
+# read by `_request` on every call, keep it a plain module attribute
+enabled = True
+
+logger = logging.getLogger('geopayment.providers')
+logging.getLogger('geopayment').addHandler(logging.NullHandler())
+
+# probability of logging a call at the level, missing levels always log
+sample_rates: Dict[int, float] = dict()
+
+_random = random.random
+
+
+def configure(sample_rates: Optional[Dict[int, float]] = None,
+              enable: bool = True) -> None:
+    """
+    :param sample_rates: level to probability, `{logging.INFO: 0.01}` logs
+                         one of hundred successful calls, errors are logged
+                         unless their level is sampled too
+    :param enable: `False` turns provider call logging off
+    """
+    global enabled
+    globals()['sample_rates'] = dict(sample_rates or dict())
+    enabled = enable
+
+
+@lru_cache(maxsize=1024)
+def _is_secret(key: str) -> bool:
+    return SECRET_KEYS.search(key) is not None
+
+
+def redact(value: Any, key: str = '') -> Any:
+    """
+    :param value: header, payload or query value
+    :param key: name of the value
+    :return: copy of `value` without secrets
+    """
+    if key and _is_secret(key):
+        return REDACTED
+    if isinstance(value, dict):
+        return {k: redact(v, str(k)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        if ' ' in value:
+            value = _CREDENTIALS.sub(rf'\1 {REDACTED}', value)
+        if len(value) >= 13:
+            value = _CARD_NUMBER.sub(r'\1******\2', value)
+    return value
+
+
+def redact_url(url: str) -> str:
+    """
+    :return: `url` without secret query values
+    """
+    if '?' not in url:
+        return url
+    return _QUERY_VALUE.sub(
+        lambda m: f'{m.group(1)}={redact(m.group(2), m.group(1)[1:])}', url
+    )
+
+
+class CallEvent(object):
+    """
+    Log message of one provider call, redacts and formats on first use.
+    """
+    __slots__ = ('_raw', '_fields')
+
+    def __init__(self, **raw: Any) -> None:
+        self._raw = raw
+        self._fields = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        if self._fields is None:
+            raw = self._raw
+            self._fields = {
+                'provider': raw['provider'],
+                'method': raw['method'],
+                'http_method': raw['http_method'],
+                'url': redact_url(str(raw['url'])),
+                'status': raw['status'],
+                'code': raw['code'],
+                'elapsed_ms': round(raw['elapsed'] * 1000, 3),
+                'headers': redact(dict(raw['headers'] or dict())),
+                'payload': redact(raw['payload']),
+                'error': redact(raw['error']),
+            }
+        return self._fields
+
+    def __str__(self) -> str:
+        # headers and payload are redacted only for structured handlers
+        raw = self._raw
+        text = (
+            f"{raw['provider']}.{raw['method']} "
+            f"status={raw['status']} code={raw['code']} "
+            f"elapsed_ms={raw['elapsed'] * 1000:.3f} "
+            f"{raw['http_method'].upper()} {redact_url(str(raw['url']))}"
+        )
+        if raw['error']:
+            text = f"{text} error={redact(raw['error'])!r}"
+        return text
+
+
+def _level(status, code: str, result) -> int:
+    if 'ERROR' in result and status == 'N/A':
+        return logging.ERROR
+    if isinstance(status, int) and status >= 400:
+        return logging.WARNING
+    if 'fault' in result or 'error' in result or 'ERROR' in result:
+        return logging.WARNING
+    if code.isdigit() and code[0] != '0':
+        # TBC ECOMM, 0xx codes are approvals
+        return logging.WARNING
+    return logging.INFO
+
+
+def call(provider: str, method: str, params: Dict[str, Any], status,
+         result, elapsed: float) -> None:
+    """
+    Log one provider call, see module docs.
+
+    :param params: transport request params
+    :param result: parsed response
+    :param elapsed: seconds spent on the request
+    """
+    if not isinstance(result, dict):
+        result = dict()
+    code = result_code(result)
+    level = _level(status, code, result)
+    if not logger.isEnabledFor(level):
+        return
+    rate = sample_rates.get(level)
+    if rate is not None and _random() >= rate:
+        return
+
+    payload = params.get('data')
+    if payload is None:
+        payload = params.get('json')
+    error = result.get('ERROR') or result.get('fault') or result.get('error')
+    event = CallEvent(
+        provider=provider, method=method, http_method=params['method'],
+        url=params['url'], status=status, code=code, elapsed=elapsed,
+        headers=params.get('headers'), payload=payload, error=error,
+    )
+    logger.log(level, event, extra={'event': event})
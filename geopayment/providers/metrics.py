@@ -0,0 +1,571 @@
+"""
+Prometheus metrics of provider calls, fed by `_request` and the param
+decorators once enabled.
+
+    geopayment_calls_total{provider, method, status, code}
+    geopayment_call_duration_seconds{provider, method}      histogram
+    geopayment_calls_in_flight{provider, method}            gauge
+    geopayment_retries_total{provider, method}              outbox, EOD
+    geopayment_token_refreshes_total{provider}
+    geopayment_limit_wait_seconds{provider, method}         histogram
+    geopayment_limit_rejections_total{provider, method, reason}
+    geopayment_coalesced_total{provider, method}
+    geopayment_cache_hits_total{provider, method}
+    geopayment_cache_misses_total{provider, method}
+    geopayment_slow_calls_total{provider, method}
+
+`code` is the bank result code: TBC `RESULT_CODE`, the error code of a
+TBC installment `fault`, the oauth `error`, `transport_error` when the
+request failed, `malformed_response` when the response was not parsed,
+empty otherwise.
+
+Values are kept in per thread shards, a thread only writes its own shard
+and never takes a lock, shards are summed when collected. The shard of a
+finished thread is folded into a total, so thread per request servers
+do not pile up shards.
+
+>>> metrics.enable()
+>>> metrics.exposition()
+'# HELP geopayment_calls_total Provider calls ...'
+
+Gunicorn, every worker writes its values to a shared directory and any
+worker exports the sum of all of them:
+
+    # gunicorn.conf.py
+    from geopayment.providers import metrics
+
+    def post_fork(server, worker):
+        metrics.enable(multiprocess_dir='/tmp/geopayment-metrics')
+
+    def child_exit(server, worker):
+        metrics.mark_process_dead(worker.pid, '/tmp/geopayment-metrics')
+"""
+import atexit
+import json
+import os
+import threading
+import weakref
+from bisect import bisect_left
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from geopayment.providers import forksafe
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'Registry',
+    'REGISTRY',
+    'CONTENT_TYPE',
+    'enable',
+    'disable',
+    'exposition',
+    'flush',
+    'mark_process_dead',
+    'make_wsgi_app',
+    'retried',
+]
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+# read by `_request` on every call, keep it a plain module attribute
+enabled = False
+
+_multiprocess_dir: Optional[str] = None
+_flush_interval = 1.0
+_flushed_at = 0.0
+_flush_lock = threading.Lock()
+
+
+class _Owner(object):
+    """
+    Referenced by the thread local only, collected when its thread ends.
+    """
+    __slots__ = ('__weakref__',)
+
+
+class _Metric(object):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        # reentrant, a finished thread may fold its shard during a collect
+        self._lock = threading.RLock()
+        self._shards: List[Dict] = list()
+        # values of the finished threads
+        self._base: Dict = dict()
+        forksafe.register(self)
+
+    def _after_fork(self) -> None:
+        # the values of the parent are its own, in-flight calls included;
+        # the lock goes first, dropping the local folds the parent shards
+        self._lock = threading.RLock()
+        self._shards = list()
+        self._base = dict()
+        self._local = threading.local()
+
+    def _shard(self) -> Dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = dict()
+            owner = self._local.owner = _Owner()
+            with self._lock:
+                self._shards.append(shard)
+            weakref.finalize(owner, self._fold, shard).atexit = False
+            return shard
+
+    def _fold(self, shard: Dict) -> None:
+        with self._lock:
+            for i, current in enumerate(self._shards):
+                if current is shard:
+                    del self._shards[i]
+                    break
+            else:
+                # a shard of the parent process, or cleared
+                return
+            self._merge(self._base, shard)
+
+    def _add(self, total, value):
+        return total + value
+
+    def _merge(self, values: Dict, shard: Dict) -> None:
+        for key, value in shard.items():
+            total = values.get(key)
+            values[key] = value if total is None else self._add(total, value)
+
+    def _snapshots(self) -> List[Dict]:
+        with self._lock:
+            shards = [self._base] + self._shards
+            # `dict(shard)` is a single C call, safe while the owner writes
+            return [dict(shard) for shard in shards]
+
+    def collect(self) -> Dict[Tuple[str, ...], float]:
+        """
+        :return: value per label values, summed over all threads
+        """
+        values: Dict[Tuple[str, ...], float] = dict()
+        for shard in self._snapshots():
+            self._merge(values, shard)
+        return values
+
+    def clear(self) -> None:
+        with self._lock:
+            self._base.clear()
+            for shard in self._shards:
+                shard.clear()
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) - amount
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Tuple[str, ...] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # bucket counts, +Inf bucket, sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _add(self, total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def _merge(self, values: Dict, shard: Dict) -> None:
+        for key, counts in shard.items():
+            total = values.get(key)
+            # copied, the owner thread keeps adding to its lists
+            values[key] = list(counts) if total is None else \
+                self._add(total, counts)
+
+
+class Registry(object):
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, _Metric] = dict()
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f'Duplicated metric `{metric.name}`.')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def collect(self) -> Dict[str, Dict]:
+        """
+        :return: JSON friendly values of every metric
+        """
+        return {
+            name: {
+                'kind': metric.kind,
+                'values': [
+                    [list(key), value]
+                    for key, value in metric.collect().items()
+                ],
+            }
+            for name, metric in self.metrics.items()
+        }
+
+    def clear(self) -> None:
+        for metric in self.metrics.values():
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+CALLS = REGISTRY.register(Counter(
+    'geopayment_calls_total', 'Provider calls by HTTP status and result code.',
+    ('provider', 'method', 'status', 'code')
+))
+DURATION = REGISTRY.register(Histogram(
+    'geopayment_call_duration_seconds', 'Provider call latency.',
+    ('provider', 'method')
+))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'geopayment_calls_in_flight', 'Provider calls waiting for the bank.',
+    ('provider', 'method')
+))
+RETRIES = REGISTRY.register(Counter(
+    'geopayment_retries_total', 'Retried provider calls.',
+    ('provider', 'method')
+))
+TOKEN_REFRESHES = REGISTRY.register(Counter(
+    'geopayment_token_refreshes_total', 'Access token requests.',
+    ('provider',)
+))
+LIMIT_WAIT = REGISTRY.register(Histogram(
+    'geopayment_limit_wait_seconds',
+    'Time calls waited for the rate limiter and the bulkhead.',
+    ('provider', 'method'),
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+))
+COALESCED = REGISTRY.register(Counter(
+    'geopayment_coalesced_total',
+    'Calls which shared the response of an identical call in flight.',
+    ('provider', 'method')
+))
+CACHE_HITS = REGISTRY.register(Counter(
+    'geopayment_cache_hits_total', 'Lookups answered by the response cache.',
+    ('provider', 'method')
+))
+CACHE_MISSES = REGISTRY.register(Counter(
+    'geopayment_cache_misses_total', 'Lookups sent to the bank.',
+    ('provider', 'method')
+))
+LIMIT_REJECTIONS = REGISTRY.register(Counter(
+    'geopayment_limit_rejections_total',
+    'Calls rejected by the rate limiter (`rate`) or the bulkhead '
+    '(`concurrency`).',
+    ('provider', 'method', 'reason')
+))
+SLOW_CALLS = REGISTRY.register(Counter(
+    'geopayment_slow_calls_total',
+    'Calls slower than the threshold of the slow call watchdog.',
+    ('provider', 'method')
+))
+
+
+def result_code(result) -> str:
+    """
+    :param result: parsed bank response
+    :return: bank result code, see module docs
+    """
+    if not isinstance(result, dict):
+        return ''
+    if 'RESULT_CODE' in result:
+        return str(result['RESULT_CODE'])
+    if 'fault' in result:
+        fault = result['fault']
+        try:
+            return str(fault['detail']['errorcode'])
+        except (TypeError, KeyError):
+            return 'fault'
+    if 'error' in result:
+        error = result['error']
+        return error if isinstance(error, str) else 'error'
+    if 'ERROR' in result:
+        if isinstance(result.get('HTTP_STATUS_CODE'), int):
+            return 'malformed_response'
+        return 'transport_error'
+    return ''
+
+
+def start(provider: str, method: str) -> Tuple[str, str, float]:
+    IN_FLIGHT.inc(provider, method)
+    return provider, method, perf_counter()
+
+
+def finish(call: Tuple[str, str, float], status, result) -> None:
+    provider, method, started = call
+    IN_FLIGHT.dec(provider, method)
+    DURATION.observe(perf_counter() - started, provider, method)
+    CALLS.inc(provider, method, str(status), result_code(result))
+    if _multiprocess_dir is not None and \
+            perf_counter() - _flushed_at >= _flush_interval:
+        _maybe_flush()
+
+
+def token_refreshed(provider: str) -> None:
+    TOKEN_REFRESHES.inc(provider)
+
+
+def retried(provider: str, method: str) -> None:
+    """
+    Count a retry, called by the outbox replays of operations already
+    tried by a replay and the end of day retries, and by callers
+    retrying provider calls themselves.
+    """
+    RETRIES.inc(provider, method)
+
+
+def enable(multiprocess_dir: Optional[str] = None,
+           flush_interval: float = 1.0) -> None:
+    """
+    :param multiprocess_dir: directory shared by all worker processes,
+                             defaults to `GEOPAYMENT_METRICS_DIR`
+    :param flush_interval: seconds between writes of this process values
+    """
+    global enabled, _multiprocess_dir, _flush_interval
+    multiprocess_dir = (
+        multiprocess_dir or os.environ.get('GEOPAYMENT_METRICS_DIR')
+    )
+    if multiprocess_dir:
+        os.makedirs(multiprocess_dir, exist_ok=True)
+        if _multiprocess_dir is None:
+            atexit.register(flush)
+    _multiprocess_dir = multiprocess_dir or None
+    _flush_interval = flush_interval
+    enabled = True
+
+
+def disable() -> None:
+    global enabled, _multiprocess_dir
+    flush()
+    enabled, _multiprocess_dir = False, None
+
+
+def _process_file(directory: str, pid: int) -> str:
+    return os.path.join(directory, f'geopayment_{pid}.json')
+
+
+def _write(path: str, values: Dict) -> None:
+    import tempfile
+
+    directory, name = os.path.split(path)
+    # a temporary file of its own per writer, never named `*.json`
+    fd, tmp = tempfile.mkstemp(
+        prefix=f'.{name}.', suffix='.tmp', dir=directory
+    )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(values, f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _read(path: str) -> Dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _maybe_flush() -> None:
+    """
+    Flush from the request path, skipped while another thread flushes,
+    errors are logged and never reach the call.
+    """
+    if not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        if perf_counter() - _flushed_at >= _flush_interval:
+            _flush()
+    except Exception:
+        # imported here, providers which never flush never load logging
+        import logging
+
+        logging.getLogger('geopayment.providers').exception(
+            'geopayment: metrics flush failed'
+        )
+    finally:
+        _flush_lock.release()
+
+
+def _flush() -> None:
+    global _flushed_at
+    directory = _multiprocess_dir
+    if directory is None:
+        return
+    _flushed_at = perf_counter()
+    _write(_process_file(directory, os.getpid()), REGISTRY.collect())
+
+
+def flush() -> None:
+    """
+    Write values of this process to the multiprocess directory.
+    """
+    with _flush_lock:
+        _flush()
+
+
+@forksafe.at_fork
+def _after_fork() -> None:
+    global _flushed_at, _flush_lock
+    # the child has its own file, written on its first call
+    _flushed_at = 0.0
+    _flush_lock = threading.Lock()
+
+
+def _merge(total: Dict, values: Dict, gauges: bool = True) -> None:
+    for name, metric in values.items():
+        if metric['kind'] == 'gauge' and not gauges:
+            continue
+        entry = total.setdefault(
+            name, {'kind': metric['kind'], 'values': dict()}
+        )
+        for key, value in metric['values']:
+            key = tuple(key)
+            current = entry['values'].get(key)
+            if current is None:
+                entry['values'][key] = value
+            elif isinstance(value, list):
+                entry['values'][key] = [a + b for a, b in zip(current, value)]
+            else:
+                entry['values'][key] = current + value
+
+
+def mark_process_dead(pid: int, directory: Optional[str] = None) -> None:
+    """
+    Move counters of a finished worker to the archive and drop its gauges,
+    call it from the gunicorn `child_exit` hook.
+    """
+    directory = directory or _multiprocess_dir
+    path = _process_file(directory, pid)
+    if not os.path.exists(path):
+        return
+    archive = os.path.join(directory, 'geopayment_archive.json')
+    total: Dict = dict()
+    _merge(total, _read(archive))
+    _merge(total, _read(path), gauges=False)
+    _write(archive, {
+        name: {
+            'kind': entry['kind'],
+            'values': [[list(k), v] for k, v in entry['values'].items()],
+        }
+        for name, entry in total.items()
+    })
+    os.remove(path)
+
+
+def _escape(value: str) -> str:
+    return (
+        value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+    )
+
+
+def _labels(names: Iterable[str], values: Iterable[str],
+            extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return f'{value:.1f}'
+    return repr(value)
+
+
+def exposition(registry: Registry = REGISTRY) -> str:
+    """
+    :return: metrics in the Prometheus text format, summed over all
+             processes in multiprocess mode
+    """
+    if registry is REGISTRY and _multiprocess_dir is not None:
+        flush()
+        values: Dict = dict()
+        for name in sorted(os.listdir(_multiprocess_dir)):
+            if name.startswith('geopayment_') and name.endswith('.json'):
+                _merge(values, _read(os.path.join(_multiprocess_dir, name)))
+        values = {name: values.get(name, dict()).get('values', dict())
+                  for name in registry.metrics}
+    else:
+        values = {name: metric.collect()
+                  for name, metric in registry.metrics.items()}
+
+    lines = list()
+    for name, metric in registry.metrics.items():
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for key, value in sorted(values[name].items()):
+            if metric.kind != 'histogram':
+                lines.append(
+                    f'{name}{_labels(metric.labels, key)} {_format(value)}'
+                )
+                continue
+            cumulative = 0
+            bounds = [repr(b) for b in metric.buckets] + ['+Inf']
+            for bound, count in zip(bounds, value):
+                cumulative += count
+                le = _labels(metric.labels, key, f'le="{bound}"')
+                lines.append(f'{name}_bucket{le} {cumulative}')
+            labels = _labels(metric.labels, key)
+            lines.append(f'{name}_sum{labels} {_format(value[-1])}')
+            lines.append(f'{name}_count{labels} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def make_wsgi_app(registry: Registry = REGISTRY):
+    """
+    :return: WSGI application serving `exposition`
+    """
+
+    def app(environ, start_response):
+        body = exposition(registry).encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', CONTENT_TYPE),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    return app
@@ -0,0 +1,443 @@
+"""
+Durable outbox of mutating bank operations (refunds, reversals,
+installment confirm/cancel, `status_sync` acknowledgements).
+
+Operations which fail before reaching the bank (connect errors, limit
+rejections, spent deadlines, results with `SENT: False`) or which the
+bank answered with HTTP 429 and 5xx are stored in SQLite and replayed
+later, in order per payment id, with exponential backoff. While a
+provider keeps failing its operations are not tried until the backoff
+of the failed one is over.
+
+>>> outbox = Outbox('/var/lib/shop/outbox.sqlite3', [tbc, ipay])
+>>> outbox.call(tbc, 'refund_trans', trans_id=trans_id, amount=10)
+{'ERROR': '...', 'OUTBOX': 'queued'}
+>>> outbox.drain()        # or outbox.start() for a background thread
+{'done': 1, 'retry': 0, 'failed': 0, 'unknown': 0}
+
+Every operation has an `op_id`, by default derived from the provider,
+method and params, queuing an operation twice stores it once. Pass your
+own `op_id` for legitimately repeated operations, e.g. two partial
+refunds of the same amount. Rejected operations (other 4xx, bank
+errors, responses which were not parsed) are kept with state `failed`
+for inspection.
+
+A request which may have reached the bank, a read timeout or a reset
+connection, is stored with state `unknown` and never replayed on its
+own, replaying it could refund twice. Check the payment status with the
+bank, then `resolve` it, it is replayed only when it was not applied:
+
+An operation whose drainer did not finish it within `lease` seconds, e.g.
+a crashed process, may have reached the bank as well, it becomes
+`unknown` instead of being replayed again.
+
+>>> for operation in outbox.operations('unknown'):
+...     applied = ...  # e.g. a refund shows in `check_trans_status`
+...     outbox.resolve(operation['op_id'], applied)
+
+Operations are replayed with `stateless=True`, the worker threads share
+the provider instances.
+
+`start` keeps draining when a round fails, the error is logged to the
+`geopayment.outbox` logger.
+"""
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional
+
+from geopayment.providers import forksafe, metrics, tenants
+from geopayment.providers.utils import JsonEncoder
+
+
+__all__ = ['Outbox', 'ID_PARAMS', 'is_retryable', 'is_unknown']
+
+logger = logging.getLogger('geopayment.outbox')
+
+# error of operations whose lease expired while they were running
+LEASE_EXPIRED = 'Lease expired, the operation may have reached the bank'
+
+# params identifying the payment of an operation, first one present wins
+ID_PARAMS = ('trans_id', 'order_id', 'session_id', 'sync_request_id')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS geopayment_outbox ('
+    'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+    'op_id TEXT UNIQUE NOT NULL, '
+    'provider TEXT NOT NULL, '
+    'method TEXT NOT NULL, '
+    'payment_id TEXT NOT NULL, '
+    'params TEXT NOT NULL, '
+    "state TEXT NOT NULL DEFAULT 'pending', "
+    'attempts INTEGER NOT NULL DEFAULT 0, '
+    'next_at REAL NOT NULL DEFAULT 0, '
+    'error TEXT, '
+    'created REAL NOT NULL, '
+    'updated REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS geopayment_outbox_head '
+    'ON geopayment_outbox (provider, payment_id, state, seq)',
+    'CREATE INDEX IF NOT EXISTS geopayment_outbox_due '
+    'ON geopayment_outbox (state, next_at)',
+)
+
+# oldest unfinished operation of every payment which is due, a running
+# or unknown one holds back the operations after it
+_HEADS = (
+    'SELECT seq, provider, method, params, attempts '
+    'FROM geopayment_outbox AS o '
+    "WHERE state = 'pending' AND next_at <= ? "
+    'AND seq = (SELECT MIN(seq) FROM geopayment_outbox '
+    'WHERE provider = o.provider AND payment_id = o.payment_id '
+    "AND state IN ('pending', 'running', 'unknown')) "
+    'AND provider NOT IN ({down}) '
+    'ORDER BY seq LIMIT ?'
+)
+
+
+def is_retryable(result: Any) -> bool:
+    """
+    :param result: result of a provider method
+    :return: whether the request never reached the bank, or the bank
+             was overloaded
+    """
+    if not isinstance(result, dict):
+        return False
+    status = result.get('HTTP_STATUS_CODE')
+    if 'ERROR' in result and status in (None, 'N/A'):
+        return result.get('SENT') is False
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+def is_unknown(result: Any) -> bool:
+    """
+    :param result: result of a provider method
+    :return: whether the request failed without an answer after it may
+             have reached the bank, e.g. on a read timeout
+    """
+    if not isinstance(result, dict) or 'ERROR' not in result:
+        return False
+    return result.get('HTTP_STATUS_CODE') in (None, 'N/A') and \
+        result.get('SENT') is not False
+
+
+def _is_failed(result: Any) -> bool:
+    if not isinstance(result, dict):
+        return False
+    status = result.get('HTTP_STATUS_CODE')
+    if isinstance(status, int) and status >= 400:
+        return True
+    # `ERROR` with a status, the bank answered but the response was not
+    # parsed, the outcome is unknown
+    return 'fault' in result or 'error' in result or 'ERROR' in result or \
+        result.get('RESULT') == 'FAILED'
+
+
+class Outbox(object):
+
+    def __init__(self, path: str, providers: Iterable[Any],
+                 workers: int = 8, batch: int = 256,
+                 backoff: float = 1.0, max_backoff: float = 300.0,
+                 lease: float = 60.0) -> None:
+        """
+        :param path: SQLite database path
+        :param providers: provider instances replaying the operations,
+                          matched by `tenants.name`, the class name
+                          qualified by the tenant of a snapshot
+        :param workers: threads replaying operations of different payments
+        :param batch: operations claimed per drain round
+        :param backoff: first retry delay in seconds, doubled per attempt
+        :param max_backoff: longest retry delay in seconds
+        :param lease: seconds a claimed operation is owned by a drainer,
+                      then it becomes `unknown`
+        """
+        self.path = path
+        self.providers = {tenants.name(p): p for p in providers}
+        self.workers = workers
+        self.batch = batch
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self._local = threading.local()
+        self._down: Dict[str, float] = dict()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        connection = self._connection()
+        with connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+        forksafe.register(self)
+
+    def _after_fork(self) -> None:
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            # a SQLite connection must not cross a fork, it is neither
+            # used nor closed in the child
+            forksafe.abandon(connection)
+        self._local = threading.local()
+        # the drain thread of the parent does not exist in the child,
+        # `start` it again where needed
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            import sqlite3
+
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _payment_id(method: str, params: Dict[str, Any]) -> str:
+        for name in ID_PARAMS:
+            if params.get(name):
+                return str(params[name])
+        return method
+
+    def defer(self, provider: Any, method: str, op_id: str = None,
+              state: str = 'pending', **params: Any) -> str:
+        """
+        Queue an operation without trying it now.
+
+        :param state: `unknown` stores an operation which may have been
+                      applied, it waits for `resolve`
+        :return: operation id
+        """
+        name = tenants.name(provider)
+        if name not in self.providers:
+            self.providers[name] = provider
+        encoded = json.dumps(params, cls=JsonEncoder, sort_keys=True)
+        if op_id is None:
+            op_id = hashlib.sha1(
+                f'{name}.{method}:{encoded}'.encode('utf-8')
+            ).hexdigest()
+        now = time.time()
+        self._connection().execute(
+            'INSERT OR IGNORE INTO geopayment_outbox (op_id, provider, '
+            'method, payment_id, params, state, created, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (op_id, name, method, self._payment_id(method, params), encoded,
+             state, now, now)
+        )
+        return op_id
+
+    def resolve(self, op_id: str, applied: bool) -> bool:
+        """
+        Settle an `unknown` operation once its outcome was checked with
+        the bank.
+
+        :param applied: whether the bank applied it, otherwise it is
+                        replayed
+        :return: whether an unknown operation was settled
+        """
+        return self._connection().execute(
+            'UPDATE geopayment_outbox SET state = ?, next_at = 0, '
+            "updated = ? WHERE op_id = ? AND state = 'unknown'",
+            ('done' if applied else 'pending', time.time(), op_id)
+        ).rowcount > 0
+
+    def _queued(self, provider: str, payment_id: str) -> bool:
+        return self._connection().execute(
+            'SELECT 1 FROM geopayment_outbox WHERE provider = ? AND '
+            "payment_id = ? AND state IN ('pending', 'running', 'unknown') "
+            'LIMIT 1',
+            (provider, payment_id)
+        ).fetchone() is not None
+
+    def call(self, provider: Any, method: str, op_id: str = None,
+             **params: Any) -> Any:
+        """
+        Call a provider method now, queue it when the bank is unreachable
+        or earlier operations of the payment are still queued.
+
+        :return: result of the method, with `OUTBOX: 'queued'` and the
+                 `OUTBOX_ID` when it was queued, `OUTBOX: 'unknown'` when
+                 it may have been applied
+        """
+        name = tenants.name(provider)
+        payment_id = self._payment_id(method, params)
+        result: Any = dict()
+        state = 'pending'
+        if not self._queued(name, payment_id) and \
+                self._down.get(name, 0) <= time.time():
+            result = getattr(provider, method)(**params)
+            if is_unknown(result):
+                state = 'unknown'
+            elif not is_retryable(result):
+                return result
+            self._down[name] = time.time() + self._delay(1)
+        queued_id = self.defer(
+            provider, method, op_id=op_id, state=state, **params
+        )
+        if isinstance(result, dict):
+            result['OUTBOX'] = 'queued' if state == 'pending' else state
+            result['OUTBOX_ID'] = queued_id
+        return result
+
+    def _claim(self, now: float) -> List[tuple]:
+        down = [name for name, until in self._down.items() if until > now]
+        query = _HEADS.format(down=', '.join('?' * len(down)))
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # the drainer of an expired operation may have crashed after
+            # the bank applied it, it is never replayed blindly
+            connection.execute(
+                "UPDATE geopayment_outbox SET state = 'unknown', "
+                'next_at = 0, error = ?, updated = ? '
+                "WHERE state = 'running' AND next_at <= ?",
+                (LEASE_EXPIRED, now, now)
+            )
+            rows = connection.execute(
+                query, (now, *down, self.batch)
+            ).fetchall()
+            connection.executemany(
+                "UPDATE geopayment_outbox SET state = 'running', "
+                'next_at = ?, updated = ? WHERE seq = ?',
+                [(now + self.lease, now, row[0]) for row in rows]
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return rows
+
+    def _replay(self, row: tuple):
+        seq, provider, method, params, attempts = row
+        instance = self.providers.get(provider)
+        if instance is None:
+            return seq, 'failed', attempts, f'Unknown provider {provider}'
+        if attempts and metrics.enabled:
+            metrics.retried(type(instance).__name__, method)
+        try:
+            # the worker threads share the provider instance
+            result = getattr(instance, method)(
+                **dict(json.loads(params), stateless=True)
+            )
+        except Exception as e:
+            return seq, 'failed', attempts + 1, repr(e)
+        if is_retryable(result):
+            return seq, 'retry', attempts + 1, str(result.get('ERROR', ''))
+        if is_unknown(result):
+            return seq, 'unknown', attempts + 1, str(result['ERROR'])
+        if _is_failed(result):
+            return seq, 'failed', attempts + 1, json.dumps(
+                result, cls=JsonEncoder
+            )
+        return seq, 'done', attempts + 1, None
+
+    def _delay(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        return delay * random.uniform(0.9, 1.1)
+
+    def drain(self, max_rounds: Optional[int] = None) -> Dict[str, int]:
+        """
+        Replay due operations until none is left or every provider with
+        due operations is down.
+
+        :param max_rounds: claim rounds, `None` until nothing is due
+        :return: replayed operations by outcome
+        """
+        counts = {'done': 0, 'retry': 0, 'failed': 0, 'unknown': 0}
+        rounds = 0
+        with ThreadPoolExecutor(self.workers) as executor:
+            while max_rounds is None or rounds < max_rounds:
+                rounds += 1
+                now = time.time()
+                rows = self._claim(now)
+                if not rows:
+                    break
+                outcomes = list(executor.map(self._replay, rows))
+                providers = {row[0]: row[1] for row in rows}
+                now = time.time()
+                updates = list()
+                for seq, outcome, attempts, error in outcomes:
+                    counts[outcome] += 1
+                    if outcome == 'retry':
+                        retry_at = now + self._delay(attempts)
+                        self._down[providers[seq]] = max(
+                            self._down.get(providers[seq], 0), retry_at
+                        )
+                        updates.append(
+                            ('pending', attempts, retry_at, error, now, seq)
+                        )
+                    else:
+                        if outcome != 'unknown':
+                            self._down.pop(providers[seq], None)
+                        updates.append(
+                            (outcome, attempts, 0, error, now, seq)
+                        )
+                self._connection().executemany(
+                    'UPDATE geopayment_outbox SET state = ?, attempts = ?, '
+                    'next_at = ?, error = ?, updated = ? WHERE seq = ?',
+                    updates
+                )
+        return counts
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: operations by state
+        """
+        return dict(self._connection().execute(
+            'SELECT state, COUNT(*) FROM geopayment_outbox GROUP BY state'
+        ).fetchall())
+
+    def operations(self, state: str = 'failed',
+                   limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        :return: oldest operations in the state
+        """
+        cursor = self._connection().execute(
+            'SELECT * FROM geopayment_outbox WHERE state = ? '
+            'ORDER BY seq LIMIT ?', (state, limit)
+        )
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def purge(self, older_than: float = 86400.0) -> int:
+        """
+        Delete finished operations.
+
+        :param older_than: seconds since the operation finished
+        :return: deleted operations
+        """
+        return self._connection().execute(
+            "DELETE FROM geopayment_outbox WHERE state = 'done' "
+            'AND updated < ?', (time.time() - older_than,)
+        ).rowcount
+
+    def start(self, interval: float = 1.0) -> None:
+        """
+        Drain in a daemon thread every `interval` seconds.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.drain()
+                except Exception:
+                    # e.g. a locked database, the operations stay queued
+                    logger.exception('Outbox drain failed, %s', self.path)
+
+        self._thread = threading.Thread(
+            target=loop, name='geopayment-outbox', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
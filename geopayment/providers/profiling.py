@@ -0,0 +1,210 @@
+"""
+Opt-in per-stage latency profiling of provider calls.
+
+Stages of one call, in seconds:
+
+    params    - param decorator (`tbc_params`, `bog_params`, ...)
+    prepare   - `_request` building the request params
+    dns       - host name resolution
+    connect   - TCP connect
+    tls       - TLS handshake
+    wait      - sending the request and waiting for the response headers
+    download  - reading the response body and releasing the connection
+    process   - `perform_http_response`
+    handler   - provider method body
+    total     - all of the above
+
+`dns`, `connect` and `tls` are zero when a pooled connection is reused.
+
+>>> profiling.enable(callback=print)
+>>> provider.get_trans_id(amount=23.45, currency='GEL')
+>>> profiling.stats()['MyTBCProvider.get_trans_id']['mean']['wait']
+0.0734
+"""
+import threading
+from time import perf_counter
+from typing import Callable, Dict, Optional
+
+from geopayment.providers import forksafe
+
+__all__ = [
+    'CallProfile',
+    'STAGES',
+    'enable',
+    'disable',
+    'stats',
+    'reset',
+    'current',
+]
+
+STAGES = ('params', 'prepare', 'dns', 'connect', 'tls', 'wait', 'download',
+          'process', 'handler', 'total')
+
+# read by `_request` on every call, keep it a plain module attribute
+enabled = False
+
+_callback: Optional[Callable[['CallProfile'], None]] = None
+_attach = False
+_aggregate = True
+_local = threading.local()
+_lock = threading.Lock()
+_stats: Dict[str, Dict] = dict()
+
+
+@forksafe.at_fork
+def _after_fork() -> None:
+    global _lock, _stats
+    # stats of the parent are its own
+    _lock, _stats = threading.Lock(), dict()
+
+
+class CallProfile(object):
+    __slots__ = ('provider', 'method', 'started', 'last') + STAGES
+
+    def __init__(self, provider: str, method: str,
+                 params_started: Optional[float] = None) -> None:
+        now = perf_counter()
+        self.provider = provider
+        self.method = method
+        self.started = params_started or now
+        self.last = now
+        for stage in STAGES:
+            setattr(self, stage, 0.0)
+        self.params = now - self.started
+
+    @property
+    def name(self) -> str:
+        return f'{self.provider}.{self.method}'
+
+    def lap(self, stage: str) -> float:
+        """
+        Add the time since the previous lap to `stage`.
+        """
+        now = perf_counter()
+        elapsed = now - self.last
+        setattr(self, stage, getattr(self, stage) + elapsed)
+        self.last = now
+        return elapsed
+
+    def split_transport(self, transport: float,
+                        elapsed: Optional[float]) -> None:
+        """
+        :param transport: time spent inside the transport
+        :param elapsed: requests `Response.elapsed`, connection setup until
+                        response headers
+        """
+        setup = self.dns + self.connect + self.tls
+        if elapsed is None:
+            self.wait = max(0.0, transport - setup)
+            return
+        self.wait = max(0.0, elapsed - setup)
+        self.download = max(0.0, transport - elapsed)
+
+    def as_dict(self) -> Dict[str, float]:
+        return {stage: getattr(self, stage) for stage in STAGES}
+
+    def __repr__(self) -> str:
+        stages = ', '.join(
+            f'{stage}={getattr(self, stage) * 1000:.2f}ms' for stage in STAGES
+        )
+        return f'CallProfile({self.name}, {stages})'
+
+
+def enable(callback: Optional[Callable[[CallProfile], None]] = None,
+           attach: bool = False, aggregate: bool = True) -> None:
+    """
+    :param callback: called with the `CallProfile` of every finished call
+    :param attach: add the profile to dict results as `PROFILE`
+    :param aggregate: collect per provider method statistics, see `stats`
+    """
+    global enabled, _callback, _attach, _aggregate
+    _callback, _attach, _aggregate = callback, attach, aggregate
+    enabled = True
+
+
+def disable() -> None:
+    global enabled, _callback
+    enabled = False
+    _callback = None
+
+
+def mark_params() -> None:
+    """
+    Called by the param decorators, the call profile starts here.
+    """
+    _local.params_started = perf_counter()
+
+
+def drop_params() -> None:
+    """
+    Called by the param decorators which raised before `_request` started.
+    """
+    _local.params_started = None
+
+
+def start(provider: str, method: str) -> CallProfile:
+    params_started = getattr(_local, 'params_started', None)
+    _local.params_started = None
+    profile = CallProfile(provider, method, params_started)
+    _local.profile = profile
+    return profile
+
+
+def current() -> Optional[CallProfile]:
+    """
+    :return: profile of the call running in this thread
+    """
+    return getattr(_local, 'profile', None)
+
+
+def finish(profile: CallProfile, result=None) -> None:
+    profile.total = perf_counter() - profile.started
+    _local.profile = None
+    if _attach and isinstance(result, dict):
+        result['PROFILE'] = profile
+    if _aggregate:
+        _record(profile)
+    callback = _callback
+    if callback is not None:
+        callback(profile)
+
+
+def _record(profile: CallProfile) -> None:
+    with _lock:
+        entry = _stats.get(profile.name)
+        if entry is None:
+            entry = _stats[profile.name] = {
+                'count': 0,
+                'sum': dict.fromkeys(STAGES, 0.0),
+                'max': dict.fromkeys(STAGES, 0.0),
+            }
+        entry['count'] += 1
+        totals, maximums = entry['sum'], entry['max']
+        for stage in STAGES:
+            value = getattr(profile, stage)
+            totals[stage] += value
+            if value > maximums[stage]:
+                maximums[stage] = value
+
+
+def stats() -> Dict[str, Dict]:
+    """
+    :return: per `Provider.method` call count, mean and max of every stage
+    """
+    with _lock:
+        return {
+            name: {
+                'count': entry['count'],
+                'mean': {
+                    stage: total / entry['count']
+                    for stage, total in entry['sum'].items()
+                },
+                'max': dict(entry['max']),
+            }
+            for name, entry in _stats.items()
+        }
+
+
+def reset() -> None:
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,494 @@
+"""
+Latency quantile sketches of provider calls, p50 to p999 per provider,
+method and bank host, computed in the worker.
+
+A `Sketch` keeps counts in logarithmic buckets: quantiles are within
+`relative_accuracy` (1% by default) of the exact value, memory is bounded
+by the number of buckets between `min_value` and `max_value` whatever
+the number of samples, and two sketches merge by adding their counts.
+Every request `_request` sends is recorded, network errors and timeouts
+included, cache hits and coalesced calls are not.
+
+>>> quantiles.quantile(0.99, provider='MyTBCProvider', method='get_trans_id')
+0.184...
+>>> quantiles.summary()
+{('MyTBCProvider', 'get_trans_id', 'ecommerce.ufc.ge:18443'):
+    {'count': 1520, 'p50': 0.091, 'p95': 0.142, 'p99': 0.184, ...}}
+
+Recording is off until `enable()`. Sketches are kept per thread and
+merged when read, the sketches of a finished thread are folded into a
+total. Processes share them through a directory, every process writes
+its sketches there and reads merge all of them, the files of processes
+which are gone are removed:
+
+>>> quantiles.enable(multiprocess_dir='/tmp/geopayment-quantiles')
+
+or, from the gunicorn `child_exit` hook:
+
+>>> quantiles.mark_process_dead(worker.pid)
+"""
+import atexit
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import weakref
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from geopayment.providers import forksafe
+
+__all__ = [
+    'QUANTILES',
+    'Sketch',
+    'collect',
+    'enable',
+    'flush',
+    'make_wsgi_app',
+    'mark_process_dead',
+    'merged',
+    'observe',
+    'quantile',
+    'reset',
+    'summary',
+]
+
+QUANTILES = (0.5, 0.95, 0.99, 0.999)
+
+# read by `_request` on every call, keep it a plain module attribute
+enabled = False
+
+_multiprocess_dir: Optional[str] = None
+_flush_interval = 1.0
+_flushed_at = 0.0
+_flush_lock = threading.Lock()
+
+logger = logging.getLogger('geopayment.providers')
+
+Key = Tuple[str, str, str]
+
+
+class Sketch(object):
+    """
+    Mergeable quantile sketch with relative accuracy, DDSketch style.
+    """
+    __slots__ = ('relative_accuracy', 'min_value', 'max_value', 'buckets',
+                 'count', 'sum', 'min', 'max', '_gamma', '_log_gamma',
+                 '_offset', '_last')
+
+    def __init__(self, relative_accuracy: float = 0.01,
+                 min_value: float = 1e-6, max_value: float = 3600.0) -> None:
+        """
+        :param relative_accuracy: largest relative error of a quantile
+        :param min_value: smaller values share the lowest bucket
+        :param max_value: larger values share the highest bucket
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(
+                'Invalid params, `relative_accuracy` must be in (0, 1).'
+            )
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._offset = math.ceil(math.log(min_value) / self._log_gamma)
+        self._last = math.ceil(math.log(max_value) / self._log_gamma) - \
+            self._offset
+        # bucket index to count, at most `_last + 1` buckets
+        self.buckets: Dict[int, int] = dict()
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value: float) -> int:
+        if value <= self.min_value:
+            return 0
+        index = math.ceil(math.log(value) / self._log_gamma) - self._offset
+        return index if index < self._last else self._last
+
+    def add(self, value: float) -> None:
+        index = self._index(value)
+        buckets = self.buckets
+        buckets[index] = buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def _compatible(self, other: 'Sketch') -> bool:
+        return (self.relative_accuracy, self.min_value, self.max_value) == \
+            (other.relative_accuracy, other.min_value, other.max_value)
+
+    def merge(self, other: 'Sketch') -> 'Sketch':
+        """
+        Add the samples of `other` to this sketch.
+        """
+        if not self._compatible(other):
+            raise ValueError(
+                'Invalid params, sketches with different accuracy or range.'
+            )
+        buckets = self.buckets
+        # `dict(...)` is a single C call, safe while the owner writes
+        for index, count in dict(other.buckets).items():
+            buckets[index] = buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        :param q: quantile, 0-1
+        :return: value of the quantile, `None` without samples
+        """
+        if not self.count:
+            return None
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+        if index == 0:
+            return self.min
+        # middle of the bucket, within the relative accuracy of its values
+        value = 2 * self._gamma ** (index + self._offset) / (self._gamma + 1)
+        return min(max(value, self.min), self.max)
+
+    def to_dict(self) -> Dict:
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'min_value': self.min_value,
+            'max_value': self.max_value,
+            'buckets': [[i, c] for i, c in dict(self.buckets).items()],
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Sketch':
+        sketch = cls(
+            data['relative_accuracy'], data['min_value'], data['max_value']
+        )
+        sketch.buckets = {int(i): c for i, c in data['buckets']}
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        if sketch.count:
+            sketch.min, sketch.max = data['min'], data['max']
+        return sketch
+
+    def __repr__(self) -> str:
+        return (
+            f'Sketch(count={self.count}, p50={self.quantile(0.5)}, '
+            f'p99={self.quantile(0.99)})'
+        )
+
+
+class _Owner(object):
+    """
+    Referenced by the thread local only, collected when its thread ends.
+    """
+    __slots__ = ('__weakref__',)
+
+
+_local = threading.local()
+# reentrant, a finished thread may fold its shard during a read
+_lock = threading.RLock()
+_shards: List[Dict[Key, Sketch]] = list()
+# sketches of the finished threads
+_base: Dict[Key, Sketch] = dict()
+
+
+def _shard() -> Dict[Key, Sketch]:
+    try:
+        return _local.shard
+    except AttributeError:
+        shard = _local.shard = dict()
+        owner = _local.owner = _Owner()
+        with _lock:
+            _shards.append(shard)
+        weakref.finalize(owner, _fold, shard).atexit = False
+        return shard
+
+
+def _fold(shard: Dict[Key, Sketch]) -> None:
+    with _lock:
+        for i, current in enumerate(_shards):
+            if current is shard:
+                del _shards[i]
+                break
+        else:
+            # a shard of the parent process
+            return
+        _add(_base, shard)
+
+
+def _add(total: Dict[Key, Sketch], sketches: Dict[Key, Sketch]) -> None:
+    for key, sketch in dict(sketches).items():
+        current = total.get(key)
+        if current is None:
+            current = total[key] = Sketch(
+                sketch.relative_accuracy, sketch.min_value, sketch.max_value
+            )
+        current.merge(sketch)
+
+
+@forksafe.at_fork
+def _after_fork() -> None:
+    global _local, _lock, _shards, _base, _flushed_at, _flush_lock
+    # the lock goes first, dropping the local folds the parent shards
+    _lock, _shards, _base = threading.RLock(), list(), dict()
+    _local = threading.local()
+    _flushed_at = 0.0
+    _flush_lock = threading.Lock()
+
+
+def observe(seconds: float, provider: str, method: str,
+            host: str = '') -> None:
+    """
+    Record the latency of a request, called by `_request`.
+    """
+    shard = _shard()
+    key = (provider, method, host)
+    sketch = shard.get(key)
+    if sketch is None:
+        sketch = shard[key] = Sketch()
+    sketch.add(seconds)
+    if _multiprocess_dir is not None and \
+            perf_counter() - _flushed_at >= _flush_interval:
+        _maybe_flush()
+
+
+def _local_sketches() -> Dict[Key, Sketch]:
+    merged: Dict[Key, Sketch] = dict()
+    with _lock:
+        _add(merged, _base)
+        shards = list(_shards)
+    for shard in shards:
+        _add(merged, shard)
+    return merged
+
+
+def _process_file(directory: str, pid: int) -> str:
+    return os.path.join(directory, f'geopayment-quantiles-{pid}.json')
+
+
+def _flush() -> None:
+    global _flushed_at
+    directory = _multiprocess_dir
+    if directory is None:
+        return
+    _flushed_at = perf_counter()
+    path = _process_file(directory, os.getpid())
+    # a temporary file of its own per writer, never named `*.json`
+    fd, tmp = tempfile.mkstemp(
+        prefix=f'.{os.path.basename(path)}.', suffix='.tmp', dir=directory
+    )
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump([
+                [list(key), sketch.to_dict()]
+                for key, sketch in _local_sketches().items()
+            ], f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _maybe_flush(wait: bool = False) -> None:
+    """
+    Flush from the request path, skipped while another thread flushes
+    unless `wait`, errors are logged and never reach the call.
+    """
+    if not _flush_lock.acquire(blocking=wait):
+        return
+    try:
+        if wait or perf_counter() - _flushed_at >= _flush_interval:
+            _flush()
+    except Exception:
+        logger.exception('geopayment: quantiles flush failed')
+    finally:
+        _flush_lock.release()
+
+
+def flush() -> None:
+    """
+    Write the sketches of this process to the multiprocess directory.
+    """
+    with _flush_lock:
+        _flush()
+
+
+def mark_process_dead(pid: int, directory: Optional[str] = None) -> None:
+    """
+    Drop the sketches of a finished worker, call it from the gunicorn
+    `child_exit` hook. `collect` drops them too, once it sees the
+    process is gone.
+    """
+    directory = directory or _multiprocess_dir
+    if directory is None:
+        return
+    try:
+        os.remove(_process_file(directory, pid))
+    except FileNotFoundError:
+        pass
+
+
+def _pid(name: str) -> Optional[int]:
+    """
+    :return: pid of a process sketches file, `None` for other files
+    """
+    if not (name.startswith('geopayment-quantiles-') and
+            name.endswith('.json')):
+        return None
+    pid = name[len('geopayment-quantiles-'):-len('.json')]
+    return int(pid) if pid.isdigit() else None
+
+
+def collect() -> Dict[Key, Sketch]:
+    """
+    :return: sketch per provider, method and host, merged over the
+             threads, and the processes in multiprocess mode
+    """
+    directory = _multiprocess_dir
+    if directory is None:
+        return _local_sketches()
+    _maybe_flush(wait=True)
+    merged: Dict[Key, Sketch] = dict()
+    for name in sorted(os.listdir(directory)):
+        pid = _pid(name)
+        if pid is None:
+            continue
+        if pid != os.getpid() and not forksafe.alive(pid):
+            mark_process_dead(pid, directory)
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for key, data in values:
+            sketch = Sketch.from_dict(data)
+            total = merged.get(tuple(key))
+            if total is None:
+                merged[tuple(key)] = sketch
+            else:
+                total.merge(sketch)
+    return merged
+
+
+def merged(provider: Optional[str] = None, method: Optional[str] = None,
+           host: Optional[str] = None) -> Optional[Sketch]:
+    """
+    :return: sketch of the matching calls, all of them by default, `None`
+             without calls
+    """
+    total = None
+    for (p, m, h), sketch in collect().items():
+        if provider not in (None, p) or method not in (None, m) or \
+                host not in (None, h):
+            continue
+        if total is None:
+            total = Sketch(
+                sketch.relative_accuracy, sketch.min_value, sketch.max_value
+            )
+        total.merge(sketch)
+    return total
+
+
+def quantile(q: float, provider: Optional[str] = None,
+             method: Optional[str] = None,
+             host: Optional[str] = None) -> Optional[float]:
+    """
+    :param q: quantile, 0-1
+    :return: latency quantile in seconds of the matching calls, all of
+             them by default, `None` without calls
+    """
+    sketch = merged(provider, method, host)
+    return None if sketch is None else sketch.quantile(q)
+
+
+def summary(quantiles: Iterable[float] = QUANTILES) -> Dict[Key, Dict]:
+    """
+    :return: count, sum, max and quantiles in seconds per provider, method
+             and host
+    """
+    quantiles = tuple(quantiles)
+    result = dict()
+    for key, sketch in sorted(collect().items()):
+        values = {'count': sketch.count, 'sum': sketch.sum,
+                  'max': sketch.max}
+        for q in quantiles:
+            values[f'p{q * 100:g}'.replace('.', '')] = sketch.quantile(q)
+        result[key] = values
+    return result
+
+
+def enable(multiprocess_dir: Optional[str] = None,
+           flush_interval: float = 1.0) -> None:
+    """
+    :param multiprocess_dir: directory shared by all worker processes,
+                             defaults to `GEOPAYMENT_METRICS_DIR`
+    :param flush_interval: seconds between writes of this process sketches
+    """
+    global enabled, _multiprocess_dir, _flush_interval
+    multiprocess_dir = (
+        multiprocess_dir or os.environ.get('GEOPAYMENT_METRICS_DIR')
+    )
+    if multiprocess_dir:
+        os.makedirs(multiprocess_dir, exist_ok=True)
+        if _multiprocess_dir is None:
+            atexit.register(flush)
+    _multiprocess_dir = multiprocess_dir or None
+    _flush_interval = flush_interval
+    enabled = True
+
+
+def disable() -> None:
+    global enabled, _multiprocess_dir
+    flush()
+    enabled, _multiprocess_dir = False, None
+
+
+def reset() -> None:
+    """
+    Drop the samples of this process.
+    """
+    with _lock:
+        _base.clear()
+        for shard in _shards:
+            shard.clear()
+
+
+def make_wsgi_app():
+    """
+    :return: WSGI application serving `summary` as JSON
+    """
+
+    def app(environ, start_response):
+        body = json.dumps([
+            {'provider': key[0], 'method': key[1], 'host': key[2], **values}
+            for key, values in summary().items()
+        ]).encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    return app
@@ -0,0 +1,346 @@
+"""
+Slow call watchdog of the provider calls.
+
+A call is slow when it takes longer than the threshold of its method, or
+than the `percentile` of the method latency (see `quantiles`) once
+`min_samples` calls were seen. Slow calls are counted, a sample of them
+is captured into a ring buffer of the last `capacity` captures:
+
+    provider, method, http_method, url, status, code, elapsed, threshold,
+    stages (params, prepare, call, handler, total), request_bytes,
+    response_bytes, request (redacted query params and body, at most
+    `max_bytes` of JSON) and the call profile when profiling is on
+
+>>> slowcalls.configure(thresholds={'checkout': 2.0, 'statuses': 5.0},
+...                     percentile=0.99)
+>>> slowcalls.captures()
+[{'provider': 'MyIPayProvider', 'method': 'checkout', 'elapsed': 3.71,
+  'request_bytes': 481203, ...}]
+>>> slowcalls.dump('/tmp/slow-calls.json')
+
+Thresholds are keyed by `method` or `Provider.method`, the latter wins.
+Percentile thresholds are computed every `refresh` seconds in a daemon
+thread, calls only read them.
+At most `rate` calls per second (bursts of `burst`) are captured, so a
+slow bank does not turn the watchdog into a load of its own.
+"""
+import json
+import random
+import threading
+import time
+from collections import deque
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from geopayment.providers import forksafe, log, metrics, quantiles
+
+
+__all__ = [
+    'captures',
+    'clear',
+    'configure',
+    'disable',
+    'dump',
+    'stats',
+]
+
+# read by `_request` and the param decorators on every call, keep it a
+# plain module attribute
+enabled = False
+
+_thresholds: Dict[str, float] = dict()
+_default: Optional[float] = None
+_percentile: Optional[float] = None
+_min_samples = 100
+_refresh = 10.0
+_rate = 1.0
+_burst = 10.0
+_sample_rate = 1.0
+_max_bytes = 4096
+
+_local = threading.local()
+_lock = threading.Lock()
+_captures: deque = deque(maxlen=100)
+_tokens = 10.0
+_updated = 0.0
+# (provider, method): configured threshold
+_cache: Dict[Tuple[str, str], Optional[float]] = dict()
+# (provider, method): latency percentile, replaced by the refresher
+_percentiles: Dict[Tuple[str, str], float] = dict()
+_refresher: Optional[threading.Thread] = None
+_stop = threading.Event()
+_stats: Dict[Tuple[str, str], List[int]] = dict()
+_random = random.random
+
+
+def configure(thresholds: Optional[Dict[str, float]] = None,
+              default: Optional[float] = None,
+              percentile: Optional[float] = None,
+              min_samples: int = 100, refresh: float = 10.0,
+              capacity: int = 100, rate: float = 1.0, burst: float = 10.0,
+              sample_rate: float = 1.0, max_bytes: int = 4096) -> None:
+    """
+    :param thresholds: seconds per `method` or `Provider.method`
+    :param default: seconds of the other methods, `None` for no threshold
+    :param percentile: latency quantile of a method, 0-1, above which a
+                       call is slow too, turns `quantiles` on
+    :param min_samples: calls of a method before its percentile is used
+    :param refresh: seconds between computations of the percentile
+                    thresholds
+    :param capacity: captures kept, the oldest are dropped
+    :param rate: captures per second
+    :param burst: captures at once
+    :param sample_rate: probability of capturing a slow call
+    :param max_bytes: longest JSON of the captured request params
+    """
+    global enabled, _thresholds, _default, _percentile, _min_samples, \
+        _refresh, _rate, _burst, _sample_rate, _max_bytes, _captures, \
+        _tokens
+    if percentile is not None and not 0 < percentile < 1:
+        raise ValueError('Invalid params, `percentile` must be in (0, 1).')
+    with _lock:
+        _thresholds = dict(thresholds or dict())
+        _default, _percentile = default, percentile
+        _min_samples, _refresh = min_samples, refresh
+        _rate, _burst, _tokens = rate, burst, burst
+        _sample_rate, _max_bytes = sample_rate, max_bytes
+        _captures = deque(_captures, maxlen=capacity)
+        _cache.clear()
+    _halt()
+    if percentile is not None:
+        if not quantiles.enabled:
+            quantiles.enable()
+        _refresh_percentiles()
+        _start()
+    enabled = True
+
+
+def disable() -> None:
+    global enabled
+    enabled = False
+    _halt()
+
+
+def _halt() -> None:
+    global _refresher
+    _stop.set()
+    _refresher = None
+
+
+def mark_params() -> None:
+    """
+    Called by the param decorators, the params stage starts here.
+    """
+    _local.params_started = perf_counter()
+
+
+def drop_params() -> None:
+    """
+    Called by the param decorators which raised before `_request` started.
+    """
+    _local.params_started = None
+
+
+def _refresh_percentiles() -> None:
+    """
+    Compute the percentile of every method from the merged sketches,
+    a read of every process file in multiprocess mode.
+    """
+    global _percentiles
+    percentile, min_samples = _percentile, _min_samples
+    if percentile is None:
+        return
+    totals: Dict[Tuple[str, str], quantiles.Sketch] = dict()
+    for (provider, method, _), sketch in quantiles.collect().items():
+        total = totals.get((provider, method))
+        if total is None:
+            totals[(provider, method)] = sketch
+        else:
+            total.merge(sketch)
+    _percentiles = {
+        key: sketch.quantile(percentile)
+        for key, sketch in totals.items() if sketch.count >= min_samples
+    }
+
+
+def _run(stop: threading.Event) -> None:
+    while not stop.wait(_refresh):
+        try:
+            _refresh_percentiles()
+        except Exception:
+            log.logger.exception('geopayment: slow call thresholds failed')
+
+
+def _start() -> None:
+    global _refresher, _stop
+    with _lock:
+        if _refresher is not None:
+            return
+        _stop = threading.Event()
+        _refresher = threading.Thread(
+            target=_run, args=(_stop,), name='geopayment-slowcalls',
+            daemon=True
+        )
+        _refresher.start()
+
+
+def _threshold(provider: str, method: str) -> Optional[float]:
+    key = (provider, method)
+    try:
+        threshold = _cache[key]
+    except KeyError:
+        threshold = _thresholds.get(f'{provider}.{method}')
+        if threshold is None:
+            threshold = _thresholds.get(method, _default)
+        _cache[key] = threshold
+    if _percentile is not None:
+        if _refresher is None:
+            # a forked child, the thread of the parent is gone
+            _start()
+        value = _percentiles.get(key)
+        if value is not None:
+            threshold = value if threshold is None else \
+                min(threshold, value)
+    return threshold
+
+
+def _take_token() -> bool:
+    global _tokens, _updated
+    now = perf_counter()
+    tokens = min(_burst, _tokens + (now - _updated) * _rate)
+    _updated = now
+    if tokens < 1:
+        _tokens = tokens
+        return False
+    _tokens = tokens - 1
+    return True
+
+
+def _size(value: Any) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return len(json.dumps(value, separators=(',', ':'), default=str))
+
+
+def check(provider: str, method: str, request_params: Dict[str, Any],
+          status, headers: Any, result: Any, entered: float, started: float,
+          received: float, profile: Any = None) -> bool:
+    """
+    Flag a finished call when slow, called by `_request`.
+
+    :param entered: time `_request` was entered
+    :param started: time the request was about to be sent
+    :param received: time the response was parsed
+    :return: whether the call was slow
+    """
+    now = perf_counter()
+    params_started = getattr(_local, 'params_started', None)
+    _local.params_started = None
+    if params_started is None or params_started > entered:
+        params_started = entered
+    elapsed = now - params_started
+    threshold = _threshold(provider, method)
+    if threshold is None or elapsed < threshold:
+        return False
+
+    if metrics.enabled:
+        metrics.SLOW_CALLS.inc(provider, method)
+    with _lock:
+        counts = _stats.setdefault((provider, method), [0, 0])
+        counts[0] += 1
+        if (_sample_rate < 1 and _random() >= _sample_rate) or \
+                not _take_token():
+            return True
+        counts[1] += 1
+
+    body = request_params.get('data')
+    if body is None:
+        body = request_params.get('json')
+    request = log.redact({
+        'params': request_params.get('params'), 'body': body,
+    })
+    encoded = json.dumps(request, default=str)
+    truncated = len(encoded) > _max_bytes
+    response_bytes = (headers or dict()).get('Content-Length')
+    capture = {
+        'time': time.time(),
+        'provider': provider,
+        'method': method,
+        'http_method': request_params.get('method'),
+        'url': log.redact_url(str(request_params.get('url'))),
+        'status': status,
+        'code': metrics.result_code(result) if isinstance(result, dict)
+        else '',
+        'elapsed': elapsed,
+        'threshold': threshold,
+        'stages': {
+            'params': entered - params_started,
+            'prepare': started - entered,
+            'call': received - started,
+            'handler': now - received,
+            'total': elapsed,
+        },
+        'request_bytes': _size(body),
+        'response_bytes': int(response_bytes) if response_bytes
+        else _size(result),
+        'request': encoded[:_max_bytes] if truncated else request,
+        'truncated': truncated,
+        'profile': profile.as_dict() if profile is not None else None,
+    }
+    with _lock:
+        _captures.append(capture)
+    return True
+
+
+def captures() -> List[Dict[str, Any]]:
+    """
+    :return: captured slow calls, oldest first
+    """
+    with _lock:
+        return list(_captures)
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """
+    :return: slow and captured calls per `Provider.method`
+    """
+    with _lock:
+        return {
+            f'{provider}.{method}': {'slow': counts[0],
+                                     'captured': counts[1]}
+            for (provider, method), counts in _stats.items()
+        }
+
+
+def dump(path: Optional[str] = None) -> str:
+    """
+    :param path: file the captures are written to
+    :return: captures as JSON
+    """
+    text = json.dumps(captures(), default=str, indent=2)
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(text)
+    return text
+
+
+def clear() -> None:
+    global _percentiles
+    with _lock:
+        _captures.clear()
+        _stats.clear()
+        _cache.clear()
+        _percentiles = dict()
+
+
+@forksafe.at_fork
+def _after_fork() -> None:
+    global _lock, _captures, _refresher, _stop
+    # captures of the parent are its own, its refresher does not exist
+    # in the child, the first call starts one
+    _lock = threading.Lock()
+    _captures = deque(maxlen=_captures.maxlen)
+    _stats.clear()
+    _refresher, _stop = None, threading.Event()
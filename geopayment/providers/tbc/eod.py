@@ -0,0 +1,145 @@
+"""
+End of business day of many TBC merchant terminals at once.
+
+Every terminal, a `TBCProvider` subclass with its own `cert` and
+`service_url`, is closed in a thread, at most `MAX_WORKERS` (32) at once
+unless `workers` is given, an attempt is limited to
+`timeout` seconds and unreachable terminals (network errors, HTTP 429
+and 5xx) are tried again. The whole run stays within `deadline`, the
+bank cut-off, however many terminals there are.
+
+>>> report = close_terminals([ShopTerminal, CafeTerminal], deadline=60)
+>>> report['failed'], report['totals']['FLD_088']
+(0, 1530075)
+
+The `FLD_*` counters and amounts of the terminals are parsed to
+integers, amounts are in tetri, and summed up in `totals`.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Dict, Iterable, Mapping, Optional, Union
+
+from geopayment.providers import deadline as deadlines
+from geopayment.providers import metrics
+from geopayment.providers.outbox import is_retryable, is_unknown
+
+
+__all__ = ['EOD_FIELDS', 'MAX_WORKERS', 'close_terminals', 'parse_totals']
+
+# terminals closed at once by default, a thread each
+MAX_WORKERS = 32
+
+# counters and amounts of a closed business day
+EOD_FIELDS = {
+    'FLD_074': 'number of credit transactions',
+    'FLD_075': 'number of credit reversals',
+    'FLD_076': 'number of debit transactions',
+    'FLD_077': 'number of debit reversals',
+    'FLD_086': 'total amount of credit transactions',
+    'FLD_087': 'total amount of credit reversals',
+    'FLD_088': 'total amount of debit transactions',
+    'FLD_089': 'total amount of debit reversals',
+}
+
+Terminals = Union[Iterable[Any], Mapping[str, Any]]
+
+
+def parse_totals(result: Dict[str, Any]) -> Dict[str, int]:
+    """
+    :param result: `end_of_business_day` result
+    :return: `FLD_*` values as integers, missing and malformed ones are 0
+    """
+    totals = dict()
+    for name in EOD_FIELDS:
+        try:
+            totals[name] = int(result.get(name) or 0)
+        except (TypeError, ValueError):
+            totals[name] = 0
+    return totals
+
+
+def _close(provider: Any, timeout: float, retries: int, backoff: float,
+           run_deadline: Optional[deadlines.Deadline]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    attempts, result = 0, dict()
+    with deadlines.budget(run_deadline) if run_deadline else nullcontext():
+        while True:
+            attempts += 1
+            result = provider.end_of_business_day(deadline=timeout)
+            # closing the day twice closes nothing more, a timed out
+            # attempt is tried again too
+            retryable = is_retryable(result) or is_unknown(result)
+            if not retryable or attempts > retries:
+                break
+            left = deadlines.remaining()
+            delay = backoff * 2 ** (attempts - 1)
+            if left is not None and left <= delay:
+                break
+            time.sleep(delay)
+            if metrics.enabled:
+                metrics.retried(
+                    type(provider).__name__, 'end_of_business_day'
+                )
+    ok = isinstance(result, dict) and result.get('RESULT') == 'OK'
+    return {
+        'ok': ok,
+        'result': result,
+        'totals': parse_totals(result) if ok else None,
+        'attempts': attempts,
+        'elapsed': round(time.perf_counter() - started, 6),
+    }
+
+
+def close_terminals(terminals: Terminals, timeout: float = 30.0,
+                    retries: int = 2, backoff: float = 1.0,
+                    deadline: Union[None, float, deadlines.Deadline] = None,
+                    workers: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Close the business day of every terminal concurrently.
+
+    :param terminals: provider instances or classes, or a mapping of
+                      terminal name to them, named by class otherwise
+    :param timeout: seconds an attempt of a terminal may take
+    :param retries: attempts after the first one of unreachable terminals
+    :param backoff: first retry delay in seconds, doubled per attempt
+    :param deadline: seconds (or a `Deadline`) the whole run must finish in
+    :param workers: terminals closed at once, all of them up to
+                    `MAX_WORKERS` by default
+    :return: `terminals` with the result, `ok`, `totals`, `attempts` and
+             `elapsed` per terminal, summed `totals`, `closed` and `failed`
+             terminal counts
+    """
+    if isinstance(terminals, Mapping):
+        named = list(terminals.items())
+    else:
+        named = [
+            (getattr(t, '__name__', type(t).__name__), t) for t in terminals
+        ]
+    names = [name for name, _ in named]
+    if len(set(names)) != len(names):
+        raise ValueError(
+            'Invalid params, terminal names must be unique, pass a mapping.'
+        )
+    providers = [t() if isinstance(t, type) else t for _, t in named]
+    run_deadline = deadlines.current(deadline)
+
+    if workers is None:
+        workers = min(MAX_WORKERS, len(providers))
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        results = list(executor.map(
+            lambda p: _close(p, timeout, retries, backoff, run_deadline),
+            providers
+        ))
+
+    totals = dict.fromkeys(EOD_FIELDS, 0)
+    for result in results:
+        for name, value in (result['totals'] or dict()).items():
+            totals[name] += value
+    closed = sum(1 for result in results if result['ok'])
+    return {
+        'terminals': dict(zip(names, results)),
+        'totals': totals,
+        'closed': closed,
+        'failed': len(results) - closed,
+    }
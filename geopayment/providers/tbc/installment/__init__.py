@@ -2,7 +2,10 @@ from base64 import b64encode
 from dataclasses import dataclass
 from typing import Optional, Any, Dict
 
-from geopayment.providers.utils import tbc_installment_params, _request
+from geopayment.providers.cache import tbc_installment_final
+from geopayment.providers.utils import (
+    tbc_installment_params, _request, is_stateless
+)
 
 
 @dataclass
@@ -20,6 +23,9 @@ class BaseInstallmentProvider(object):
     session_id: str = None
     redirect_url: str = None
     http_status_code: str = None
+    # methods return their results without storing them on the instance,
+    # can be overridden per call with `stateless=True/False`
+    stateless: bool = False
 
     def __init__(self) -> None:
         assert callable(self.merchant_key) is False, \
@@ -143,12 +149,16 @@ class TBCInstallmentProvider(BaseInstallmentProvider):
 
         """
 
-        self.http_status_code = kwargs['HTTP_STATUS_CODE']
         result = kwargs['result']
+        stateless = is_stateless(self, kwargs)
+        if not stateless:
+            self.http_status_code = kwargs['HTTP_STATUS_CODE']
         if 'fault' in result or 'error' in result:
             return result
-        self.auth = AuthData(**result)
-        return self.auth
+        auth = AuthData(**result)
+        if not stateless:
+            self.auth = auth
+        return auth
 
     @tbc_installment_params(
         endpoint='v1/online-installments/applications', api='create',
@@ -189,20 +199,22 @@ class TBCInstallmentProvider(BaseInstallmentProvider):
 
         """
 
-        self.http_status_code = kwargs['HTTP_STATUS_CODE']
-        self.session_id = kwargs['result'].get('sessionId')
-        self.redirect_url = kwargs['headers'].get('location')
-        if self.session_id and self.redirect_url:
-            return {
-                'session_id': self.session_id, 'redirect_url': self.redirect_url
-            }
+        session_id = kwargs['result'].get('sessionId')
+        redirect_url = kwargs['headers'].get('location')
+        if not is_stateless(self, kwargs):
+            self.http_status_code = kwargs['HTTP_STATUS_CODE']
+            self.session_id = session_id
+            self.redirect_url = redirect_url
+        if session_id and redirect_url:
+            return {'session_id': session_id, 'redirect_url': redirect_url}
         return kwargs['result']
 
     @tbc_installment_params(
         endpoint='v1/online-installments/applications/{session_id}/confirm',
         api='confirm',
     )
-    @_request(verify=True, timeout=(3, 10), method='post')
+    @_request(verify=True, timeout=(3, 10), method='post',
+              invalidates='session_id')
     def confirm(self,  **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         [api doc](https://developers.tbcbank.ge/docs/installment-confirm-application)
@@ -224,14 +236,16 @@ class TBCInstallmentProvider(BaseInstallmentProvider):
 
         """
 
-        self.http_status_code = kwargs['HTTP_STATUS_CODE']
+        if not is_stateless(self, kwargs):
+            self.http_status_code = kwargs['HTTP_STATUS_CODE']
         return kwargs['result']
 
     @tbc_installment_params(
         endpoint='v1/online-installments/applications/{session_id}/cancel',
         api='cancel',
     )
-    @_request(verify=True, timeout=(3, 10), method='post')
+    @_request(verify=True, timeout=(3, 10), method='post',
+              invalidates='session_id')
     def cancel(self,  **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         [api doc](https://developers.tbcbank.ge/docs/installment-cancel-application)
@@ -252,14 +266,16 @@ class TBCInstallmentProvider(BaseInstallmentProvider):
                             HTTP request has been successfully completed.
 
         """
-        self.http_status_code = kwargs['HTTP_STATUS_CODE']
+        if not is_stateless(self, kwargs):
+            self.http_status_code = kwargs['HTTP_STATUS_CODE']
         return kwargs['result']
 
     @tbc_installment_params(
         endpoint='v1/online-installments/applications/{session_id}/status',
         api='status',
     )
-    @_request(verify=True, timeout=(3, 10), method='post')
+    @_request(verify=True, timeout=(3, 10), method='post', coalesce=True,
+              cache_by='session_id', final=tbc_installment_final)
     def status(self,  **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         [api doc](https://developers.tbcbank.ge/docs/installment-get-application-status)
@@ -290,14 +306,15 @@ class TBCInstallmentProvider(BaseInstallmentProvider):
                             HTTP request has been successfully completed.
 
         """
-        self.http_status_code = kwargs['HTTP_STATUS_CODE']
+        if not is_stateless(self, kwargs):
+            self.http_status_code = kwargs['HTTP_STATUS_CODE']
         return kwargs['result']
 
     @tbc_installment_params(
         endpoint='v1/online-installments/merchant/applications/status-changes',
         api='statuses',
     )
-    @_request(verify=True, timeout=(3, 10), method='post')
+    @_request(verify=True, timeout=(3, 10), method='post', coalesce=True)
     def statuses(self,  **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         [api doc](https://developers.tbcbank.ge/docs/installment-merchant-application-statuses)
@@ -325,7 +342,8 @@ class TBCInstallmentProvider(BaseInstallmentProvider):
                             HTTP request has been successfully completed.
 
         """
-        self.http_status_code = kwargs['HTTP_STATUS_CODE']
+        if not is_stateless(self, kwargs):
+            self.http_status_code = kwargs['HTTP_STATUS_CODE']
         return kwargs['result']
 
     @tbc_installment_params(
@@ -352,5 +370,6 @@ class TBCInstallmentProvider(BaseInstallmentProvider):
                             HTTP request has been successfully completed.
 
         """
-        self.http_status_code = kwargs['HTTP_STATUS_CODE']
+        if not is_stateless(self, kwargs):
+            self.http_status_code = kwargs['HTTP_STATUS_CODE']
         return kwargs['result']
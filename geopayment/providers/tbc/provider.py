@@ -8,7 +8,8 @@ Created on Apr 14, 2020
 
 from typing import Dict, Any, Optional, Tuple
 
-from geopayment.providers.utils import _request, tbc_params
+from geopayment.providers.cache import tbc_final
+from geopayment.providers.utils import _request, tbc_params, is_stateless
 
 
 __all__ = ['TBCProvider']
@@ -17,6 +18,9 @@ __all__ = ['TBCProvider']
 class BaseTBCProvider(object):
     trans_id: str = None
     refund_trans_id: str = None
+    # methods return their results without storing them on the instance,
+    # can be overridden per call with `stateless=True/False`
+    stateless: bool = False
 
     def __init__(self) -> None:
         assert callable(self.description) is False, \
@@ -93,12 +97,13 @@ class TBCProvider(BaseTBCProvider):
         """
 
         result = kwargs['result']
-        if 'TRANSACTION_ID' in result:
+        if 'TRANSACTION_ID' in result and not is_stateless(self, kwargs):
             self.trans_id = result['TRANSACTION_ID']
         return result
 
     @tbc_params('trans_id', 'client_ip_addr', command='c')
-    @_request(verify=False, timeout=(3, 10), method='post')
+    @_request(verify=False, timeout=(3, 10), method='post', coalesce=True,
+              cache_by='trans_id', final=tbc_final)
     def check_trans_status(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         command: Transaction type
@@ -125,7 +130,8 @@ class TBCProvider(BaseTBCProvider):
         return kwargs['result']
 
     @tbc_params('trans_id', 'amount', command='r')
-    @_request(verify=False, timeout=(3, 10), method='post')
+    @_request(verify=False, timeout=(3, 10), method='post',
+              invalidates='trans_id')
     def reversal_trans(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         command: Transaction type
@@ -147,7 +153,8 @@ class TBCProvider(BaseTBCProvider):
         return kwargs['result']
 
     @tbc_params('trans_id', 'amount', command='k')
-    @_request(verify=False, timeout=(3, 10), method='post')
+    @_request(verify=False, timeout=(3, 10), method='post',
+              invalidates='trans_id')
     def refund_trans(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         command: Transaction type
@@ -190,13 +197,14 @@ class TBCProvider(BaseTBCProvider):
         """
 
         result = kwargs['result']
-        if 'TRANSACTION_ID' in result:
+        if 'TRANSACTION_ID' in result and not is_stateless(self, kwargs):
             self.trans_id = result['TRANSACTION_ID']
         return result
 
     @tbc_params('trans_id', 'amount', 'currency', 'client_ip_addr',
                 'description', command='t', language='ka', msg_type='DMS')
-    @_request(verify=False, timeout=(3, 10), method='post')
+    @_request(verify=False, timeout=(3, 10), method='post',
+              invalidates='trans_id')
     def confirm_pre_auth_trans(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         command: Transaction type
@@ -315,7 +323,7 @@ class TBCProvider(BaseTBCProvider):
 
         """
         result = kwargs['result']
-        if 'TRANSACTION_ID' in result:
+        if 'TRANSACTION_ID' in result and not is_stateless(self, kwargs):
             self.trans_id = result['TRANSACTION_ID']
         return result
 
@@ -343,12 +351,13 @@ class TBCProvider(BaseTBCProvider):
 
         """
         result = kwargs['result']
-        if 'TRANSACTION_ID' in result:
+        if 'TRANSACTION_ID' in result and not is_stateless(self, kwargs):
             self.trans_id = result['TRANSACTION_ID']
         return result
 
     @tbc_params('trans_id', 'amount', command='g')
-    @_request(verify=False, timeout=(3, 10), method='post')
+    @_request(verify=False, timeout=(3, 10), method='post',
+              invalidates='trans_id')
     def refund_to_debit_card(self, **kwargs: Optional[Any]) -> Dict[str, str]:
         """
         command: Transaction type
@@ -367,9 +376,11 @@ class TBCProvider(BaseTBCProvider):
         error           - in case of an error
 
         """
+        result = kwargs['result']
+        if is_stateless(self, kwargs):
+            return result
         if 'trans_id' in kwargs:
             self.trans_id = kwargs['trans_id']
-        result = kwargs['result']
         if 'REFUND_TRANS_ID' in result:
             self.refund_trans_id = result['REFUND_TRANS_ID']
         return result
@@ -0,0 +1,202 @@
+"""
+Registry of configured provider instances of many tenants (merchants).
+
+`build(tenant_id)` returns the provider of a tenant, its configuration
+properties (`service_url`, `cert`, `client_id`, `merchant_key`, ...) may
+be slow, e.g. read from a database. The registry reads them once, keeps
+a snapshot instance whose properties are plain values and caches it, the
+least recently used tenants are dropped above `maxsize`:
+
+>>> registry = TenantRegistry(lambda tenant: ShopIPayProvider(tenant))
+>>> registry.get('shop-42').checkout(...)
+>>> registry.invalidate('shop-42')        # the merchant changed settings
+
+Tenants without their own `transport` share the registry transport, a
+`PooledTransport` by default, so connections to a bank host are pooled
+across tenants (TBC terminals with their own `cert` still get their own
+pool). Tokens fetched by a tenant provider stay on its snapshot.
+
+`client_ip` is not snapshotted by default, it is the customer address of
+the current request in most shops.
+
+A snapshot keeps the class name of its provider and gets the tenant id
+in its `tenant` attribute. `name(provider)`, e.g.
+`ShopIPayProvider[shop-42]`, keys what tenants must never share: cache
+keys, coalesced requests, outbox operations and journal records. Metrics
+and quantile labels, limits, logs, slow calls and the warm-up report
+stay per class name, they do not grow with the number of tenants.
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional
+
+from geopayment.providers import forksafe
+
+__all__ = ['SNAPSHOT_ATTRIBUTES', 'TenantRegistry', 'name', 'snapshot']
+
+# configuration properties of the providers
+SNAPSHOT_ATTRIBUTES = (
+    'description',
+    'service_url',
+    'redirect_url',
+    'cert',
+    'client_id',
+    'secret_key',
+    'merchant_key',
+    'campaign_id',
+    'key',
+    'secret',
+    'merchant_id',
+    'password',
+)
+
+# snapshot class per provider class and attributes
+_classes: Dict[tuple, type] = dict()
+_classes_lock = threading.Lock()
+
+
+@forksafe.at_fork
+def _after_fork() -> None:
+    global _classes_lock
+    _classes_lock = threading.Lock()
+
+
+def name(provider: Any) -> str:
+    """
+    :param provider: provider instance
+    :return: class name of the provider, with the tenant of a snapshot
+    """
+    tenant = getattr(provider, 'tenant', None)
+    if tenant is None:
+        return type(provider).__name__
+    return f'{type(provider).__name__}[{tenant}]'
+
+
+def _snapshot_class(klass: type, names: tuple) -> type:
+    key = (klass, names)
+    snapshot_class = _classes.get(key)
+    if snapshot_class is None:
+        with _classes_lock:
+            snapshot_class = _classes.get(key)
+            if snapshot_class is None:
+                # plain class attributes, the instance values shadow them;
+                # the class name is kept, `name` adds the tenant
+                snapshot_class = type(klass.__name__, (klass,), dict(
+                    {name: None for name in names},
+                    __module__=klass.__module__,
+                    __qualname__=klass.__qualname__,
+                ))
+                _classes[key] = snapshot_class
+    return snapshot_class
+
+
+def snapshot(provider: Any,
+             attributes: Iterable[str] = SNAPSHOT_ATTRIBUTES,
+             tenant: Optional[Hashable] = None) -> Any:
+    """
+    :param provider: configured provider instance
+    :param attributes: properties read once
+    :param tenant: tenant id, the `tenant` attribute of the copy
+    :return: copy of the provider whose properties are plain values
+    """
+    klass = type(provider)
+    names = tuple(
+        name for name in attributes
+        if isinstance(getattr(klass, name, None), property)
+    )
+    values = {name: getattr(provider, name) for name in names}
+    snapshot_class = _snapshot_class(klass, names)
+    instance = snapshot_class.__new__(snapshot_class)
+    instance.__dict__.update(vars(provider))
+    # the copy has credentials of its own, see `cache.fingerprint`
+    instance.__dict__.pop('_cache_fingerprint', None)
+    instance.__dict__.update(values)
+    if tenant is not None:
+        instance.__dict__['tenant'] = tenant
+    return instance
+
+
+class TenantRegistry(object):
+
+    def __init__(self, build: Callable[[Hashable], Any],
+                 maxsize: int = 1024, transport: Any = None,
+                 attributes: Iterable[str] = SNAPSHOT_ATTRIBUTES) -> None:
+        """
+        :param build: returns the configured provider of a tenant id
+        :param maxsize: cached tenants
+        :param transport: transport of tenants without their own, a shared
+                          `PooledTransport` by default
+        :param attributes: configuration properties snapshotted per tenant
+        """
+        if transport is None:
+            from geopayment.providers.transport import PooledTransport
+
+            transport = PooledTransport()
+        self.build = build
+        self.maxsize = maxsize
+        self.transport = transport
+        self.attributes = tuple(attributes)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._providers: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        forksafe.register(self)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def get(self, tenant_id: Hashable) -> Any:
+        """
+        :return: cached provider of the tenant, built on first use
+        """
+        with self._lock:
+            provider = self._providers.get(tenant_id)
+            if provider is not None:
+                self._providers.move_to_end(tenant_id)
+                self.hits += 1
+                return provider
+            self.misses += 1
+        provider = snapshot(
+            self.build(tenant_id), self.attributes, tenant_id
+        )
+        if getattr(provider, 'transport', None) is None:
+            provider.transport = self.transport
+        with self._lock:
+            # a concurrent miss of the tenant may have stored it already
+            provider = self._providers.setdefault(tenant_id, provider)
+            self._providers.move_to_end(tenant_id)
+            while len(self._providers) > self.maxsize:
+                self._providers.popitem(last=False)
+        return provider
+
+    __getitem__ = get
+
+    def invalidate(self, tenant_id: Hashable) -> bool:
+        """
+        Drop the provider of a tenant, the next `get` builds it again.
+
+        :return: whether the tenant was cached
+        """
+        with self._lock:
+            return self._providers.pop(tenant_id, None) is not None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._providers.clear()
+
+    def peek(self, tenant_id: Hashable) -> Optional[Any]:
+        """
+        :return: cached provider of the tenant, without building it
+        """
+        with self._lock:
+            return self._providers.get(tenant_id)
+
+    def __contains__(self, tenant_id: Hashable) -> bool:
+        return tenant_id in self._providers
+
+    def __len__(self) -> int:
+        return len(self._providers)
+
+    def close(self) -> None:
+        self.clear()
+        self.transport.close()
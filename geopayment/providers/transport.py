@@ -0,0 +1,253 @@
+"""
+Transports send the request params built by `_request` (the keyword
+arguments of `requests.request`) and return a `requests.Response`.
+
+A provider picks its transport through an optional `transport` attribute,
+otherwise the module default is used.
+
+>>> class MyTBCProvider(TBCProvider):
+...     transport = StubTransport(lambda params: (200, 'RESULT: OK', None))
+"""
+import json
+import threading
+from typing import Any, Callable, Dict, Optional, Union
+
+from geopayment.providers import forksafe, profiling
+
+
+__all__ = [
+    'Transport',
+    'RequestsTransport',
+    'PooledTransport',
+    'StubTransport',
+    'make_response',
+    'get_transport',
+    'set_transport',
+]
+
+
+class Transport(object):
+
+    def request(self, **params: Any):
+        """
+        :param params: `requests.request` keyword arguments
+        :return: requests.Response
+        """
+        raise NotImplementedError(
+            'Transport needs implement `request` function'
+        )
+
+    def close(self) -> None:
+        pass
+
+
+def _profiled_request(params: Dict[str, Any]):
+    import requests
+
+    from geopayment.providers.adapters import ProfilingHTTPAdapter
+
+    # a new session per call, like `requests.request`
+    with requests.Session() as session:
+        session.mount('https://', ProfilingHTTPAdapter())
+        session.mount('http://', ProfilingHTTPAdapter())
+        return session.request(**params)
+
+
+class RequestsTransport(Transport):
+    """
+    Sends every request with `requests.request`, a new session per call.
+    """
+
+    def request(self, **params: Any):
+        import requests
+
+        if not profiling.enabled:
+            return requests.request(**params)
+        return _profiled_request(params)
+
+
+class PooledTransport(Transport):
+    """
+    Keeps connections (and TLS sessions) open between calls, one pool per
+    host and client certificate, shared by the threads of a process.
+    Cookies are never stored. Profiled calls go through the same pools,
+    their DNS, connect and TLS stages are measured when a connection is
+    opened and zero when one is reused.
+    """
+
+    def __init__(self, pool_connections: int = 10,
+                 pool_maxsize: int = 10) -> None:
+        """
+        :param pool_connections: hosts (and certificates) with a pool
+        :param pool_maxsize: connections kept open per host
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._session = None
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    @property
+    def session(self):
+        if self._session is not None:
+            return self._session
+        # the first calls of several threads, e.g. of `open`, share the
+        # session they create
+        with self._lock:
+            if self._session is not None:
+                return self._session
+            from http.cookiejar import DefaultCookiePolicy
+
+            import requests
+
+            from geopayment.providers.adapters import ProfilingHTTPAdapter
+
+            session = requests.Session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            # times new connections of profiled calls only
+            for prefix in ('https://', 'http://'):
+                session.mount(prefix, ProfilingHTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize,
+                ))
+            self._session = session
+        return self._session
+
+    def request(self, **params: Any):
+        return self.session.request(**params)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+        if self._session is None:
+            return
+        # new pool managers with the same settings, an `ssl_context`
+        # included; the old ones are garbage collected, which only closes
+        # the child's copies of the parent's sockets
+        for adapter in self._session.adapters.values():
+            manager = getattr(adapter, 'poolmanager', None)
+            if manager is None:
+                continue
+            pool_kwargs = dict(manager.connection_pool_kw)
+            pool_kwargs.pop('maxsize', None)
+            pool_kwargs.pop('block', None)
+            adapter.init_poolmanager(
+                adapter._pool_connections, adapter._pool_maxsize,
+                block=adapter._pool_block, **pool_kwargs
+            )
+            adapter.proxy_manager = dict()
+
+    def open(self, url: str, count: int = 1, verify: Union[bool, str] = True,
+             cert: Any = None, timeout: float = 3.0) -> int:
+        """
+        Open connections to the host of `url` and keep them in its pool,
+        the DNS lookup, TCP connect and TLS handshake are done now with
+        `HEAD` requests to `url`.
+
+        :param count: connections, at most `pool_maxsize`
+        :param verify: server certificate verification, like the requests
+        :param cert: client certificate, like the requests
+        :param timeout: connect and read timeout in seconds
+        :return: connections in the pool which are open
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        import requests
+
+        def head(_):
+            try:
+                # streamed, the connection is held until the body is read,
+                # so every request opens a connection of its own
+                return self.session.head(
+                    url, verify=verify, cert=cert, timeout=timeout,
+                    allow_redirects=False, stream=True
+                )
+            except requests.exceptions.RequestException:
+                return None
+
+        count = min(count, self.pool_maxsize)
+        with ThreadPoolExecutor(max(1, count)) as executor:
+            responses = list(executor.map(head, range(count)))
+        opened = 0
+        for response in responses:
+            if response is None:
+                continue
+            # reading the empty body puts the connection back in the pool
+            response.content
+            response.close()
+            opened += 1
+        return opened
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+def make_response(status_code: int = 200,
+                  content: Union[bytes, str, Dict, list, None] = None,
+                  headers: Optional[Dict[str, str]] = None,
+                  url: Optional[str] = None):
+    """
+    Build a `requests.Response` without network, `dict`/`list` content is
+    json encoded.
+    """
+    from requests import Response
+    from requests.structures import CaseInsensitiveDict
+
+    response_headers = CaseInsensitiveDict(headers or dict())
+    if isinstance(content, (dict, list)):
+        content = json.dumps(content)
+        response_headers.setdefault('Content-Type', 'application/json')
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+
+    response = Response()
+    response.status_code = status_code
+    response._content = content or b''
+    response.headers = response_headers
+    response.encoding = 'utf-8'
+    response.url = url
+    return response
+
+
+class StubTransport(Transport):
+    """
+    Offline transport, `responder` receives the request params and returns
+    a response or a `(status_code, content, headers)` tuple.
+    """
+
+    def __init__(self, responder: Callable[[Dict[str, Any]], Any]) -> None:
+        self.responder = responder
+        self.calls = 0
+
+    def request(self, **params: Any):
+        self.calls += 1
+        response = self.responder(params)
+        if isinstance(response, tuple):
+            status_code, content, headers = response
+            response = make_response(
+                status_code, content, headers, params.get('url')
+            )
+        return response
+
+
+_default_transport: Transport = RequestsTransport()
+
+
+def get_transport(provider: Any = None) -> Transport:
+    """
+    :param provider: provider instance
+    :return: provider transport, or the default one
+    """
+    return getattr(provider, 'transport', None) or _default_transport
+
+
+def set_transport(transport: Transport) -> Transport:
+    """
+    Replace the default transport used by providers without their own.
+
+    :return: previous default transport
+    """
+    global _default_transport
+    previous, _default_transport = _default_transport, transport
+    return previous
@@ -7,11 +7,11 @@ Created on Jul 14, 2017
 """
 import datetime
 import json
-from decimal import Decimal, ROUND_UP
+import sys
+from decimal import Decimal
 from functools import wraps
-from typing import Dict, Any, Union
-
-import requests
+from time import perf_counter
+from typing import Dict, Any, Union, TYPE_CHECKING
 
 from geopayment.constants import (
     CURRENCY_CODES,
@@ -20,23 +20,81 @@ from geopayment.constants import (
     DEFAULT_PAYLOAD_ARGS,
     BOG_ITEM_KEYS,
     BOG_INSTALLMENT_ITEM_KEYS,
-    TBC_INSTALLMENT_ITEM_KEYS
+    TBC_INSTALLMENT_ITEM_KEYS,
+    TBC_ROUNDING,
+    TBC_INSTALLMENT_ROUNDING,
+    BOG_ROUNDING,
+)
+from geopayment.money import Money, to_minor
+
+# the other feature modules are imported where they are used, signing
+# only paths (e.g. Credo) never load them
+from geopayment.providers import (
+    cache,
+    coalesce,
+    deadline,
+    forksafe,
+    metrics,
+    tenants,
 )
+from geopayment.providers.transport import get_transport
+
+if TYPE_CHECKING:
+    import requests
+
+
+def _enabled(name: str):
+    """
+    :param name: opt-in feature module with an `enabled` flag, e.g.
+                 `profiling`
+    :return: the module when enabled, `None` otherwise; enabling a feature
+             imports its module, calls never do
+    """
+    module = sys.modules.get(f'geopayment.providers.{name}')
+    # a module still imported by another thread has no flag yet
+    if module is not None and getattr(module, 'enabled', False):
+        return module
+    return None
+
+
+_log_module = None
+
+
+def _log():
+    """
+    :return: the `log` module, on by default, imported by the first call
+    """
+    global _log_module
+    if _log_module is None:
+        # not `sys.modules`, which holds the module while another thread
+        # is still importing it; the import waits for it
+        from geopayment.providers import log
+        _log_module = log
+    return _log_module
+
+
+def is_stateless(klass, kwargs: Dict[str, Any]) -> bool:
+    """
+    :param klass: provider instance
+    :param kwargs: method kwargs, `stateless` overrides the provider setting
+    :return: whether the call must leave the provider instance untouched
+    """
+    return kwargs.get('stateless', getattr(klass, 'stateless', False))
 
 
 def get_client_ip(request) -> str:
     """
-    This method support only Django web framework
+    Django, Starlette, Flask requests, ASGI scopes and WSGI environs are
+    supported, `X-Forwarded-For` hops are trusted only when they come from
+    the proxies given to `client_ip.configure` (loopback and private
+    networks by default).
+
     :param request:
     :return: client ip address
     """
+    from geopayment.providers import client_ip
 
-    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-    if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
-    else:
-        ip = request.META.get('REMOTE_ADDR')
-    return ip
+    return client_ip.resolve(request)
 
 
 def parse_response(content: str) -> Dict:
@@ -57,19 +115,25 @@ def parse_response(content: str) -> Dict:
 
 
 def gel_to_tetri(
-        amount: Union[int, float, Decimal],
-        quantize: str = '1.00') -> int:
+        amount: Union[int, float, str, Decimal, Money],
+        quantize: str = '1.00',
+        rounding: str = TBC_ROUNDING) -> int:
     """
 
-    :param amount: type of decimal
+    :param amount: type of decimal, floats are read by their shortest repr
     :param quantize: type of string
+    :param rounding: rounding mode for more than two decimal places
     :return: amount in tetri
 
     >>> amount = Decimal('0.01')
     >>> gel_to_tetri(amount)
     1
     """
-    return int(Decimal(amount).quantize(Decimal(quantize)) * 100)
+    if quantize == '1.00':
+        return to_minor(amount, rounding)
+    return int(
+        Decimal(amount).quantize(Decimal(quantize), rounding=rounding) * 100
+    )
 
 
 def get_currency_code(code):
@@ -93,13 +157,13 @@ class JsonEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, datetime.datetime):
             return o.isoformat()
-        if isinstance(o, Decimal):
+        if isinstance(o, (Decimal, Money)):
             return str(o)
 
         return super().default(o)
 
 
-def perform_http_response(response: requests.Response):
+def perform_http_response(response: 'requests.Response'):
     """
     :param response: Response object from HTTP Request
     :return: result from merchant handler
@@ -107,9 +171,21 @@ def perform_http_response(response: requests.Response):
     try:
         result = response.json()
         result.update({'HTTP_STATUS_CODE': response.status_code})
-    except (ValueError, json.decoder.JSONDecodeError):
-        result = parse_response(response.text)
-        result.update({'HTTP_STATUS_CODE': response.status_code})
+    except (ValueError, json.decoder.JSONDecodeError) as e:
+        text = response.text
+        try:
+            # a truncated json body is no ECOMM response either
+            if text.lstrip()[:1] in ('{', '['):
+                raise e
+            result = parse_response(text)
+        except ValueError as error:
+            result = {
+                'RESULT': text,
+                'ERROR': str(error),
+                'HTTP_STATUS_CODE': response.status_code
+            }
+        else:
+            result.update({'HTTP_STATUS_CODE': response.status_code})
     except Exception as e:
         result = {
             'RESULT': response.text,
@@ -119,17 +195,145 @@ def perform_http_response(response: requests.Response):
     return result
 
 
+def _not_sent(error: Exception) -> bool:
+    """
+    :param error: error of a request
+    :return: whether the request provably never reached the bank, it was
+             rejected before sending or no connection was made
+    """
+    import requests
+
+    from geopayment.providers import limits
+
+    if isinstance(error, (limits.Rejected, deadline.DeadlineExceeded,
+                          requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        from urllib3.exceptions import NewConnectionError
+
+        # refused or unresolved, a reset or an aborted connection may
+        # come after the request was written
+        reason = getattr(error.args[0], 'reason', None) if error.args \
+            else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+def _send(klass, name: str, request_params: Dict[str, Any], profile,
+          call_deadline=None):
+    """
+    Send a request through the provider limits and transport.
+
+    :param klass: provider instance
+    :param name: provider method name
+    :param request_params: transport request params
+    :param profile: call profile, when profiling is enabled
+    :param call_deadline: `Deadline` of the call, shrinks the timeout
+    :return: HTTP status, response headers and parsed response
+    """
+    # imported on first call, signing only paths never load requests
+    import requests
+
+    from geopayment.providers import limits
+
+    provider = type(klass).__name__
+    call, result, limit, limited = None, None, None, False
+    status, sent = 'N/A', None
+    provider_limits = getattr(klass, 'limits', None)
+    if provider_limits:
+        limit = limits.find(provider_limits, name)
+    try:
+        if limit is not None:
+            limited = limits.enter(limit, provider, name, call_deadline)
+        if call_deadline is not None:
+            left = call_deadline.remaining()
+            if left <= 0:
+                raise deadline.DeadlineExceeded(
+                    f'Deadline exceeded, {provider}.{name} was not sent.'
+                )
+            request_params['timeout'] = deadline.shrink(
+                request_params['timeout'], left
+            )
+        if metrics.enabled:
+            call = metrics.start(provider, name)
+        quantiles = _enabled('quantiles')
+        if quantiles is not None:
+            sent = perf_counter()
+        resp = get_transport(klass).request(**request_params)
+        if profile is not None:
+            elapsed = getattr(resp, 'elapsed', None)
+            profile.split_transport(
+                profile.lap('wait'),
+                elapsed.total_seconds() if elapsed else None
+            )
+        status = resp.status_code
+        result = perform_http_response(resp)
+        return status, resp.headers, result
+    except (requests.exceptions.RequestException, limits.Rejected,
+            deadline.DeadlineExceeded) as e:
+        if profile is not None:
+            profile.split_transport(profile.lap('wait'), None)
+        result = {'ERROR': str(e)}
+        if _not_sent(e):
+            result['SENT'] = False
+        return status, dict(), result
+    finally:
+        if limited:
+            limit.leave()
+        if call is not None:
+            metrics.finish(call, status, result)
+        if sent is not None:
+            quantiles.observe(
+                perf_counter() - sent, provider, name,
+                request_params['url'].partition('//')[2].partition('/')[0]
+            )
+
+
+def _exchange(klass, name: str, request_params: Dict[str, Any],
+              kwargs: Dict[str, Any], profile, call_deadline, started: float):
+    """
+    `_send` and the journal record of the request, run once per request
+    sent, by the leader of coalesced calls only.
+    """
+    status, headers, result = _send(
+        klass, name, request_params, profile, call_deadline
+    )
+    provider_journal = getattr(klass, 'journal', None)
+    if provider_journal is not None:
+        from geopayment.providers import journal
+
+        journal.record(
+            provider_journal, tenants.name(klass), name, request_params,
+            kwargs, status, result, perf_counter() - started
+        )
+    return status, headers, result
+
+
 def _request(**kw):
+    cache_by, invalidates = kw.get('cache_by'), kw.get('invalidates')
+
     def wrapper(f):
+        if cache_by:
+            cache.register(f.__name__)
+
         @wraps(f)
         def wrapped(*args, **kwargs):
+            entered = perf_counter()
+            klass = args[0]
+            # observability labels stay per class, tenants would make
+            # their cardinality unbounded
+            provider = type(klass).__name__
+            profile = None
+            profiling = _enabled('profiling')
+            if profiling is not None:
+                profile = profiling.start(provider, f.__name__)
+
             request_params: Dict[str, Any] = dict()
             for k, v in kw.items():
                 if k in kwargs:
                     continue
                 kwargs[k] = v
 
-            klass = args[0]
             method = kwargs['method']
             request_params['url'] = kwargs.get('url', klass.service_url)
             request_params['method'] = method
@@ -146,24 +350,112 @@ def _request(**kw):
             if method == 'get':
                 request_params['allow_redirects'] = True
 
+            if profile is not None:
+                profile.lap('prepare')
+            started = perf_counter()
+            call_deadline = deadline.current(kwargs.get('deadline'))
+            response_cache = getattr(klass, 'response_cache', None)
+            cache_key, cached = None, None
+            if response_cache is not None and kwargs.get(cache_by):
+                cache_key = cache.key(klass, f.__name__, kwargs[cache_by])
+                sent_generation = cache.generation(cache_key)
+                # `cached=False` skips the lookup, the response replaces
+                # the cached one
+                if kwargs.get('cached', True):
+                    cached = cache.lookup(
+                        response_cache, cache_key, provider, f.__name__
+                    )
+            if cached is not None:
+                status, headers, result = cached
+            elif kwargs.get('coalesce'):
+                status, headers, result = coalesce.do(
+                    coalesce.key(klass, f.__name__, request_params),
+                    _exchange, klass, f.__name__, request_params, kwargs,
+                    profile, call_deadline, started,
+                    timeout=coalesce.patience(
+                        request_params['timeout'], call_deadline
+                    )
+                )
+                if profile is not None:
+                    profile.lap('wait')
+            else:
+                status, headers, result = _exchange(
+                    klass, f.__name__, request_params, kwargs, profile,
+                    call_deadline, started
+                )
+            received = perf_counter()
+            if response_cache is not None:
+                if cache_key is not None and cached is None:
+                    cache.store(
+                        response_cache, cache_key, status, headers, result,
+                        kw['final'], sent_generation
+                    )
+                elif invalidates:
+                    cache.invalidate(
+                        response_cache, klass, kwargs.get(invalidates)
+                    )
+            if status != 'N/A' or 'HTTP_STATUS_CODE' not in kwargs:
+                kwargs['HTTP_STATUS_CODE'] = status
+            kwargs['headers'] = headers
+            log = _log() if cached is None else None
+            if log is not None and log.enabled:
+                log.call(
+                    provider, f.__name__, request_params,
+                    kwargs['HTTP_STATUS_CODE'], result,
+                    perf_counter() - started
+                )
+            slowcalls = _enabled('slowcalls')
+            if profile is None and slowcalls is None:
+                return f(result=result, *args, **kwargs)
+
+            response = result
+            if profile is not None:
+                profile.lap('process')
             try:
-                resp = requests.request(**request_params)
-                kwargs['HTTP_STATUS_CODE'] = resp.status_code
-                result = perform_http_response(resp)
-                kwargs['headers'] = resp.headers
-            except requests.exceptions.RequestException as e:
-                result = {'ERROR': str(e)}
-                kwargs['headers'] = dict()
-                if 'HTTP_STATUS_CODE' not in kwargs:
-                    kwargs['HTTP_STATUS_CODE'] = 'N/A'
-
-            return f(result=result, *args, **kwargs)
+                result = f(result=result, *args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.lap('handler')
+                    profiling.finish(profile, result)
+            if slowcalls is not None:
+                slowcalls.check(
+                    provider, f.__name__, request_params,
+                    status, headers, response, entered, started, received,
+                    profile
+                )
+            return result
 
+        wrapped.coalesce = kw.get('coalesce', False)
+        wrapped.verify = kw.get('verify', True)
         return wrapped
 
     return wrapper
 
 
+def _params_stage(wrapped):
+    """
+    Body of a param decorator, profiles and slow calls start here. The
+    mark is dropped when the body raises, e.g. on invalid params, so the
+    next call of the thread does not take it.
+    """
+    @wraps(wrapped)
+    def marked(*args, **kwargs):
+        modules = [
+            module for module in map(_enabled, ('profiling', 'slowcalls'))
+            if module is not None
+        ]
+        for module in modules:
+            module.mark_params()
+        try:
+            return wrapped(*args, **kwargs)
+        except BaseException:
+            for module in modules:
+                module.drop_params()
+            raise
+
+    return marked
+
+
 def tbc_params(*arg_params, **kwarg_params):
     """
     Decorator that pops all accepted parameters from method's kwargs and puts
@@ -172,6 +464,7 @@ def tbc_params(*arg_params, **kwarg_params):
 
     def wrapper(f):
         @wraps(f)
+        @_params_stage
         def wrapped(*a, **kw):
             kw.update(kwarg_params)
             payload = dict()
@@ -214,6 +507,7 @@ def tbc_installment_params(**kw):
 
     def wrapper(f):
         @wraps(f)
+        @_params_stage
         def wrapped(*args, **kwargs):
             for k, v in kw.items():
                 if k in kwargs:
@@ -222,6 +516,7 @@ def tbc_installment_params(**kw):
 
             klass = args[0]
             data, headers, payload = dict(), dict(), dict()
+            session_id = None
             endpoint = kw['endpoint']
             if endpoint.startswith('/'):
                 raise ValueError(
@@ -230,6 +525,9 @@ def tbc_installment_params(**kw):
                 )
             api = kw['api']
             if api == 'auth':
+                forksafe.track_tokens(klass)
+                if metrics.enabled:
+                    metrics.token_refreshed(type(klass).__name__)
                 headers['accept'] = 'application/json'
                 headers['Content-Type'] = 'application/x-www-form-urlencoded'
                 credentials = klass.get_basic_auth().decode('utf-8')
@@ -261,7 +559,7 @@ def tbc_installment_params(**kw):
                     )
                 else:
                     data['invoiceId'] = kwargs['invoice_id']
-                amount = Decimal(0)
+                prices = list()
                 for item in kwargs['products']:
                     for key in TBC_INSTALLMENT_ITEM_KEYS:
                         if key not in item:
@@ -269,13 +567,20 @@ def tbc_installment_params(**kw):
                                 f'Invalid params, products item `{key}` is a '
                                 f'required parameter.'
                             )
-                    amount += Decimal(item['price'])
+                    prices.append(item['price'])
                 data['products'] = kwargs['products']
-                data['priceTotal'] = str(amount.quantize(Decimal('.00')))
+                data['priceTotal'] = Money.sum(
+                    prices, rounding=TBC_INSTALLMENT_ROUNDING
+                ).to_major()
 
                 payload.update({'json': data})
             elif api == 'confirm' or api == 'cancel' or api == 'status':
-                endpoint = endpoint.format(session_id=klass.session_id)
+                session_id = kwargs.get('session_id') or klass.session_id
+                if not session_id:
+                    raise ValueError(
+                        'Invalid params, `session_id` is a required parameter.'
+                    )
+                endpoint = endpoint.format(session_id=session_id)
 
                 headers['accept'] = 'application/json'
                 headers['Content-Type'] = 'application/json'
@@ -325,7 +630,7 @@ def tbc_installment_params(**kw):
                         access_token = klass.auth.access_token
                     else:
                         access_token = kwargs['access_token']
-                except TypeError:
+                except (TypeError, AttributeError):
                     raise ValueError(
                         'Invalid params, `access_token` is a required parameter. '
                         'Use authorization method `get_auth` or set `access_token` value.'
@@ -334,7 +639,11 @@ def tbc_installment_params(**kw):
 
             kwargs = {
                 'url': f'{klass.url}{endpoint}',
-                'headers': headers
+                'headers': headers,
+                'stateless': is_stateless(klass, kwargs),
+                'session_id': session_id,
+                'cached': kwargs.get('cached', True),
+                'deadline': kwargs.get('deadline'),
             }
 
             return f(payload=payload, *args, **kwargs)
@@ -352,6 +661,7 @@ def bog_params(**kw):
 
     def wrapper(f):
         @wraps(f)
+        @_params_stage
         def wrapped(*args, **kwargs):
             for k, v in kw.items():
                 if k in kwargs:
@@ -363,6 +673,9 @@ def bog_params(**kw):
             endpoint = kw['endpoint']
             api = kw['api']
             if api == 'auth':
+                forksafe.track_tokens(klass)
+                if metrics.enabled:
+                    metrics.token_refreshed(type(klass).__name__)
                 headers['accept'] = 'application/json'
                 headers['Content-Type'] = 'application/x-www-form-urlencoded'
                 credentials = klass.get_credentials().decode('utf-8')
@@ -396,7 +709,7 @@ def bog_params(**kw):
                     raise ValueError(
                         f'Invalid params, `items` is a required parameter.'
                     )
-                amount = Decimal(0)
+                amounts = list()
                 for item in kwargs['items']:
                     for key in BOG_ITEM_KEYS:
                         if key not in item:
@@ -404,15 +717,16 @@ def bog_params(**kw):
                                 f'Invalid params, item `{key}` is a '
                                 f'required parameter.'
                             )
-                    amount += Decimal(item['amount'])
+                    amounts.append(item['amount'])
                 data['items'] = kwargs['items']
+                amount = Money.sum(
+                    amounts, kwargs['currency_code'], rounding=BOG_ROUNDING
+                )
                 data['purchase_units'] = [
                     {
                         'amount': {
                             'currency_code': kwargs['currency_code'],
-                            'value': str(amount.quantize(
-                                Decimal('.00'), rounding=ROUND_UP
-                            ))
+                            'value': amount.to_major()
                         },
                         'industry_type': 'ECOMMERCE'
                     }
@@ -452,12 +766,12 @@ def bog_params(**kw):
                     raise ValueError(error_message.format('cart_items'))
 
                 data['cart_items'] = kwargs['cart_items']
-                amount = Decimal(0)
+                amounts = list()
                 for item in kwargs['cart_items']:
                     for key in BOG_INSTALLMENT_ITEM_KEYS:
                         if key not in item:
                             raise ValueError(error_message.format(key))
-                    amount += Decimal(item['total_item_amount'])
+                    amounts.append(item['total_item_amount'])
                     item['total_item_amount'] = str(item['total_item_amount'])
 
                 if 'currency_code' not in kwargs:
@@ -466,7 +780,10 @@ def bog_params(**kw):
                     data['purchase_units'] = [{
                         'amount': {
                             'currency_code': kwargs['currency_code'],
-                            'value': str(amount.quantize(Decimal('.00'), rounding=ROUND_UP))
+                            'value': Money.sum(
+                                amounts, kwargs['currency_code'],
+                                rounding=BOG_ROUNDING
+                            ).to_major()
                         },
                     }]
 
@@ -516,7 +833,7 @@ def bog_params(**kw):
                         access_token = klass.access['access_token']
                     else:
                         access_token = kwargs['access_token']
-                except TypeError:
+                except (TypeError, KeyError):
                     raise ValueError(
                         'Invalid params, `access_token` is a required parameter. '
                         'Use authorization method `get_auth` or set `access_token` value.'
@@ -525,7 +842,11 @@ def bog_params(**kw):
 
             kwargs = {
                 'url': f'{klass.service_url}{endpoint}',
-                'headers': headers
+                'headers': headers,
+                'stateless': is_stateless(klass, kwargs),
+                'order_id': kwargs.get('order_id'),
+                'cached': kwargs.get('cached', True),
+                'deadline': kwargs.get('deadline'),
             }
 
             return f(payload=payload, *args, **kwargs)
@@ -0,0 +1,281 @@
+"""
+Warm-up of provider connections and tokens at worker start, so the first
+checkout does not pay for DNS, the (m)TLS handshake and the OAuth token.
+
+Connections are pre-opened in the pools of a `PooledTransport`. Other
+transports, the default `RequestsTransport` opens a connection per call,
+keep nothing open, their providers only get their tokens and `skipped`
+in the report tells why. Tokens are fetched with `get_auth`
+(BOG iPay) and `auth` (TBC installments) and stored on the provider
+instances, warm the instances which serve the requests:
+
+>>> set_transport(PooledTransport(pool_maxsize=20))
+>>> warm_up([tbc, ipay, installments], connections=4)
+{'MyTBCProvider': {'connections': 4, 'token': False, 'error': None,
+                   'skipped': None, ...}}
+>>> ready()
+True
+
+gunicorn, in `gunicorn.conf.py`, the worker accepts requests once warm:
+
+>>> post_worker_init = gunicorn_hook(lambda: [tbc, ipay], connections=4)
+
+uvicorn and other ASGI servers, the lifespan of the application:
+
+>>> app = FastAPI(lifespan=asgi_lifespan(lambda: [tbc, ipay]))
+
+`make_wsgi_app()` is a readiness probe for a load balancer, 200 once
+warm and 503 before.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+from geopayment.providers import forksafe
+from geopayment.providers.transport import get_transport
+
+
+__all__ = [
+    'TOKEN_METHODS',
+    'asgi_lifespan',
+    'gunicorn_hook',
+    'make_wsgi_app',
+    'ready',
+    'report',
+    'reset',
+    'start',
+    'warm_up',
+]
+
+# provider methods fetching an OAuth token
+TOKEN_METHODS = ('get_auth', 'auth')
+
+_lock = threading.Lock()
+_ready = threading.Event()
+_report: Dict[str, Dict[str, Any]] = dict()
+
+Providers = Union[Iterable[Any], Callable[[], Iterable[Any]]]
+
+
+@forksafe.at_fork
+def _after_fork() -> None:
+    global _lock, _ready
+    # pooled connections are not inherited, a child warms up on its own;
+    # the tokens of the parent are
+    _lock, _ready = threading.Lock(), threading.Event()
+    _report.clear()
+
+
+def _token_method(provider: Any) -> Optional[Callable]:
+    for name in TOKEN_METHODS:
+        # `auth` of the instance is the token once fetched, use the class
+        method = getattr(type(provider), name, None)
+        if callable(method) and hasattr(method, 'coalesce'):
+            return method
+    return None
+
+
+def _verify(provider: Any) -> bool:
+    """
+    :return: certificate verification of most provider methods, the pool
+             of a connection depends on it
+    """
+    values = [
+        getattr(getattr(type(provider), name, None), 'verify', None)
+        for name in dir(type(provider)) if not name.startswith('_')
+    ]
+    values = [v for v in values if v is not None]
+    return max(set(values), key=values.count) if values else True
+
+
+def _warm_provider(provider: Any, connections: int, tokens: bool,
+                   timeout: float) -> Dict[str, Any]:
+    started = time.perf_counter()
+    result = {'connections': 0, 'token': False, 'error': None,
+              'skipped': None}
+    transport = get_transport(provider)
+    try:
+        if connections and not hasattr(transport, 'open'):
+            result['skipped'] = \
+                f'{type(transport).__name__} keeps no connections open'
+        elif connections:
+            try:
+                url = provider.service_url
+            except (AttributeError, NotImplementedError):
+                url = None
+            if url:
+                result['connections'] = transport.open(
+                    url, connections, verify=_verify(provider),
+                    cert=getattr(provider, 'cert', None), timeout=timeout
+                )
+                if not result['connections']:
+                    result['error'] = f'Could not connect to {url}'
+        method = _token_method(provider) if tokens else None
+        if method is not None:
+            token = method(provider, stateless=False)
+            error = None
+            if isinstance(token, dict):
+                error = token.get('ERROR') or token.get('error')
+            if error:
+                result['error'] = str(error)
+            else:
+                result['token'] = True
+    except Exception as e:
+        result['error'] = repr(e)
+    result['elapsed'] = round(time.perf_counter() - started, 6)
+    return result
+
+
+def _merge(first: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    :return: warm-up result of two providers of a class, e.g. tenants
+    """
+    return {
+        'connections': first['connections'] + other['connections'],
+        'token': first['token'] and other['token'],
+        'error': first['error'] or other['error'],
+        'skipped': first['skipped'] or other['skipped'],
+        'elapsed': max(first['elapsed'], other['elapsed']),
+    }
+
+
+def _providers(providers: Providers) -> List[Any]:
+    if callable(providers):
+        providers = providers()
+    return list(providers)
+
+
+def warm_up(providers: Providers, connections: int = 2,
+            tokens: bool = True, timeout: float = 3.0,
+            strict: bool = False) -> Dict[str, Dict[str, Any]]:
+    """
+    Warm the providers concurrently, see module docs.
+
+    :param providers: provider instances, or a callable returning them
+    :param connections: connections opened per provider
+    :param tokens: fetch OAuth tokens
+    :param timeout: connect timeout in seconds
+    :param strict: ready only when every provider was warmed without error,
+                   otherwise once the warm-up was tried
+    :return: connections opened, token fetched, error, why connections
+             were skipped and seconds spent per provider class name, the
+             tenants of a class are merged
+    """
+    providers = _providers(providers)
+    with ThreadPoolExecutor(max(1, len(providers))) as executor:
+        results = list(executor.map(
+            lambda p: _warm_provider(p, connections, tokens, timeout),
+            providers
+        ))
+    warmed: Dict[str, Dict[str, Any]] = dict()
+    for provider, result in zip(providers, results):
+        name = type(provider).__name__
+        warmed[name] = _merge(warmed[name], result) if name in warmed \
+            else result
+    with _lock:
+        _report.update(warmed)
+        if not strict or not any(r['error'] for r in _report.values()):
+            _ready.set()
+    return warmed
+
+
+def start(providers: Providers, interval: float = 5.0,
+          **kwargs: Any) -> threading.Thread:
+    """
+    Warm up in a daemon thread, in strict mode tried again every
+    `interval` seconds until the providers are ready.
+
+    :param kwargs: `warm_up` params
+    """
+
+    def loop():
+        while True:
+            warm_up(providers, **kwargs)
+            if _ready.wait(interval):
+                return
+
+    thread = threading.Thread(
+        target=loop, name='geopayment-warmup', daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def ready() -> bool:
+    """
+    :return: whether the worker is warm
+    """
+    return _ready.is_set()
+
+
+def report() -> Dict[str, Dict[str, Any]]:
+    """
+    :return: last warm-up result per provider class name
+    """
+    with _lock:
+        return {name: dict(result) for name, result in _report.items()}
+
+
+def reset() -> None:
+    """
+    Forget the warm-up, e.g. in a forked worker.
+    """
+    with _lock:
+        _report.clear()
+        _ready.clear()
+
+
+def gunicorn_hook(providers: Providers, **kwargs: Any) -> Callable:
+    """
+    :param kwargs: `warm_up` params
+    :return: gunicorn `post_worker_init` hook warming the worker
+    """
+
+    def post_worker_init(worker) -> None:
+        reset()
+        warmed = warm_up(providers, **kwargs)
+        log = getattr(worker, 'log', None)
+        if log is not None:
+            log.info('geopayment warm-up: %s', warmed)
+
+    return post_worker_init
+
+
+def asgi_lifespan(providers: Providers, **kwargs: Any) -> Callable:
+    """
+    :param kwargs: `warm_up` params
+    :return: lifespan of a Starlette/FastAPI application, warming the
+             worker in a thread before it accepts requests
+    """
+    from contextlib import asynccontextmanager
+
+    @asynccontextmanager
+    async def lifespan(app):
+        import asyncio
+
+        reset()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, lambda: warm_up(providers, **kwargs)
+        )
+        yield
+
+    return lifespan
+
+
+def make_wsgi_app():
+    """
+    :return: WSGI readiness probe, 200 when warm, 503 before
+    """
+
+    def app(environ, start_response):
+        warm = ready()
+        body = b'ready\n' if warm else b'warming up\n'
+        start_response('200 OK' if warm else '503 Service Unavailable', [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    return app
@@ -0,0 +1,28 @@
+"""
+Local stand-in servers for the bank APIs used by the providers, for tests,
+benchmarks and load tests without network.
+
+>>> simulator = TBCEcommSimulator(behaviour=Behaviour(latency=fixed(0.02)))
+>>> with SimulatorServer(simulator) as server:
+...     service_url = f'{server.url}/ecomm2/MerchantHandler'
+"""
+from geopayment.simulator.base import (
+    Behaviour,
+    Request,
+    Simulator,
+    SimulatorServer,
+    exponential,
+    fixed,
+    lognormal,
+    parse_latency,
+    uniform,
+)
+from geopayment.simulator.bog import IPaySimulator
+from geopayment.simulator.tbc import TBCEcommSimulator, TBCInstallmentSimulator
+
+
+SIMULATORS = {
+    'tbc': TBCEcommSimulator,
+    'tbc-installment': TBCInstallmentSimulator,
+    'bog': IPaySimulator,
+}
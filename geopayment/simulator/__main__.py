@@ -0,0 +1,48 @@
+"""
+    $ python -m geopayment.simulator tbc --port 18443 \
+        --certfile server.pem --keyfile server-key.pem --client-ca ca.pem \
+        --latency lognormal:0.03,0.5 --error-rate 0.01 --throttle 200
+"""
+import argparse
+
+from geopayment.simulator import SIMULATORS, Behaviour, SimulatorServer
+from geopayment.simulator.base import parse_latency
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='geopayment bank simulator')
+    parser.add_argument('bank', choices=sorted(SIMULATORS))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    parser.add_argument('--client-ca', help='require client certificates')
+    parser.add_argument('--latency', help='e.g. fixed:0.02, uniform:0.01,0.05')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle', type=float, help='requests per second')
+    parser.add_argument('--approve-rate', type=float, default=1.0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    behaviour = Behaviour(
+        latency=parse_latency(args.latency), error_rate=args.error_rate,
+        throttle=args.throttle, seed=args.seed
+    )
+    simulator = SIMULATORS[args.bank](
+        behaviour=behaviour, approve_rate=args.approve_rate, seed=args.seed
+    )
+    server = SimulatorServer(
+        simulator, args.host, args.port, args.certfile, args.keyfile,
+        args.client_ca
+    )
+    print(f'{args.bank} simulator listening on {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""
+Building blocks of the local bank simulators: behaviour (latency, error
+rate, throttling), request routing and a threaded HTTP(S) server with
+optional mutual TLS.
+"""
+import json
+import random
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit
+
+
+__all__ = [
+    'Behaviour',
+    'Request',
+    'Simulator',
+    'SimulatorServer',
+    'fixed',
+    'uniform',
+    'lognormal',
+    'exponential',
+    'parse_latency',
+]
+
+
+Latency = Callable[[random.Random], float]
+
+
+def fixed(seconds: float) -> Latency:
+    return lambda rnd: seconds
+
+
+def uniform(low: float, high: float) -> Latency:
+    return lambda rnd: rnd.uniform(low, high)
+
+
+def lognormal(median: float, sigma: float = 0.5) -> Latency:
+    from math import log
+
+    mu = log(median)
+    return lambda rnd: rnd.lognormvariate(mu, sigma)
+
+
+def exponential(mean: float) -> Latency:
+    return lambda rnd: rnd.expovariate(1 / mean)
+
+
+_DISTRIBUTIONS = {
+    'fixed': fixed,
+    'uniform': uniform,
+    'lognormal': lognormal,
+    'exponential': exponential,
+}
+
+
+def parse_latency(spec: Optional[str]) -> Optional[Latency]:
+    """
+    :param spec: `name:arg,arg` in seconds, e.g. `lognormal:0.02,0.5`
+    :return: latency distribution
+
+    >>> parse_latency('uniform:0.01,0.05')
+    """
+    if not spec:
+        return None
+    name, _, args = spec.partition(':')
+    if name not in _DISTRIBUTIONS:
+        raise ValueError(
+            f'Invalid latency, allowed: {", ".join(_DISTRIBUTIONS)}'
+        )
+    return _DISTRIBUTIONS[name](*(float(a) for a in args.split(',') if a))
+
+
+class Behaviour(object):
+    """
+    How a simulated endpoint misbehaves.
+
+    :param latency: distribution of the added response delay
+    :param error_rate: probability of answering with HTTP 500
+    :param throttle: allowed requests per second, HTTP 429 above it
+    :param burst: token bucket size of `throttle`, defaults to `throttle`
+    :param seed: random seed, makes latencies and errors reproducible
+    """
+
+    def __init__(self, latency: Optional[Latency] = None,
+                 error_rate: float = 0.0, throttle: Optional[float] = None,
+                 burst: Optional[float] = None,
+                 seed: Optional[int] = None) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.burst = burst or throttle
+        self.random = random.Random(seed)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        if self.latency is None:
+            return 0.0
+        with self._lock:
+            return max(0.0, self.latency(self.random))
+
+    def fails(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def throttled(self) -> bool:
+        if not self.throttle:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated) * self.throttle
+            )
+            self._updated = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+
+class Request(object):
+    __slots__ = ('method', 'path', 'query', 'headers', 'body', 'params',
+                 'client_cert')
+
+    def __init__(self, method: str, path: str, headers: Dict[str, str],
+                 body: bytes, client_cert: Optional[Dict] = None) -> None:
+        url = urlsplit(path)
+        self.method = method
+        self.path = url.path
+        self.query = dict(parse_qsl(url.query))
+        self.headers = headers
+        self.body = body
+        self.params: Dict[str, str] = dict()
+        self.client_cert = client_cert
+
+    def form(self) -> Dict[str, str]:
+        return dict(parse_qsl(self.body.decode('utf-8')))
+
+    def json(self) -> Any:
+        return json.loads(self.body.decode('utf-8') or 'null')
+
+    @property
+    def bearer(self) -> Optional[str]:
+        auth = self.headers.get('authorization', '')
+        if auth.startswith('Bearer '):
+            return auth[7:]
+        return None
+
+    @property
+    def basic(self) -> Optional[str]:
+        auth = self.headers.get('authorization', '')
+        if auth.startswith('Basic '):
+            return auth[6:]
+        return None
+
+
+# status code, body (dict/list are json encoded) and extra headers
+Reply = Tuple[int, Union[bytes, str, Dict, list, None], Dict[str, str]]
+
+
+class Simulator(object):
+    """
+    Base simulator, subclasses fill `routes` with
+    `(method, path regex, handler name)`. Path regexes are matched against
+    the end of the request path, so any service url prefix works.
+    """
+
+    routes: Tuple[Tuple[str, str, str], ...] = ()
+
+    def __init__(self, behaviour: Optional[Behaviour] = None,
+                 endpoints: Optional[Dict[str, Behaviour]] = None,
+                 seed: Optional[int] = None) -> None:
+        """
+        :param behaviour: default behaviour of every endpoint
+        :param endpoints: behaviour per handler name, e.g. `{'token': ...}`
+        :param seed: seed of the simulated bank decisions
+        """
+        self.behaviour = behaviour or Behaviour()
+        self.endpoints = endpoints or dict()
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.stats: Dict[str, int] = dict()
+        self._routes = [
+            (method, re.compile(f'(?:^|/){pattern}/?$'), name)
+            for method, pattern, name in self.routes
+        ]
+
+    def route(self, request: Request) -> Optional[str]:
+        for method, pattern, name in self._routes:
+            if method != request.method:
+                continue
+            match = pattern.search(request.path)
+            if match:
+                request.params = match.groupdict()
+                return name
+        return None
+
+    def handle(self, request: Request) -> Reply:
+        name = self.route(request)
+        if name is None:
+            return 404, {'error': 'not_found', 'path': request.path}, dict()
+
+        behaviour = self.endpoints.get(name, self.behaviour)
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+        if behaviour.throttled():
+            return 429, {'error': 'too_many_requests'}, {'Retry-After': '1'}
+        delay = behaviour.delay()
+        if delay:
+            time.sleep(delay)
+        if behaviour.fails():
+            return 500, {'error': 'internal_server_error'}, dict()
+        return getattr(self, f'on_{name}')(request)
+
+    def token(self, size: int = 28) -> str:
+        alphabet = (
+            'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+        )
+        with self.lock:
+            return ''.join(self.random.choice(alphabet) for _ in range(size))
+
+    def chance(self, probability: float) -> bool:
+        with self.lock:
+            return self.random.random() < probability
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'geopayment-simulator'
+    # headers and body are separate writes, without it keep-alive
+    # connections wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def setup(self) -> None:
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.do_handshake()
+        super().setup()
+
+    def _dispatch(self, body: bool = True) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        request_body = self.rfile.read(length) if length else b''
+        client_cert = None
+        if isinstance(self.connection, ssl.SSLSocket):
+            client_cert = self.connection.getpeercert()
+        request = Request(
+            self.command, self.path,
+            {k.lower(): v for k, v in self.headers.items()},
+            request_body, client_cert
+        )
+        status, content, headers = self.server.simulator.handle(request)
+        if isinstance(content, (dict, list)):
+            content = json.dumps(content).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            content = content or b''
+            content_type = 'text/plain; charset=utf-8'
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    def do_HEAD(self) -> None:
+        # headers only, the connection is kept alive like by a bank
+        self._dispatch(body=False)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class SimulatorServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server for a simulator, with TLS when `certfile` is set
+    and mutual TLS when `client_ca` is set as well.
+
+    >>> with SimulatorServer(TBCEcommSimulator()) as server:
+    ...     server.url
+    'http://127.0.0.1:54321'
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, simulator: Simulator, host: str = '127.0.0.1',
+                 port: int = 0, certfile: Optional[str] = None,
+                 keyfile: Optional[str] = None,
+                 client_ca: Optional[str] = None) -> None:
+        super().__init__((host, port), _Handler)
+        self.simulator = simulator
+        self.scheme = 'http'
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            if client_ca:
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(client_ca)
+            self.socket = context.wrap_socket(
+                self.socket, server_side=True, do_handshake_on_connect=False
+            )
+            self.scheme = 'https'
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'{self.scheme}://{host}:{port}'
+
+    def handle_error(self, request, client_address) -> None:
+        # failed handshakes and dropped connections are expected under load
+        pass
+
+    def start(self) -> 'SimulatorServer':
+        self._thread = threading.Thread(
+            target=self.serve_forever, name=type(self.simulator).__name__,
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> 'SimulatorServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
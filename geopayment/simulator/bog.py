@@ -0,0 +1,236 @@
+"""
+BOG iPay checkout and installment simulator.
+"""
+import time
+from base64 import b64encode
+from decimal import Decimal
+from typing import Dict, Optional
+
+from geopayment.simulator.base import Reply, Request, Simulator
+
+
+__all__ = ['IPaySimulator']
+
+
+class _Order(object):
+    __slots__ = ('order_id', 'intent', 'shop_order_id', 'items', 'amount',
+                 'currency', 'status', 'refunded', 'payment_hash',
+                 'installment')
+
+    def __init__(self, order_id: str, data: Dict, amount: Decimal,
+                 currency: str, installment: bool = False) -> None:
+        self.order_id = order_id
+        self.intent = data.get('intent')
+        self.shop_order_id = data.get('shop_order_id')
+        self.items = data.get('items') or data.get('cart_items') or list()
+        self.amount = amount
+        self.currency = currency
+        self.status = 'CREATED'
+        self.refunded = Decimal(0)
+        self.payment_hash = None
+        self.installment = installment
+
+
+class IPaySimulator(Simulator):
+    """
+    BOG iPay API, orders are `CREATED` until the customer pays, `complete`
+    settles them; with `auto_complete` the first status or details lookup
+    does it, approving with `approve_rate` probability.
+
+    CREATED -> PERFORMED (success) | REJECTED (error)
+    PERFORMED -> PARTIALLY_REFUNDED -> REFUNDED
+    """
+
+    routes = (
+        ('POST', r'oauth2/token', 'token'),
+        ('POST', r'checkout/orders', 'checkout'),
+        ('POST', r'installment/checkout', 'installment_checkout'),
+        ('POST', r'services/installment/calculate', 'calculate'),
+        ('POST', r'checkout/refund', 'refund'),
+        ('GET', r'checkout/orders/status/(?P<order_id>[^/]+)', 'status'),
+        ('GET', r'checkout/orders/(?P<order_id>[^/]+)', 'details'),
+        ('GET', r'checkout/payment/(?P<order_id>[^/]+)', 'payment'),
+    )
+
+    def __init__(self, client_id: Optional[str] = None,
+                 secret_key: Optional[str] = None, auto_complete: bool = True,
+                 approve_rate: float = 1.0, token_ttl: int = 3600,
+                 **kwargs) -> None:
+        """
+        :param client_id: accepted client id, any client when not set
+        :param secret_key: accepted client secret key
+        """
+        super().__init__(**kwargs)
+        self.credentials = None
+        if client_id is not None:
+            self.credentials = b64encode(
+                f'{client_id}:{secret_key}'.encode()
+            ).decode()
+        self.auto_complete = auto_complete
+        self.approve_rate = approve_rate
+        self.token_ttl = token_ttl
+        self.tokens: Dict[str, float] = dict()
+        self.orders: Dict[str, _Order] = dict()
+
+    def _unauthorized(self) -> Reply:
+        return 401, {'error': 'invalid_token'}, dict()
+
+    def _authorized(self, request: Request) -> bool:
+        with self.lock:
+            expires = self.tokens.get(request.bearer)
+        return expires is not None and expires > time.time()
+
+    def on_token(self, request: Request) -> Reply:
+        if request.basic is None or (
+                self.credentials and request.basic != self.credentials):
+            return 401, {'error': 'invalid_client'}, dict()
+        token = self.token(64)
+        expires = time.time() + self.token_ttl
+        with self.lock:
+            self.tokens[token] = expires
+        return 200, {
+            'access_token': token,
+            'token_type': 'Bearer',
+            'app_id': '1A2019',
+            'expires_in': int(expires * 1000),
+        }, dict()
+
+    def _create(self, request: Request, installment: bool) -> Reply:
+        data = request.json() or dict()
+        try:
+            unit = data['purchase_units'][0]['amount']
+            amount = Decimal(unit['value'])
+            currency = unit['currency_code']
+        except (KeyError, IndexError, TypeError, ArithmeticError):
+            return 400, {'error': 'invalid purchase_units'}, dict()
+        order_id = self.token(40).lower()
+        order = _Order(order_id, data, amount, currency, installment)
+        order.payment_hash = self.token(40).lower()
+        with self.lock:
+            self.orders[order_id] = order
+        rel = 'target' if installment else 'approve'
+        return 200, {
+            'status': order.status,
+            'payment_hash': order.payment_hash,
+            'order_id': order_id,
+            'links': [
+                {'href': f'{request.path}/{order_id}', 'rel': 'self',
+                 'method': 'GET'},
+                {'href': f'https://ipay.local/?order_id={order_id}',
+                 'rel': rel, 'method': 'REDIRECT'},
+            ],
+        }, dict()
+
+    def on_checkout(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._unauthorized()
+        return self._create(request, installment=False)
+
+    def on_installment_checkout(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._unauthorized()
+        return self._create(request, installment=True)
+
+    def on_calculate(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._unauthorized()
+        amount = Decimal((request.json() or dict()).get('amount') or 0)
+        discounts = [
+            {
+                'month': month,
+                'amount': str((amount / month).quantize(Decimal('.01'))),
+                'discount_code': f'MONTH_{month}',
+            }
+            for month in (3, 6, 12, 24)
+        ]
+        return 200, {'discounts': discounts}, dict()
+
+    def complete(self, order_id: str, approved: bool = True) -> None:
+        """
+        Simulate the customer finishing (or failing) the payment page.
+        """
+        with self.lock:
+            order = self.orders[order_id]
+            order.status = 'PERFORMED' if approved else 'REJECTED'
+
+    def _order(self, request: Request) -> Optional[_Order]:
+        with self.lock:
+            order = self.orders.get(request.params['order_id'])
+            if order and order.status == 'CREATED' and self.auto_complete:
+                approved = self.chance(self.approve_rate)
+                order.status = 'PERFORMED' if approved else 'REJECTED'
+        return order
+
+    def on_status(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._unauthorized()
+        order = self._order(request)
+        if order is None:
+            return 404, {'error': 'order not found'}, dict()
+        status = {
+            'CREATED': 'in_progress', 'REJECTED': 'error',
+        }.get(order.status, 'success')
+        return 200, {
+            'status': status,
+            'payment_hash': order.payment_hash,
+            'ipay_payment_id': order.order_id,
+            'status_description': order.status,
+            'shop_order_id': order.shop_order_id,
+            'payment_method': 'BOG_CARD',
+            'card_type': 'VISA',
+        }, dict()
+
+    def on_details(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._unauthorized()
+        order = self._order(request)
+        if order is None:
+            return 404, {'error': 'order not found'}, dict()
+        return 200, {
+            'order_id': order.order_id,
+            'status': order.status,
+            'intent': order.intent,
+            'shop_order_id': order.shop_order_id,
+            'items': order.items,
+            'purchase_units': [{'amount': {
+                'currency_code': order.currency, 'value': str(order.amount)
+            }}],
+        }, dict()
+
+    def on_payment(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._unauthorized()
+        order = self._order(request)
+        if order is None:
+            return 404, {'error': 'order not found'}, dict()
+        return 200, {
+            'order_id': order.order_id,
+            'status': order.status,
+            'amount': str(order.amount),
+            'refunded_amount': str(order.refunded),
+            'currency': order.currency,
+            'pan': '4***********1111',
+            'transaction_id': order.payment_hash,
+        }, dict()
+
+    def on_refund(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._unauthorized()
+        form = request.form()
+        with self.lock:
+            order = self.orders.get(form.get('order_id', ''))
+            if order is None:
+                return 404, {'error': 'order not found'}, dict()
+            try:
+                amount = Decimal(form.get('amount') or order.amount)
+            except ArithmeticError:
+                return 400, {'error': 'invalid amount'}, dict()
+            if order.status not in ('PERFORMED', 'PARTIALLY_REFUNDED') or \
+                    amount > order.amount - order.refunded:
+                return 400, {'error': 'refund is not allowed'}, dict()
+            order.refunded += amount
+            order.status = (
+                'REFUNDED' if order.refunded == order.amount
+                else 'PARTIALLY_REFUNDED'
+            )
+        return 200, dict(), dict()
@@ -0,0 +1,88 @@
+"""
+Self-signed CA, server and client certificates for mutual TLS with the
+simulators. Requires `cryptography`.
+"""
+import datetime
+import os
+from typing import Dict
+
+
+__all__ = ['generate_certificates']
+
+
+def generate_certificates(directory: str, host: str = '127.0.0.1',
+                          days: int = 30) -> Dict[str, str]:
+    """
+    :param directory: output directory
+    :param host: server host name or ip address
+    :param days: certificates validity
+    :return: paths of `ca`, `server_cert`, `server_key`, `client_cert`
+             and `client_key` pem files
+    """
+    import ipaddress
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+    now = datetime.datetime.utcnow()
+
+    def name(common_name):
+        return x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, common_name)
+        ])
+
+    def issue(subject, key, issuer, issuer_key, ca=False, extensions=()):
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(issuer)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(minutes=5))
+            .not_valid_after(now + datetime.timedelta(days=days))
+            .add_extension(
+                x509.BasicConstraints(ca=ca, path_length=None), critical=True
+            )
+        )
+        for extension in extensions:
+            builder = builder.add_extension(extension, critical=False)
+        return builder.sign(issuer_key, hashes.SHA256())
+
+    try:
+        alt_name = x509.IPAddress(ipaddress.ip_address(host))
+    except ValueError:
+        alt_name = x509.DNSName(host)
+
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca_name = name('geopayment simulator CA')
+    ca = issue(ca_name, ca_key, ca_name, ca_key, ca=True)
+
+    server_key = ec.generate_private_key(ec.SECP256R1())
+    server = issue(name(host), server_key, ca_name, ca_key, extensions=(
+        x509.SubjectAlternativeName([alt_name]),
+        x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]),
+    ))
+
+    client_key = ec.generate_private_key(ec.SECP256R1())
+    client_usage = x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH])
+    client = issue(name('geopayment merchant'), client_key, ca_name, ca_key,
+                   extensions=(client_usage,))
+
+    os.makedirs(directory, exist_ok=True)
+    paths = dict()
+    for label, obj in (('ca', ca), ('server_cert', server),
+                       ('client_cert', client)):
+        paths[label] = os.path.join(directory, f'{label}.pem')
+        with open(paths[label], 'wb') as f:
+            f.write(obj.public_bytes(serialization.Encoding.PEM))
+    for label, key in (('server_key', server_key), ('client_key', client_key)):
+        paths[label] = os.path.join(directory, f'{label}.pem')
+        with open(paths[label], 'wb') as f:
+            f.write(key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()
+            ))
+    return paths
@@ -0,0 +1,428 @@
+"""
+TBC ECOMM merchant handler and TBC online installments simulators.
+"""
+import time
+from base64 import b64encode
+from typing import Dict, List, Optional
+
+from geopayment.simulator.base import Reply, Request, Simulator
+
+
+__all__ = ['TBCEcommSimulator', 'TBCInstallmentSimulator']
+
+
+def _ecomm(**fields: object) -> str:
+    return '\n'.join(f'{k}: {v}' for k, v in fields.items())
+
+
+class _Transaction(object):
+    __slots__ = ('trans_id', 'command', 'msg_type', 'amount', 'currency',
+                 'result', 'result_code', 'refunded', 'biller_client_id',
+                 'rrn', 'approval_code')
+
+    def __init__(self, trans_id: str, command: str, msg_type: str,
+                 amount: int, currency: str) -> None:
+        self.trans_id = trans_id
+        self.command = command
+        self.msg_type = msg_type
+        self.amount = amount
+        self.currency = currency
+        self.result = 'CREATED'
+        self.result_code = ''
+        self.refunded = 0
+        self.biller_client_id = None
+        self.rrn = ''
+        self.approval_code = ''
+
+
+class TBCEcommSimulator(Simulator):
+    """
+    TBC ECOMM `MerchantHandler`, every command is a form POST with
+    a `command` field, answers are `KEY: value` lines.
+
+    Registered transactions wait for the cardholder, `complete` settles
+    them; with `auto_complete` the first status check does it, approving
+    with `approve_rate` probability.
+
+    SMS: v -> (cardholder) -> OK, then r (reversal) or k (refund)
+    DMS: a -> (cardholder) -> OK (blocked), t -> OK (captured)
+    """
+
+    routes = (('POST', r'MerchantHandler', 'command'),)
+
+    commands = {
+        'v': 'register', 'a': 'register', 'z': 'register', 'd': 'register',
+        'p': 'register', 'c': 'status', 't': 'confirm', 'r': 'reversal',
+        'k': 'refund', 'e': 'recurring', 'f': 'recurring',
+        'g': 'refund_to_card', 'b': 'end_of_business_day',
+    }
+
+    def __init__(self, auto_complete: bool = True, approve_rate: float = 1.0,
+                 require_client_cert: bool = False, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.auto_complete = auto_complete
+        self.approve_rate = approve_rate
+        self.require_client_cert = require_client_cert
+        self.transactions: Dict[str, _Transaction] = dict()
+        self.billers: Dict[str, str] = dict()
+        self._day = {'debit': 0, 'debit_amount': 0,
+                     'credit': 0, 'credit_amount': 0}
+
+    def on_command(self, request: Request) -> Reply:
+        if self.require_client_cert and not request.client_cert:
+            return 403, _ecomm(error='client certificate required'), dict()
+        form = request.form()
+        command = form.get('command')
+        name = self.commands.get(command)
+        if name is None:
+            return 200, _ecomm(error=f'unknown command {command}'), dict()
+        with self.lock:
+            return 200, getattr(self, f'_{name}')(form), dict()
+
+    def complete(self, trans_id: str, approved: bool = True) -> None:
+        """
+        Simulate the cardholder finishing (or failing) the bank page.
+        """
+        with self.lock:
+            self._complete(self.transactions[trans_id], approved)
+
+    def _complete(self, trans: _Transaction, approved: bool) -> None:
+        if approved:
+            trans.result, trans.result_code = 'OK', '000'
+            trans.rrn = str(int(time.time() * 1000))[-12:]
+            trans.approval_code = self.token(6).upper()
+            if trans.msg_type != 'DMS' and trans.amount:
+                self._day['debit'] += 1
+                self._day['debit_amount'] += trans.amount
+            if trans.biller_client_id:
+                self.billers[trans.biller_client_id] = trans.trans_id
+        else:
+            trans.result, trans.result_code = 'FAILED', '116'
+
+    def _required(self, form: Dict[str, str], *names: str) -> Optional[str]:
+        for name in names:
+            if not form.get(name):
+                return _ecomm(error=f'{name} is required')
+        return None
+
+    def _amount(self, form: Dict[str, str]) -> int:
+        try:
+            return int(form.get('amount') or 0)
+        except ValueError:
+            return -1
+
+    def _register(self, form: Dict[str, str]) -> str:
+        command = form['command']
+        error = self._required(form, 'currency', 'client_ip_addr')
+        if command != 'p':
+            error = error or self._required(form, 'amount')
+        if command in ('z', 'd', 'p'):
+            error = error or self._required(form, 'biller_client_id')
+        if error:
+            return error
+        amount = self._amount(form)
+        if amount < 0:
+            return _ecomm(error='wrong amount')
+        msg_type = form.get('msg_type') or ('DMS' if command == 'a' else 'SMS')
+        trans = _Transaction(
+            f'{self.token(27)}=', command, msg_type, amount, form['currency']
+        )
+        trans.biller_client_id = form.get('biller_client_id')
+        self.transactions[trans.trans_id] = trans
+        return _ecomm(TRANSACTION_ID=trans.trans_id)
+
+    def _find(self, form: Dict[str, str]) -> Optional[_Transaction]:
+        return self.transactions.get(form.get('trans_id', ''))
+
+    def _status(self, form: Dict[str, str]) -> str:
+        trans = self._find(form)
+        if trans is None:
+            return _ecomm(error='wrong transaction id')
+        if trans.result == 'CREATED' and self.auto_complete:
+            self._complete(trans, self.chance(self.approve_rate))
+        fields = {'RESULT': trans.result, 'RESULT_CODE': trans.result_code}
+        if trans.result != 'CREATED':
+            fields.update({
+                '3DSECURE': 'ATTEMPTED',
+                'RRN': trans.rrn,
+                'APPROVAL_CODE': trans.approval_code,
+                'CARD_NUMBER': '4***********1111',
+            })
+        if trans.biller_client_id and trans.result == 'OK':
+            fields['RECC_PMNT_ID'] = trans.biller_client_id
+        return _ecomm(**fields)
+
+    def _confirm(self, form: Dict[str, str]) -> str:
+        trans = self._find(form)
+        if trans is None:
+            return _ecomm(error='wrong transaction id')
+        if trans.msg_type != 'DMS' or trans.result != 'OK':
+            return _ecomm(RESULT='FAILED', RESULT_CODE='914')
+        amount = self._amount(form)
+        if amount <= 0 or amount > trans.amount:
+            return _ecomm(error='wrong amount')
+        trans.msg_type, trans.amount = 'SMS', amount
+        self._day['debit'] += 1
+        self._day['debit_amount'] += amount
+        return _ecomm(
+            RESULT='OK', RESULT_CODE='000', RRN=trans.rrn,
+            APPROVAL_CODE=trans.approval_code, CARD_NUMBER='4***********1111'
+        )
+
+    def _reverse(self, trans: _Transaction, amount: int) -> None:
+        trans.refunded += amount
+        if trans.msg_type == 'SMS':
+            self._day['credit'] += 1
+            self._day['credit_amount'] += amount
+        if trans.refunded >= trans.amount:
+            trans.result = 'REVERSED'
+
+    def _reversal(self, form: Dict[str, str]) -> str:
+        trans = self._find(form)
+        if trans is None:
+            return _ecomm(error='wrong transaction id')
+        amount = self._amount(form) or trans.amount
+        if trans.result != 'OK' or amount > trans.amount - trans.refunded:
+            return _ecomm(RESULT='FAILED', RESULT_CODE='914')
+        self._reverse(trans, amount)
+        return _ecomm(RESULT='OK', RESULT_CODE='400')
+
+    def _refund(self, form: Dict[str, str]) -> str:
+        trans = self._find(form)
+        if trans is None:
+            return _ecomm(error='wrong transaction id')
+        amount = self._amount(form) or trans.amount
+        if trans.result != 'OK' or amount > trans.amount - trans.refunded:
+            return _ecomm(RESULT='FAILED', RESULT_CODE='914')
+        self._reverse(trans, amount)
+        return _ecomm(
+            RESULT='OK', RESULT_CODE='000',
+            REFUND_TRANS_ID=f'{self.token(27)}='
+        )
+
+    def _refund_to_card(self, form: Dict[str, str]) -> str:
+        trans = self._find(form)
+        if trans is None:
+            return _ecomm(error='wrong transaction id')
+        amount = self._amount(form)
+        if amount <= 0:
+            return _ecomm(error='wrong amount')
+        self._day['credit'] += 1
+        self._day['credit_amount'] += amount
+        return _ecomm(
+            REFUND_TRANS_ID=f'{self.token(27)}=', RESULT='OK',
+            RESULT_CODE='000'
+        )
+
+    def _recurring(self, form: Dict[str, str]) -> str:
+        error = self._required(form, 'biller_client_id', 'amount', 'currency')
+        if error:
+            return error
+        if form['biller_client_id'] not in self.billers:
+            return _ecomm(error='biller_client_id is not registered')
+        amount = self._amount(form)
+        if amount <= 0:
+            return _ecomm(error='wrong amount')
+        msg_type = 'DMS' if form['command'] == 'f' else 'SMS'
+        trans = _Transaction(
+            f'{self.token(27)}=', form['command'], msg_type, amount,
+            form['currency']
+        )
+        self.transactions[trans.trans_id] = trans
+        self._complete(trans, self.chance(self.approve_rate))
+        return _ecomm(
+            TRANSACTION_ID=trans.trans_id, RESULT=trans.result,
+            RESULT_CODE=trans.result_code, RRN=trans.rrn,
+            APPROVAL_CODE=trans.approval_code
+        )
+
+    def _end_of_business_day(self, form: Dict[str, str]) -> str:
+        day = self._day
+        self._day = {'debit': 0, 'debit_amount': 0,
+                     'credit': 0, 'credit_amount': 0}
+        return _ecomm(
+            RESULT='OK', RESULT_CODE='500',
+            FLD_074=0, FLD_075=day['credit'], FLD_076=day['debit'],
+            FLD_077=0, FLD_086=0, FLD_087=day['credit_amount'],
+            FLD_088=day['debit_amount'], FLD_089=0
+        )
+
+
+class _Application(object):
+    __slots__ = ('session_id', 'merchant_key', 'invoice_id', 'amount',
+                 'status_id')
+
+    def __init__(self, session_id: str, merchant_key: str, invoice_id: str,
+                 amount: str) -> None:
+        self.session_id = session_id
+        self.merchant_key = merchant_key
+        self.invoice_id = invoice_id
+        self.amount = amount
+        self.status_id = 1
+
+
+class TBCInstallmentSimulator(Simulator):
+    """
+    TBC online installments API. Status ids are simulator values:
+
+    1 - created, 3 - approved by customer, waiting for merchant confirm,
+    5 - rejected, 7 - cancelled by merchant, 9 - confirmed from both sides.
+    Created applications become approved (or rejected) on the first status
+    lookup when `auto_complete` is on.
+    """
+
+    routes = (
+        ('POST', r'oauth/token', 'token'),
+        ('POST', r'v1/online-installments/applications', 'create'),
+        ('POST', r'v1/online-installments/applications/(?P<session_id>[^/]+)'
+                 r'/(?P<action>confirm|cancel|status)', 'application'),
+        ('POST', r'v1/online-installments/merchant/applications/'
+                 r'status-changes', 'statuses'),
+        ('POST', r'v1/online-installments/merchant/applications/'
+                 r'status-changes-sync', 'status_sync'),
+    )
+
+    descriptions = {
+        1: 'Application created',
+        3: 'Approved, waiting for merchant confirmation',
+        5: 'Rejected',
+        7: 'Cancelled by merchant',
+        9: 'Installment pending Disbursed (Confirmed from both side)',
+    }
+
+    def __init__(self, key: Optional[str] = None, secret: Optional[str] = None,
+                 auto_complete: bool = True, approve_rate: float = 1.0,
+                 token_ttl: int = 7775999, **kwargs) -> None:
+        """
+        :param key: accepted api key, any key when not set
+        :param secret: accepted api secret
+        """
+        super().__init__(**kwargs)
+        self.credentials = None
+        if key is not None:
+            self.credentials = b64encode(f'{key}:{secret}'.encode()).decode()
+        self.auto_complete = auto_complete
+        self.approve_rate = approve_rate
+        self.token_ttl = token_ttl
+        self.tokens: Dict[str, float] = dict()
+        self.applications: Dict[str, _Application] = dict()
+        self.changes: List[str] = list()
+        self.syncs: Dict[str, List[str]] = dict()
+
+    def _fault(self, status: int, message: str) -> Reply:
+        return status, {'fault': {'faultstring': message}}, dict()
+
+    def _authorized(self, request: Request) -> bool:
+        token = request.bearer
+        with self.lock:
+            expires = self.tokens.get(token)
+        return expires is not None and expires > time.time()
+
+    def on_token(self, request: Request) -> Reply:
+        if request.basic is None or (
+                self.credentials and request.basic != self.credentials):
+            return self._fault(401, 'Invalid ApiKey')
+        form = request.form()
+        if form.get('grant_type') != 'client_credentials':
+            return 400, {'error': 'unsupported_grant_type'}, dict()
+        token = self.token(28)
+        issued_at = int(time.time() * 1000)
+        with self.lock:
+            self.tokens[token] = time.time() + self.token_ttl / 1000
+        return 200, {
+            'access_token': token,
+            'token_type': 'BearerToken',
+            'scope': form.get('scope', 'online_installments'),
+            'issued_at': str(issued_at),
+            'expires_in': self.token_ttl,
+        }, dict()
+
+    def on_create(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._fault(401, 'Invalid access token')
+        data = request.json() or dict()
+        for key in ('merchantKey', 'invoiceId', 'products', 'priceTotal'):
+            if key not in data:
+                return 400, {'errors': [f'{key} is required']}, dict()
+        total = sum(int(round(float(p['price']) * 100))
+                    for p in data['products'])
+        if total != int(round(float(data['priceTotal']) * 100)):
+            return 400, {'errors': ['priceTotal mismatch']}, dict()
+
+        session_id = '-'.join(
+            self.token(n).lower() for n in (8, 4, 4, 4, 12)
+        )
+        with self.lock:
+            self.applications[session_id] = _Application(
+                session_id, data['merchantKey'], data['invoiceId'],
+                data['priceTotal']
+            )
+        location = (
+            f'https://tbcinstallment.local/Installment/InitializeNewLoan'
+            f'?sessionId={session_id}'
+        )
+        return 201, {'sessionId': session_id}, {'Location': location}
+
+    def _set_status(self, application: _Application, status_id: int) -> None:
+        application.status_id = status_id
+        self.changes.append(application.session_id)
+
+    def on_application(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._fault(401, 'Invalid access token')
+        action = request.params['action']
+        with self.lock:
+            application = self.applications.get(request.params['session_id'])
+            if application is None:
+                return 404, {'detail': 'Application not found'}, dict()
+            if action == 'status':
+                if application.status_id == 1 and self.auto_complete:
+                    approved = self.chance(self.approve_rate)
+                    self._set_status(application, 3 if approved else 5)
+                return 200, {
+                    'amount': float(application.amount),
+                    'contributionAmount': None,
+                    'statusId': application.status_id,
+                    'description': self.descriptions[application.status_id],
+                }, dict()
+            if application.status_id in (5, 7, 9):
+                return 400, {'detail': 'Application is closed'}, dict()
+            if action == 'confirm':
+                if application.status_id != 3:
+                    return 400, {'detail': 'Application is not approved'}, \
+                        dict()
+                self._set_status(application, 9)
+            else:
+                self._set_status(application, 7)
+        return 200, {'id': None}, dict()
+
+    def on_statuses(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._fault(401, 'Invalid access token')
+        take = int((request.json() or dict()).get('take', 15))
+        with self.lock:
+            sessions = list(dict.fromkeys(self.changes))
+            sync_id = self.token(16)
+            self.syncs[sync_id] = sessions[:take]
+            changes = [
+                {
+                    'sessionId': s,
+                    'statusId': self.applications[s].status_id,
+                    'invoiceId': self.applications[s].invoice_id,
+                }
+                for s in sessions[:take]
+            ]
+        return 200, {
+            'synchronizationRequestId': sync_id,
+            'totalCount': len(sessions),
+            'statusChanges': changes,
+        }, dict()
+
+    def on_status_sync(self, request: Request) -> Reply:
+        if not self._authorized(request):
+            return self._fault(401, 'Invalid access token')
+        sync_id = (request.json() or dict()).get('synchronizationRequestId')
+        with self.lock:
+            synced = set(self.syncs.pop(sync_id, ()))
+            self.changes = [s for s in self.changes if s not in synced]
+        return 200, dict(), dict()
@@ -1,6 +1,8 @@
 import unittest
+from decimal import Decimal
 
-from geopayment import TBCProvider
+from geopayment import CredoProvider, TBCProvider
+from geopayment.providers.transport import StubTransport
 
 
 class TestsTBCProvider(unittest.TestCase):
@@ -298,5 +300,1904 @@ class TestsTBCProvider(unittest.TestCase):
         )
 
 
+class TestsCredoProvider(unittest.TestCase):
+
+    def setUp(self):
+
+        class MyCredoProvider(CredoProvider):
+
+            @property
+            def merchant_id(self):
+                return '7220'
+
+            @property
+            def password(self):
+                return 'secret'
+
+        self.provider = MyCredoProvider()
+        self.products = [
+            {'id': '4634', 'title': 'PHILIPS HP6549/00', 'amount': '2',
+             'price': Decimal('414.00'), 'type': '0'},
+            {'id': '4635', 'title': 'PHILIPS HP6550/00', 'amount': '1',
+             'price': 12.5, 'type': '0'},
+        ]
+
+    def test_check_does_not_mutate_products(self):
+        first = self.provider.check(products=self.products)
+        second = self.provider.check(products=self.products)
+        self.assertEqual(first, second)
+        self.assertEqual(self.products[0]['price'], Decimal('414.00'))
+
+    def test_set_installment_data(self):
+        data = self.provider.set_installment_data(products=self.products)
+        self.assertEqual(data['products'][0]['price'], 41400)
+        self.assertEqual(self.products[0]['price'], Decimal('414.00'))
+        self.assertEqual(
+            data['check'], self.provider.check(products=self.products)
+        )
+
+    def test_sign_many(self):
+        orders = [self.products, self.products[:1]]
+        self.assertEqual(
+            list(self.provider.sign_many(iter(orders))),
+            [self.provider.check(products=o) for o in orders]
+        )
+
+    def test_form_escapes_payload(self):
+        data = self.provider.set_installment_data(
+            products=self.products, orderCode='"><script>', dump=True
+        )
+        html = self.provider.form(data=data).render()
+        self.assertNotIn('"><script>', html)
+        self.assertIn('&quot;&gt;&lt;script&gt;', html)
+
+    def test_form_serializes_once(self):
+        from unittest import mock
+
+        from geopayment.providers.credo.installment import form
+
+        data = {'orderCode': 1, 'products': self.products}
+        installment_form = self.provider.form(data=data)
+        with mock.patch.object(
+            form, 'serialize_value', wraps=form.serialize_value
+        ) as serialize:
+            html = installment_form.render_form()
+            self.assertIn(installment_form.render(), html)
+            self.assertIn(installment_form.escaped, installment_form.input)
+            self.assertEqual(serialize.call_count, 1)
+            installment_form.value = {'orderCode': 2}
+            self.assertIn('orderCode&quot;: 2', installment_form.render())
+            self.assertEqual(serialize.call_count, 2)
+
+    def test_form_fields(self):
+        from geopayment.providers.credo.installment.form import (
+            InstallmentForm
+        )
+
+        class FieldsForm(InstallmentForm):
+            form_fields = ['<input name="a">']
+
+        self.assertTrue(FieldsForm().render().startswith('<input name="a">'))
+        form = FieldsForm()
+        form.form_fields = ['<input name="b">']
+        self.assertTrue(form.render().startswith('<input name="b">'))
+        FieldsForm.form_fields = ['<input name="c">']
+        self.assertTrue(FieldsForm().render().startswith('<input name="c">'))
+
+    def test_form_stream(self):
+        payloads = [{'orderCode': 1}, {'orderCode': 2}]
+        forms = list(self.provider.form.stream(iter(payloads)))
+        self.assertEqual(len(forms), 2)
+        self.assertEqual(
+            forms[1], self.provider.form(data=payloads[1]).render_form()
+        )
+
+
+class TestsMoney(unittest.TestCase):
+
+    def test_parse(self):
+        from geopayment.money import Money
+
+        self.assertEqual(Money.parse(23.45).minor, 2345)
+        self.assertEqual(Money.parse('0.1').minor, 10)
+        self.assertEqual(Money.parse(Decimal('7')).minor, 700)
+        self.assertEqual(Money.parse(5, 981).currency, 'GEL')
+        for amount in ('abc', float('nan'), None, True):
+            with self.assertRaises(ValueError):
+                Money.parse(amount)
+
+    def test_currency_mismatch(self):
+        from geopayment.money import Money
+
+        usd = Money(100, 'USD')
+        self.assertIs(Money.parse(usd, currency=840), usd)
+        with self.assertRaisesRegex(ValueError, 'USD and GEL'):
+            Money.parse(usd, currency='GEL')
+        self.assertEqual(Money.sum([usd, '1'], 'usd'), Money(200, 'USD'))
+        with self.assertRaisesRegex(ValueError, 'USD and GEL'):
+            Money.sum([Money(100), usd])
+
+    def test_rounding(self):
+        from geopayment.money import Money, ROUND_HALF_EVEN, ROUND_UP
+
+        self.assertEqual(Money.parse('0.125', rounding=ROUND_UP).minor, 13)
+        self.assertEqual(
+            Money.parse('0.125', rounding=ROUND_HALF_EVEN).minor, 12
+        )
+        # rounded once on the total, not per amount
+        self.assertEqual(
+            Money.sum(['0.333', '0.333'], rounding=ROUND_UP).minor, 67
+        )
+
+    def test_arithmetic(self):
+        from geopayment.money import Money
+
+        total = sum([Money(150), Money(250)])
+        self.assertEqual(total, Money(400))
+        self.assertEqual((total - Money(1)) * 2, Money(798))
+        self.assertEqual(Money(-5).to_major(), '-0.05')
+        self.assertEqual(str(Money(123456)), '1234.56')
+        with self.assertRaises(ValueError):
+            Money(1, 'GEL') + Money(1, 'USD')
+        with self.assertRaises(AttributeError):
+            total.minor = 1
+
+    def test_comparison_and_currency(self):
+        from geopayment.money import Money
+
+        class Limit(object):
+            def __ge__(self, other):
+                return True
+
+        self.assertTrue(Money(100) < Money(200))
+        # reflected operation of the foreign type is tried
+        self.assertTrue(Money(100) <= Limit())
+        with self.assertRaises(TypeError):
+            Money(100) < 'abc'
+        self.assertEqual(Money(100, 'gel'), Money(100, 981))
+        self.assertEqual(Money(100, ' usd ').currency, 'USD')
+        self.assertEqual(Money(100, '978').currency, 'EUR')
+        for currency in ('XYZ', '999', 643, None):
+            with self.assertRaises(ValueError):
+                Money(100, currency)
+
+    def test_provider_totals(self):
+        from geopayment.benchmarks.fixtures import (
+            BenchIPayProvider, BenchTBCInstallmentProvider
+        )
+        from geopayment.providers.utils import (
+            bog_params, tbc_installment_params
+        )
+
+        def payload(self, **kwargs):
+            return kwargs['payload']
+
+        checkout = bog_params(
+            currency_code='GEL', endpoint='checkout/orders', api='checkout'
+        )(payload)
+        items = [
+            {'amount': 10.1, 'description': 'a', 'quantity': 1,
+             'product_id': '1'},
+            {'amount': Decimal('0.005'), 'description': 'b', 'quantity': 1,
+             'product_id': '2'},
+        ]
+        data = checkout(BenchIPayProvider(), items=items)['json']
+        self.assertEqual(
+            data['purchase_units'][0]['amount']['value'], '10.11'
+        )
+
+        create = tbc_installment_params(
+            endpoint='v1/online-installments/applications', api='create'
+        )(payload)
+        products = [{'name': 'a', 'price': 10.1, 'quantity': 1},
+                    {'name': 'b', 'price': '0.2', 'quantity': 1}]
+        data = create(
+            BenchTBCInstallmentProvider(), products=products, invoice_id='1'
+        )['json']
+        self.assertEqual(data['priceTotal'], '10.30')
+
+
+class TestsTransport(unittest.TestCase):
+
+    def test_stub_transport(self):
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+
+        requests = list()
+
+        def responder(params):
+            requests.append(params)
+            return 200, 'TRANSACTION_ID: NMQfTRLUTne3eywr9YnAU78Qxxw=', None
+
+        class StubbedTBCProvider(BenchTBCProvider):
+            transport = StubTransport(responder)
+
+        provider = StubbedTBCProvider()
+        result = provider.get_trans_id(amount=23.45, currency='GEL')
+        self.assertEqual(
+            result['TRANSACTION_ID'], 'NMQfTRLUTne3eywr9YnAU78Qxxw='
+        )
+        self.assertEqual(result['HTTP_STATUS_CODE'], 200)
+        self.assertEqual(requests[0]['data']['amount'], 2345)
+        self.assertEqual(requests[0]['data']['currency'], 981)
+
+    def test_stateless_result_shape(self):
+        from geopayment.benchmarks.fixtures import (
+            BenchTBCInstallmentProvider,
+        )
+
+        class StubbedInstallmentProvider(BenchTBCInstallmentProvider):
+            transport = StubTransport(lambda params: (
+                201, {'sessionId': 'e4ff7785'},
+                {'location': 'https://localhost/?sessionId=e4ff7785'}
+            ))
+
+        provider = StubbedInstallmentProvider()
+        products = [{'name': 'item', 'price': 10, 'quantity': 1}]
+        stateful = provider.create(
+            access_token='token', products=products, invoice_id='1'
+        )
+        stateless = provider.create(
+            access_token='token', products=products, invoice_id='1',
+            stateless=True
+        )
+        self.assertEqual(stateless, stateful)
+        self.assertEqual(set(stateful), {'session_id', 'redirect_url'})
+        self.assertEqual(provider.http_status_code, 201)
+
+
+class TestsSimulator(unittest.TestCase):
+
+    def test_tbc_ecomm_flow(self):
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.simulator import SimulatorServer, TBCEcommSimulator
+
+        with SimulatorServer(TBCEcommSimulator()) as server:
+
+            class SimulatedTBCProvider(BenchTBCProvider):
+                service_url = f'{server.url}/ecomm2/MerchantHandler'
+
+            provider = SimulatedTBCProvider()
+            provider.get_trans_id(amount=23.45, currency='GEL')
+            status = provider.check_trans_status(trans_id=provider.trans_id)
+            self.assertEqual(status['RESULT'], 'OK')
+            refund = provider.refund_trans(
+                trans_id=provider.trans_id, amount=23.45
+            )
+            self.assertIn('REFUND_TRANS_ID', refund)
+            eod = provider.end_of_business_day()
+            self.assertEqual(eod['FLD_088'], '2345')
+            self.assertEqual(eod['FLD_087'], '2345')
+
+    def test_stateless_shared_provider(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        from geopayment.benchmarks.fixtures import BenchIPayProvider
+        from geopayment.simulator import IPaySimulator, SimulatorServer
+
+        with SimulatorServer(IPaySimulator()) as server:
+
+            class SharedIPayProvider(BenchIPayProvider):
+                access = None
+                stateless = True
+                service_url = f'{server.url}/opay/api/v1/'
+
+            provider = SharedIPayProvider()
+
+            def flow(i):
+                token = provider.get_auth()['access_token']
+                order = provider.checkout(
+                    access_token=token, shop_order_id=str(i),
+                    items=[{'amount': 10, 'description': 'item',
+                            'quantity': 1, 'product_id': str(i)}]
+                )
+                return provider.checkout_status(
+                    access_token=token, order_id=order['order_id']
+                )
+
+            with ThreadPoolExecutor(4) as executor:
+                results = list(executor.map(flow, range(8)))
+
+            self.assertEqual({r['status'] for r in results}, {'success'})
+            self.assertEqual(
+                sorted(r['shop_order_id'] for r in results),
+                sorted(str(i) for i in range(8))
+            )
+            self.assertEqual(vars(provider), dict())
+
+    def test_throttle(self):
+        from geopayment.simulator import Behaviour, Request, IPaySimulator
+
+        simulator = IPaySimulator(behaviour=Behaviour(throttle=1, burst=1))
+        request = Request('POST', '/oauth2/token', dict(), b'')
+        self.assertEqual(simulator.handle(request)[0], 401)
+        self.assertEqual(simulator.handle(request)[0], 429)
+
+
+class TestsProfiling(unittest.TestCase):
+
+    def tearDown(self):
+        from geopayment.providers import profiling
+
+        profiling.disable()
+        profiling.reset()
+
+    def test_call_stages(self):
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers import profiling
+        from geopayment.simulator import SimulatorServer, TBCEcommSimulator
+
+        profiles = list()
+        profiling.enable(callback=profiles.append, attach=True)
+        with SimulatorServer(TBCEcommSimulator()) as server:
+
+            class ProfiledTBCProvider(BenchTBCProvider):
+                service_url = f'{server.url}/ecomm2/MerchantHandler'
+
+            result = ProfiledTBCProvider().get_trans_id(
+                amount=23.45, currency='GEL'
+            )
+
+        self.assertIs(result['PROFILE'], profiles[0])
+        profile = profiles[0]
+        self.assertGreater(profile.params, 0)
+        self.assertGreater(profile.connect, 0)
+        self.assertGreater(profile.wait, 0)
+        self.assertGreaterEqual(
+            profile.total,
+            sum(getattr(profile, s) for s in profiling.STAGES[:-1]) * 0.99
+        )
+        stats = profiling.stats()['ProfiledTBCProvider.get_trans_id']
+        self.assertEqual(stats['count'], 1)
+
+    def test_invalid_params(self):
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers import profiling, slowcalls
+
+        profiling.enable()
+        slowcalls.configure(default=60)
+        self.addCleanup(slowcalls.disable)
+        with self.assertRaises(ValueError):
+            BenchTBCProvider().get_trans_id(currency='GEL')
+        # the next call of the thread does not start at the failed one
+        self.assertIsNone(profiling._local.params_started)
+        self.assertIsNone(slowcalls._local.params_started)
+
+    def test_pooled_connections(self):
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers import profiling
+        from geopayment.providers.transport import PooledTransport
+        from geopayment.simulator import SimulatorServer, TBCEcommSimulator
+
+        transport = PooledTransport()
+        self.addCleanup(transport.close)
+        profiles = list()
+        profiling.enable(callback=profiles.append)
+        with SimulatorServer(TBCEcommSimulator()) as server:
+
+            class PooledTBCProvider(BenchTBCProvider):
+                service_url = f'{server.url}/ecomm2/MerchantHandler'
+
+            PooledTBCProvider.transport = transport
+            provider = PooledTBCProvider()
+            provider.get_trans_id(amount=1, currency='GEL')
+            provider.get_trans_id(amount=1, currency='GEL')
+            self.assertEqual(
+                transport.open(provider.service_url, 3, verify=False), 3
+            )
+            provider.get_trans_id(amount=1, currency='GEL')
+
+        # the profiled calls use the pool of the transport
+        self.assertGreater(profiles[0].connect, 0)
+        self.assertEqual(profiles[1].connect, 0)
+        self.assertEqual(profiles[2].connect, 0)
+
+
+class TestsMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        from geopayment.providers import metrics
+
+        metrics.disable()
+        metrics.REGISTRY.clear()
+
+    def test_calls_from_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers import metrics
+
+        class MeteredTBCProvider(BenchTBCProvider):
+            transport = StubTransport(
+                lambda params: (200, 'RESULT: OK\nRESULT_CODE: 000', None)
+            )
+
+        metrics.enable()
+        provider = MeteredTBCProvider()
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(
+                lambda i: provider.check_trans_status(trans_id=str(i)),
+                range(200)
+            ))
+
+        key = ('MeteredTBCProvider', 'check_trans_status', '200', '000')
+        self.assertEqual(metrics.CALLS.collect()[key], 200)
+        self.assertEqual(
+            metrics.IN_FLIGHT.collect()[key[:2]], 0
+        )
+        text = metrics.exposition()
+        self.assertIn(
+            'geopayment_call_duration_seconds_count{provider='
+            '"MeteredTBCProvider",method="check_trans_status"} 200', text
+        )
+
+    def test_multiprocess(self):
+        import json
+        import os
+        import tempfile
+
+        from geopayment.providers import metrics
+
+        directory = tempfile.mkdtemp()
+        metrics.enable(multiprocess_dir=directory)
+        metrics.token_refreshed('IPayProvider')
+        with open(os.path.join(directory, 'geopayment_1.json'), 'w') as f:
+            json.dump({
+                'geopayment_token_refreshes_total': {
+                    'kind': 'counter', 'values': [[['IPayProvider'], 2]]
+                },
+                'geopayment_calls_in_flight': {
+                    'kind': 'gauge', 'values': [[['IPayProvider', 'x'], 1]]
+                },
+            }, f)
+        metrics.mark_process_dead(1)
+        text = metrics.exposition()
+        self.assertIn(
+            'geopayment_token_refreshes_total{provider="IPayProvider"} 3',
+            text
+        )
+        self.assertNotIn('method="x"', text)
+
+    def test_finished_threads(self):
+        import gc
+        import threading
+
+        from geopayment.providers import metrics
+
+        def work():
+            for _ in range(10):
+                metrics.RETRIES.inc('P', 'm')
+                metrics.DURATION.observe(0.01, 'P', 'm')
+
+        threads = [threading.Thread(target=work) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        gc.collect()
+        self.assertEqual(metrics.RETRIES._shards, [])
+        self.assertEqual(metrics.RETRIES.collect()[('P', 'm')], 500)
+        self.assertEqual(metrics.DURATION.collect()[('P', 'm')][1], 500)
+
+    def test_retries(self):
+        import os
+        import tempfile
+
+        from geopayment.providers import metrics
+        from geopayment.providers.outbox import Outbox
+        from geopayment.providers.tbc.eod import close_terminals
+
+        metrics.enable()
+        self.addCleanup(metrics.REGISTRY.clear)
+        self.addCleanup(metrics.disable)
+        results = iter([
+            {'ERROR': 'unavailable', 'HTTP_STATUS_CODE': 503},
+            {'ERROR': 'unavailable', 'HTTP_STATUS_CODE': 503},
+            {'RESULT': 'OK', 'HTTP_STATUS_CODE': 200},
+        ])
+
+        class FlakyTerminal(object):
+            def refund_trans(self, **kwargs):
+                return next(results)
+
+            def end_of_business_day(self, **kwargs):
+                return next(results)
+
+        terminal = FlakyTerminal()
+        outbox = Outbox(
+            os.path.join(tempfile.mkdtemp(), 'outbox.sqlite3'), [terminal],
+            backoff=0
+        )
+        outbox.defer(terminal, 'refund_trans', trans_id='1', amount=1)
+        # the first replay is not a retry, the two after it are
+        self.assertEqual(outbox.drain()['done'], 1)
+        results = iter([
+            {'ERROR': 'unavailable', 'HTTP_STATUS_CODE': 503},
+            {'RESULT': 'OK', 'HTTP_STATUS_CODE': 200},
+        ])
+        close_terminals([terminal], retries=1, backoff=0)
+        self.assertEqual(metrics.RETRIES.collect(), {
+            ('FlakyTerminal', 'refund_trans'): 2,
+            ('FlakyTerminal', 'end_of_business_day'): 1,
+        })
+
+    def test_concurrent_flushes(self):
+        import os
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+
+        from geopayment.providers import metrics
+
+        directory = tempfile.mkdtemp()
+        metrics.enable(multiprocess_dir=directory, flush_interval=0)
+
+        def calls(i):
+            for _ in range(50):
+                metrics.finish(metrics.start('P', 'm'), 200, dict())
+
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(calls, range(8)))
+        metrics.flush()
+        self.assertEqual(
+            os.listdir(directory), [f'geopayment_{os.getpid()}.json']
+        )
+        self.assertIn(
+            'geopayment_calls_total{provider="P",method="m",status="200",'
+            'code=""} 400', metrics.exposition()
+        )
+
+
+class TestsLogging(unittest.TestCase):
+
+    def tearDown(self):
+        from geopayment.providers import log
+
+        log.configure()
+
+    def test_redaction(self):
+        from geopayment.providers import log
+
+        params = {
+            'method': 'post',
+            'url': 'https://bank.ge/token?access_token=abc&take=15',
+            'headers': {'Authorization': 'Basic dXNlcjpzZWNyZXQ='},
+            'data': {'grant_type': 'client_credentials',
+                     'client_secret': 'secret',
+                     'description': 'card 4111111111111111'},
+            'cert': ('/etc/bank/cert.pem', '/etc/bank/key.pem'),
+        }
+        with self.assertLogs('geopayment.providers', 'INFO') as logs:
+            log.call('TBCInstallmentProvider', 'get_auth', params, 200,
+                     {'access_token': 'abc'}, 0.01)
+        event = logs.records[0].event.as_dict()
+        text = str(event) + logs.output[0]
+        for secret in ('dXNlcjpzZWNyZXQ=', "'secret'", 'abc',
+                       '4111111111111111', '/etc/bank'):
+            self.assertNotIn(secret, text)
+        self.assertEqual(
+            event['payload']['description'], 'card 411111******1111'
+        )
+        self.assertIn('take=15', event['url'])
+
+    def test_sampling(self):
+        import logging
+
+        from geopayment.providers import log
+
+        params = {'method': 'post', 'url': 'https://bank.ge'}
+        log.configure(sample_rates={logging.INFO: 0})
+        with self.assertLogs('geopayment.providers', 'INFO') as logs:
+            for _ in range(100):
+                log.call('TBCProvider', 'get_trans_id', params, 200,
+                         {'TRANSACTION_ID': '1'}, 0.01)
+            log.call('TBCProvider', 'get_trans_id', params, 'N/A',
+                     {'ERROR': 'timeout'}, 0.01)
+        self.assertEqual(
+            [r.levelno for r in logs.records], [logging.ERROR]
+        )
+
+
+class TestsLimits(unittest.TestCase):
+
+    def _provider(self, provider_limits, delay=0.0):
+        import time
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+
+        def responder(params):
+            time.sleep(delay)
+            return 200, 'RESULT: OK\nRESULT_CODE: 000', None
+
+        return type('LimitedTBCProvider', (BenchTBCProvider,), {
+            'transport': StubTransport(responder),
+            'limits': provider_limits,
+        })()
+
+    def test_bulkhead_and_rate(self):
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        from geopayment.providers import metrics
+        from geopayment.providers.limits import Limit
+
+        metrics.enable()
+        self.addCleanup(metrics.REGISTRY.clear)
+        self.addCleanup(metrics.disable)
+        provider = self._provider({
+            'check_trans_status': Limit(concurrency=2, timeout=0.05),
+            '*': Limit(rate=20, burst=1),
+        }, delay=0.2)
+        with ThreadPoolExecutor(6) as executor:
+            results = list(executor.map(
+                lambda i: provider.check_trans_status(trans_id=str(i)),
+                range(6)
+            ))
+        rejected = [r for r in results if 'ERROR' in r]
+        self.assertEqual(len(rejected), 4)
+        self.assertIn('concurrency limit exceeded', rejected[0]['ERROR'])
+        self.assertIs(rejected[0]['SENT'], False)
+        key = ('LimitedTBCProvider', 'check_trans_status', 'concurrency')
+        self.assertEqual(metrics.LIMIT_REJECTIONS.collect()[key], 4)
+
+        provider = self._provider({'*': Limit(rate=20, burst=1)})
+        started = time.monotonic()
+        for _ in range(5):
+            provider.end_of_business_day()
+        self.assertGreaterEqual(time.monotonic() - started, 0.19)
+
+    def test_shared_and_async(self):
+        import asyncio
+        import contextvars
+        import os
+        import uuid
+
+        from geopayment.providers.limits import Limit, Rejected, admit
+
+        name = uuid.uuid4().hex
+        first = Limit(concurrency=1, timeout=0.01, shared=name)
+        second = Limit(concurrency=1, timeout=0.01, shared=name)
+        self.addCleanup(os.remove, first._state.path)
+        first.enter(0.01)
+        self.assertRaises(Rejected, second.enter, 0.01)
+        first.leave()
+        second.enter(0.01)
+        second.leave()
+
+        limit = Limit(concurrency=1, timeout=0.5)
+        provider = self._provider({'*': limit})
+
+        async def check():
+            async with admit(provider, 'check_trans_status'):
+                # the admitted call does not wait for its own slot
+                return await asyncio.get_event_loop().run_in_executor(
+                    None, contextvars.copy_context().run,
+                    lambda: provider.check_trans_status(trans_id='1')
+                )
+
+        result = asyncio.run(check())
+        self.assertEqual(result['RESULT'], 'OK')
+        self.assertTrue(limit.try_enter())
+
+    def test_dead_worker_and_refund(self):
+        import os
+        import uuid
+
+        from geopayment.providers.limits import Limit, Rejected
+
+        name = uuid.uuid4().hex
+        limit = Limit(concurrency=2, timeout=0.01, shared=name)
+        self.addCleanup(os.remove, limit._state.path)
+        pid = os.fork()
+        if not pid:
+            # the worker dies holding both slots
+            limit.enter(0.01)
+            limit.enter(0.01)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        limit.enter(0.01)
+        limit.enter(0.01)
+        self.assertRaises(Rejected, limit.enter, 0.01)
+        limit.leave()
+        limit.leave()
+
+        limit = Limit(rate=1, burst=2, concurrency=1, timeout=0.01)
+        limit.acquire()
+        self.assertRaises(Rejected, limit.acquire)
+        limit.leave()
+        # the call rejected by the bulkhead gave its token back
+        with limit._state.locked() as state:
+            self.assertGreaterEqual(state.tokens, 0.99)
+
+
+class TestsCoalesce(unittest.TestCase):
+
+    def _provider(self, sent):
+        import time
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+
+        def responder(params):
+            sent.append(params['data']['trans_id'])
+            time.sleep(0.1)
+            return 200, 'RESULT: OK\nRESULT_CODE: 000', None
+
+        class CoalescedTBCProvider(BenchTBCProvider):
+            stateless = True
+            transport = StubTransport(responder)
+
+        return CoalescedTBCProvider()
+
+    def test_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        from geopayment.providers import metrics
+
+        metrics.enable()
+        self.addCleanup(metrics.REGISTRY.clear)
+        self.addCleanup(metrics.disable)
+        sent = list()
+        provider = self._provider(sent)
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(
+                lambda i: provider.check_trans_status(trans_id=str(i % 2)),
+                range(8)
+            ))
+        self.assertEqual(sorted(sent), ['0', '1'])
+        self.assertEqual({r['RESULT'] for r in results}, {'OK'})
+        self.assertEqual(len({id(r) for r in results}), 8)
+        self.assertEqual(
+            sum(metrics.COALESCED.collect().values()), 6
+        )
+
+    def test_journal_in_leader(self):
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+
+        from geopayment.providers.journal import Journal
+
+        journal = Journal(tempfile.mkdtemp(), fsync_interval=0)
+        self.addCleanup(journal.close)
+        sent = list()
+        provider = self._provider(sent)
+        provider.journal = journal
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(
+                lambda i: provider.check_trans_status(trans_id='1'),
+                range(4)
+            ))
+        self.assertEqual(sent, ['1'])
+        self.assertEqual(len(journal.history('1')), 1)
+        self.assertEqual(journal.verify()['records'], 1)
+
+    def test_client_ip_and_deadline(self):
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        sent = list()
+        provider = self._provider(sent)
+        with ThreadPoolExecutor(2) as executor:
+            results = list(executor.map(
+                lambda ip: provider.check_trans_status(
+                    trans_id='1', client_ip_addr=ip
+                ),
+                ['10.0.0.1', '10.0.0.2']
+            ))
+        self.assertEqual(sent, ['1'])
+
+        with ThreadPoolExecutor(2) as executor:
+            leader = executor.submit(
+                provider.check_trans_status, trans_id='2'
+            )
+            time.sleep(0.02)
+            started = time.monotonic()
+            # the joined call stops waiting once its deadline is spent
+            results = provider.check_trans_status(
+                trans_id='2', deadline=0.03
+            )
+            self.assertLess(time.monotonic() - started, 0.07)
+            self.assertIn('Deadline exceeded', results['ERROR'])
+            self.assertEqual(leader.result()['RESULT'], 'OK')
+        self.assertEqual(sent, ['1', '2'])
+
+    def test_asyncio(self):
+        import asyncio
+
+        from geopayment.providers import coalesce
+
+        sent = list()
+        provider = self._provider(sent)
+
+        async def check():
+            return await asyncio.gather(*[
+                coalesce.call(provider.check_trans_status, trans_id='1')
+                for _ in range(5)
+            ])
+
+        results = asyncio.run(check())
+        self.assertEqual(sent, ['1'])
+        self.assertEqual(len(results), 5)
+        self.assertEqual(coalesce.in_flight(), 0)
+        self.assertRaises(
+            ValueError, asyncio.run,
+            coalesce.call(provider.refund_trans, trans_id='1', amount=1)
+        )
+
+
+class TestsCache(unittest.TestCase):
+
+    def test_finality(self):
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers.cache import LRUCache
+
+        sent = list()
+        results = iter(['PENDING', 'OK', 'OK', 'OK', 'OK'])
+
+        def responder(params):
+            sent.append(params['data']['command'])
+            if params['data']['command'] == 'k':
+                return 200, 'RESULT: OK\nREFUND_TRANS_ID: 1', None
+            return 200, f'RESULT: {next(results)}\nRESULT_CODE: 000', None
+
+        class CachedTBCProvider(BenchTBCProvider):
+            transport = StubTransport(responder)
+            response_cache = LRUCache(ttl=0)
+
+        provider = CachedTBCProvider()
+        for expected in ('PENDING', 'OK', 'OK'):
+            result = provider.check_trans_status(trans_id='1')
+            self.assertEqual(result['RESULT'], expected)
+        self.assertEqual(sent, ['c', 'c'])
+        provider.check_trans_status(trans_id='2')
+        provider.refund_trans(trans_id='1', amount=1)
+        provider.check_trans_status(trans_id='1')
+        provider.check_trans_status(trans_id='2')
+        provider.check_trans_status(trans_id='2', cached=False)
+        self.assertEqual(sent, ['c', 'c', 'c', 'k', 'c', 'c'])
+
+    def test_sqlite(self):
+        import os
+        import tempfile
+
+        from geopayment.providers.cache import SQLiteCache
+
+        path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite3')
+        backend = SQLiteCache(path)
+        backend.set('final', '1', None)
+        backend.set('expired', '2', -1)
+        self.assertEqual(SQLiteCache(path).get('final'), '1')
+        self.assertIsNone(backend.get('expired'))
+        backend.delete('final')
+        self.assertIsNone(backend.get('final'))
+        self.assertEqual(backend.purge(), 1)
+
+    def test_accounts_and_overwrite(self):
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers.cache import LRUCache
+
+        backend = LRUCache(ttl=60)
+        results = iter(['PENDING', 'PENDING', 'OK'])
+
+        def responder(params):
+            return 200, f'RESULT: {next(results)}\nRESULT_CODE: 000', None
+
+        class FirstTBCProvider(BenchTBCProvider):
+            transport = StubTransport(responder)
+            response_cache = backend
+
+        class SecondTBCProvider(FirstTBCProvider):
+
+            @property
+            def cert(self):
+                return ('/etc/second/cert.pem', '/etc/second/key.pem')
+
+        first, second = FirstTBCProvider(), SecondTBCProvider()
+        SecondTBCProvider.__name__ = 'FirstTBCProvider'
+        first.check_trans_status(trans_id='1')
+        # another merchant account never sees the cached response
+        second.check_trans_status(trans_id='1')
+        self.assertEqual(len(backend), 2)
+        result = first.check_trans_status(trans_id='1', cached=False)
+        self.assertEqual(result['RESULT'], 'OK')
+        result = first.check_trans_status(trans_id='1')
+        self.assertEqual(result['RESULT'], 'OK')
+
+    def test_lookup_during_refund(self):
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers.cache import LRUCache
+
+        backend = LRUCache(ttl=60)
+        reads = list()
+
+        def responder(params):
+            if params['data']['command'] == 'c':
+                # the refund runs while the lookup is in flight
+                provider.refund_trans(trans_id='1', amount=1)
+                return 200, 'RESULT: OK\nRESULT_CODE: 000', None
+            return 200, 'RESULT: OK\nREFUND_TRANS_ID: 1', None
+
+        class CachedTBCProvider(BenchTBCProvider):
+            transport = StubTransport(responder)
+            response_cache = backend
+
+            @property
+            def merchant_id(self):
+                reads.append(1)
+                return 'merchant'
+
+        provider = CachedTBCProvider()
+        provider.check_trans_status(trans_id='1')
+        # the pre-refund final response is not stored
+        self.assertEqual(len(backend), 0)
+        # a refund of another payment does not drop the response
+        provider.check_trans_status(trans_id='2')
+        self.assertEqual(len(backend), 1)
+        self.assertEqual(len(reads), 1)
+
+    def test_replay_in_order(self):
+        import os
+        import tempfile
+
+        import requests
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers.outbox import Outbox
+
+        bank = {'down': True, 'sent': list()}
+
+        def responder(params):
+            if bank['down']:
+                raise requests.exceptions.ConnectTimeout('bank is down')
+            data = params['data']
+            bank['sent'].append((data['trans_id'], data['amount']))
+            return 200, 'RESULT: OK\nREFUND_TRANS_ID: 1', None
+
+        class QueuedTBCProvider(BenchTBCProvider):
+            stateless = True
+            transport = StubTransport(responder)
+
+        provider = QueuedTBCProvider()
+        path = os.path.join(tempfile.mkdtemp(), 'outbox.sqlite3')
+        outbox = Outbox(path, [provider], backoff=0)
+        result = outbox.call(provider, 'refund_trans', trans_id='1', amount=1)
+        self.assertEqual(result['OUTBOX'], 'queued')
+        outbox.call(provider, 'refund_trans', trans_id='1', amount=2)
+        outbox.defer(provider, 'refund_trans', trans_id='1', amount=2)
+        for i in range(2000):
+            outbox.defer(provider, 'refund_trans', trans_id=f't{i % 500}',
+                         amount=i)
+        self.assertEqual(outbox.drain(max_rounds=1)['retry'], 256)
+
+        bank['down'] = False
+        self.assertEqual(outbox.drain()['done'], 2002)
+        self.assertEqual(outbox.stats(), {'done': 2002})
+        sent = [s for s in bank['sent'] if s[0] == '1']
+        self.assertEqual(sent, [('1', 100), ('1', 200)])
+        sent = [s[1] for s in bank['sent'] if s[0] == 't7']
+        self.assertEqual(sent, sorted(sent))
+
+    def test_unknown_outcome(self):
+        import os
+        import tempfile
+        import threading
+        import time
+        from unittest import mock
+
+        import requests
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers.outbox import LEASE_EXPIRED, Outbox
+
+        bank = {'timeout': True, 'sent': list()}
+
+        def responder(params):
+            data = params['data']
+            bank['sent'].append(data['amount'])
+            if bank['timeout']:
+                # the bank may have refunded before the read timed out
+                raise requests.exceptions.ReadTimeout('read timed out')
+            return 200, 'RESULT: OK\nREFUND_TRANS_ID: 1', None
+
+        class QueuedTBCProvider(BenchTBCProvider):
+            stateless = True
+            transport = StubTransport(responder)
+
+        provider = QueuedTBCProvider()
+        path = os.path.join(tempfile.mkdtemp(), 'outbox.sqlite3')
+        outbox = Outbox(path, [provider], backoff=0)
+        result = outbox.call(provider, 'refund_trans', trans_id='1', amount=1)
+        self.assertEqual(result['OUTBOX'], 'unknown')
+        outbox.call(provider, 'refund_trans', trans_id='1', amount=2)
+        bank['timeout'] = False
+        # neither the unknown refund nor the one after it is replayed
+        self.assertEqual(outbox.drain()['done'], 0)
+        self.assertEqual(bank['sent'], [100])
+        self.assertTrue(outbox.resolve(result['OUTBOX_ID'], applied=True))
+        self.assertEqual(outbox.drain()['done'], 1)
+        self.assertEqual(bank['sent'], [100, 200])
+
+        # a drainer claimed the refund and died, it may have been applied
+        crashed = Outbox(path, [provider], backoff=0, lease=0)
+        outbox.defer(provider, 'refund_trans', trans_id='3', amount=4)
+        self.assertEqual(len(crashed._claim(time.time())), 1)
+        self.assertEqual(crashed.drain(), {
+            'done': 0, 'retry': 0, 'failed': 0, 'unknown': 0
+        })
+        self.assertEqual(bank['sent'], [100, 200])
+        self.assertEqual(
+            [o['error'] for o in outbox.operations('unknown')],
+            [LEASE_EXPIRED]
+        )
+
+        seen = list()
+
+        class SharedProvider(object):
+            def refund_trans(self, **kwargs):
+                seen.append(kwargs)
+                return {'RESULT': 'OK', 'HTTP_STATUS_CODE': 200}
+
+        shared = SharedProvider()
+        outbox.defer(shared, 'refund_trans', trans_id='4', amount=5)
+        self.assertEqual(outbox.drain()['done'], 1)
+        self.assertEqual(
+            seen, [{'trans_id': '4', 'amount': 5, 'stateless': True}]
+        )
+
+        drained = threading.Event()
+        calls = iter([RuntimeError('database is locked')])
+
+        def drain():
+            error = next(calls, None)
+            if error is not None:
+                raise error
+            drained.set()
+
+        with mock.patch.object(outbox, 'drain', drain), \
+                self.assertLogs('geopayment.outbox'):
+            outbox.start(interval=0.01)
+            self.assertTrue(drained.wait(1))
+            outbox.stop()
+
+
+class TestsClientIP(unittest.TestCase):
+
+    def test_sources(self):
+        from geopayment.providers.client_ip import ClientIPResolver
+        from geopayment.providers.utils import get_client_ip
+
+        class DjangoRequest(object):
+            META = {'HTTP_X_FORWARDED_FOR': '203.0.113.7, 10.0.0.5',
+                    'REMOTE_ADDR': '10.0.0.2'}
+
+        class StarletteRequest(object):
+            scope = {'type': 'http', 'client': ('10.0.0.2', 5000),
+                     'headers': [(b'x-forwarded-for', b'203.0.113.7')]}
+
+        self.assertEqual(get_client_ip(DjangoRequest()), '203.0.113.7')
+        self.assertEqual(get_client_ip(StarletteRequest()), '203.0.113.7')
+        self.assertEqual(get_client_ip({'REMOTE_ADDR': '198.51.100.1'}),
+                         '198.51.100.1')
+
+        resolver = ClientIPResolver(['10.0.0.0/8', '2001:db8::/32'])
+        headers = {'x-forwarded-for': '[2001:db9::1]:443, 2001:db8::5'}
+        self.assertEqual(resolver.resolve(headers, '10.1.1.1'),
+                         '2001:db9::1')
+        self.assertTrue(resolver.is_trusted('::ffff:10.1.2.3'))
+        self.assertFalse(resolver.is_trusted('11.0.0.1'))
+        with self.assertRaises(ValueError):
+            ClientIPResolver(['10.0.0.0/33'])
+        resolver = ClientIPResolver(n for n in ['10.0.0.0/8'])
+        self.assertEqual(resolver.trusted_proxies, ('10.0.0.0/8',))
+        self.assertTrue(resolver.is_trusted('10.1.2.3'))
+
+    def test_spoofed_hops(self):
+        from geopayment.providers.client_ip import ClientIPResolver
+
+        resolver = ClientIPResolver(['10.0.0.0/8'])
+        environ = {'HTTP_X_FORWARDED_FOR': '1.1.1.1, 203.0.113.7, 10.0.0.5',
+                   'REMOTE_ADDR': '10.0.0.2'}
+        self.assertEqual(resolver(environ), '203.0.113.7')
+        # not a proxy, its header is ignored
+        environ['REMOTE_ADDR'] = '198.51.100.1'
+        self.assertEqual(resolver(environ), '198.51.100.1')
+        environ = {'HTTP_X_FORWARDED_FOR': 'unknown, 10.0.0.5',
+                   'REMOTE_ADDR': '10.0.0.2'}
+        self.assertEqual(resolver(environ), '10.0.0.5')
+
+
+class TestsWarmUp(unittest.TestCase):
+
+    def test_connections_and_tokens(self):
+        from geopayment.benchmarks.fixtures import BenchIPayProvider
+        from geopayment.providers import warmup
+        from geopayment.providers.transport import PooledTransport
+        from geopayment.simulator import IPaySimulator, SimulatorServer
+
+        transport = PooledTransport()
+        statuses = list()
+        probe = warmup.make_wsgi_app()
+        warmup.reset()
+        self.addCleanup(warmup.reset)
+        self.addCleanup(transport.close)
+
+        with SimulatorServer(IPaySimulator()) as server:
+
+            class WarmIPayProvider(BenchIPayProvider):
+                access = None
+                service_url = f'{server.url}/opay/api/v1/'
+
+            WarmIPayProvider.transport = transport
+            provider = WarmIPayProvider()
+            probe(dict(), lambda status, headers: statuses.append(status))
+            report = warmup.warm_up([provider], connections=3)
+            probe(dict(), lambda status, headers: statuses.append(status))
+
+            self.assertEqual(report['WarmIPayProvider']['connections'], 3)
+            self.assertTrue(report['WarmIPayProvider']['token'])
+            self.assertIn('access_token', provider.access)
+            self.assertTrue(warmup.ready())
+            self.assertEqual(
+                statuses, ['503 Service Unavailable', '200 OK']
+            )
+            pools = transport.session.get_adapter(
+                server.url
+            ).poolmanager.pools
+            # the token request reused a pre-opened connection
+            self.assertEqual(
+                [pools[k].num_connections for k in pools.keys()], [3]
+            )
+
+    def test_skipped_transport(self):
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers import warmup
+
+        warmup.reset()
+        self.addCleanup(warmup.reset)
+
+        class StubTBCProvider(BenchTBCProvider):
+            transport = StubTransport(lambda params: (200, '', None))
+
+        report = warmup.warm_up([StubTBCProvider()], connections=3)
+        result = report['StubTBCProvider']
+        self.assertEqual(result['connections'], 0)
+        self.assertIn('StubTransport', result['skipped'])
+        self.assertIsNone(result['error'])
+
+
+class TestsDeadline(unittest.TestCase):
+
+    def test_budget_shrinks_timeouts(self):
+        import time
+
+        from geopayment.benchmarks.fixtures import (
+            BenchIPayProvider,
+            BenchTBCProvider,
+        )
+        from geopayment.providers.deadline import budget
+
+        timeouts = list()
+
+        def responder(params):
+            timeouts.append(params['timeout'])
+            time.sleep(0.1)
+            if 'oauth2/token' in params['url']:
+                return 200, {'access_token': 'token'}, None
+            return 200, 'RESULT: OK', None
+
+        class DeadlineTBCProvider(BenchTBCProvider):
+            transport = StubTransport(responder)
+
+        class DeadlineIPayProvider(BenchIPayProvider):
+            transport = DeadlineTBCProvider.transport
+
+        provider = DeadlineTBCProvider()
+        provider.check_trans_status(trans_id='1')
+        self.assertEqual(timeouts.pop(), (3, 10))
+
+        with budget(0.08):
+            provider.check_trans_status(trans_id='1')
+            self.assertLessEqual(max(timeouts.pop()), 0.08)
+            result = provider.check_trans_status(trans_id='1')
+        self.assertTrue(result['ERROR'].startswith('Deadline exceeded'))
+        self.assertEqual(timeouts, [])
+
+        ipay = DeadlineIPayProvider()
+        ipay.get_auth(deadline=0.5)
+        self.assertLessEqual(max(timeouts.pop()), 0.5)
+        with budget(5):
+            ipay.get_auth(deadline=30)
+            self.assertLessEqual(max(timeouts.pop()), 5)
+        result = ipay.get_auth(deadline=0)
+        self.assertIn('ERROR', result)
+        self.assertEqual(timeouts, [])
+
+
+class TestsEndOfBusinessDay(unittest.TestCase):
+
+    def test_default_workers(self):
+        import threading
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers.tbc import eod
+
+        threads = set()
+
+        def responder(params):
+            threads.add(threading.get_ident())
+            return 200, 'RESULT: OK', None
+
+        class StubTerminal(BenchTBCProvider):
+            transport = StubTransport(responder)
+
+        terminals = {f'terminal-{i}': StubTerminal() for i in range(40)}
+        report = eod.close_terminals(terminals)
+        self.assertEqual(report['closed'], 40)
+        self.assertLessEqual(len(threads), eod.MAX_WORKERS)
+
+    def test_close_terminals(self):
+        import time
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers.tbc.eod import close_terminals
+        from geopayment.simulator import (
+            Behaviour,
+            SimulatorServer,
+            TBCEcommSimulator,
+            fixed,
+        )
+
+        simulators = [
+            TBCEcommSimulator(),
+            TBCEcommSimulator(),
+            TBCEcommSimulator(behaviour=Behaviour(latency=fixed(1.0))),
+        ]
+        servers = [SimulatorServer(s).start() for s in simulators]
+        for server in servers:
+            self.addCleanup(server.stop)
+        terminals = {
+            f'terminal-{i}': type('Terminal', (BenchTBCProvider,), {
+                'service_url': f'{server.url}/ecomm2/MerchantHandler',
+            })()
+            for i, server in enumerate(servers)
+        }
+        for terminal in list(terminals.values())[:2]:
+            terminal.get_trans_id(amount=23.45, currency='GEL')
+            terminal.check_trans_status(trans_id=terminal.trans_id)
+
+        started = time.monotonic()
+        report = close_terminals(
+            terminals, timeout=0.2, retries=1, backoff=0.01, deadline=5
+        )
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual((report['closed'], report['failed']), (2, 1))
+        self.assertEqual(report['totals']['FLD_088'], 4690)
+        self.assertEqual(report['totals']['FLD_076'], 2)
+        slow = report['terminals']['terminal-2']
+        self.assertEqual((slow['ok'], slow['attempts']), (False, 2))
+        self.assertIn('ERROR', slow['result'])
+
+        with self.assertRaises(ValueError):
+            close_terminals(list(terminals.values()))
+
+
+class TestsLoadTest(unittest.TestCase):
+
+    def test_flows(self):
+        from geopayment.loadtest import FLOWS, make_provider, run
+        from geopayment.loadtest.flows import SERVICE_PATHS
+        from geopayment.simulator import SIMULATORS, SimulatorServer
+
+        for flow, (bank, _, _) in sorted(FLOWS.items()):
+            with SimulatorServer(SIMULATORS[bank]()) as server:
+                provider = make_provider(
+                    bank, f'{server.url}{SERVICE_PATHS[bank]}'
+                )
+                report = run(flow, provider, duration=0.2, concurrency=2)
+            self.assertGreater(report['flows'], 0, flow)
+            self.assertEqual(report['failed'], 0, report['errors'])
+            self.assertEqual(
+                report['latency_ms']['count'], report['flows']
+            )
+
+    def test_open_loop_errors(self):
+        from geopayment.loadtest import make_provider, run
+        from geopayment.simulator import (
+            Behaviour,
+            SimulatorServer,
+            TBCEcommSimulator,
+        )
+
+        simulator = TBCEcommSimulator(behaviour=Behaviour(error_rate=1.0))
+        with SimulatorServer(simulator) as server:
+            provider = make_provider(
+                'tbc', f'{server.url}/ecomm2/MerchantHandler'
+            )
+            report = run('tbc-sms', provider, duration=0.2, concurrency=2,
+                         rate=50)
+        self.assertEqual(report['mode'], 'open')
+        self.assertEqual(report['failed'], report['flows'])
+        self.assertEqual(
+            report['errors'], {'get_trans_id: HTTP 500': report['flows']}
+        )
+
+
+class TestsTenants(unittest.TestCase):
+
+    def test_snapshots_and_shared_pools(self):
+        from geopayment.benchmarks.fixtures import BenchIPayProvider
+        from geopayment.providers import cache, metrics, warmup
+        from geopayment.providers.tenants import TenantRegistry, name
+        from geopayment.simulator import IPaySimulator, SimulatorServer
+
+        reads = list()
+
+        with SimulatorServer(IPaySimulator()) as server:
+
+            class ShopIPayProvider(BenchIPayProvider):
+                access = None
+
+                def __init__(self, tenant):
+                    self.tenant = tenant
+                    super().__init__()
+
+                @property
+                def client_id(self):
+                    reads.append(self.tenant)
+                    return f'client-{self.tenant}'
+
+                @property
+                def service_url(self):
+                    return f'{server.url}/opay/api/v1/'
+
+            registry = TenantRegistry(ShopIPayProvider, maxsize=2)
+            self.addCleanup(registry.close)
+            first = registry.get('a')
+            registry.get('b')
+            built = list(reads)
+            self.assertIs(registry['a'], first)
+            self.assertEqual(first.client_id, 'client-a')
+            self.assertEqual(type(first).__name__, 'ShopIPayProvider')
+            # tenants never share what is kept per provider
+            self.assertEqual(name(first), 'ShopIPayProvider[a]')
+            self.assertNotEqual(
+                cache.key(first, 'checkout_status', '1'),
+                cache.key(registry.peek('b'), 'checkout_status', '1')
+            )
+            metrics.enable()
+            self.addCleanup(metrics.REGISTRY.clear)
+            self.addCleanup(metrics.disable)
+            self.assertIn('access_token', first.get_auth())
+            self.assertIn('access_token', registry.get('b').get_auth())
+            # labels stay per class, whatever the number of tenants
+            self.assertEqual(
+                metrics.TOKEN_REFRESHES.collect(),
+                {('ShopIPayProvider',): 2}
+            )
+            report = warmup.warm_up([first, registry.peek('b')],
+                                    connections=0, tokens=False)
+            self.assertEqual(list(report), ['ShopIPayProvider'])
+            warmup.reset()
+            # configuration is read only while building
+            self.assertEqual(reads, built)
+
+            pools = registry.transport.session.get_adapter(
+                server.url
+            ).poolmanager.pools
+            self.assertEqual(len(pools.keys()), 1)
+
+            registry.get('c')
+            self.assertNotIn('a', registry)
+            self.assertTrue(registry.invalidate('b'))
+            registry.get('b')
+            self.assertEqual(reads[-1], 'b')
+            self.assertEqual((registry.hits, registry.misses), (2, 4))
+
+
+class TestsQuantiles(unittest.TestCase):
+
+    def tearDown(self):
+        from geopayment.providers import quantiles
+
+        quantiles.disable()
+        quantiles.reset()
+
+    def test_relative_accuracy_and_merge(self):
+        import random
+
+        from geopayment.providers.quantiles import Sketch
+
+        rng = random.Random(46)
+        values = [rng.lognormvariate(-3, 1) for _ in range(20000)]
+        first, second = Sketch(), Sketch()
+        for i, value in enumerate(values):
+            (first if i % 2 else second).add(value)
+        merged = Sketch.from_dict(first.to_dict()).merge(second)
+        self.assertEqual(merged.count, len(values))
+        self.assertLess(len(merged.buckets), 1200)
+        ordered = sorted(values)
+        for q in (0.5, 0.95, 0.99, 0.999):
+            exact = ordered[int(q * (len(ordered) - 1))]
+            self.assertAlmostEqual(
+                merged.quantile(q) / exact, 1, delta=0.011
+            )
+        with self.assertRaises(ValueError):
+            merged.merge(Sketch(relative_accuracy=0.02))
+
+    def test_calls_and_processes(self):
+        import json
+        import os
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers import quantiles
+
+        class SketchedTBCProvider(BenchTBCProvider):
+            transport = StubTransport(
+                lambda params: (200, 'RESULT: OK\nRESULT_CODE: 000', None)
+            )
+
+        directory = tempfile.mkdtemp()
+        quantiles.enable(multiprocess_dir=directory)
+        provider = SketchedTBCProvider()
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(
+                lambda i: provider.check_trans_status(trans_id=str(i)),
+                range(100)
+            ))
+        other = quantiles.Sketch()
+        other.add(2.0)
+        key = ['SketchedTBCProvider', 'check_trans_status',
+               'localhost:18443']
+        path = os.path.join(directory, 'geopayment-quantiles-1.json')
+        with open(path, 'w') as f:
+            json.dump([[key, other.to_dict()]], f)
+
+        summary = quantiles.summary()
+        values = summary[tuple(key)]
+        self.assertEqual(values['count'], 101)
+        self.assertLess(values['p50'], 1)
+        self.assertEqual(values['max'], 2.0)
+        self.assertEqual(
+            quantiles.quantile(1, method='check_trans_status'), 2.0
+        )
+        self.assertIsNone(quantiles.quantile(0.5, provider='Unknown'))
+
+        # a worker which is gone
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        dead = os.path.join(directory, f'geopayment-quantiles-{pid}.json')
+        with open(dead, 'w') as f:
+            json.dump([[key, other.to_dict()]], f)
+        self.assertEqual(quantiles.summary()[tuple(key)]['count'], 101)
+        self.assertFalse(os.path.exists(dead))
+        self.assertEqual(
+            [n for n in os.listdir(directory) if n.endswith('.tmp')], []
+        )
+
+    def test_finished_threads(self):
+        import gc
+        import threading
+
+        from geopayment.providers import quantiles
+
+        def work():
+            for _ in range(10):
+                quantiles.observe(0.01, 'P', 'm')
+
+        for _ in range(20):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertLessEqual(len(quantiles._shards), 2)
+        self.assertEqual(quantiles.merged('P', 'm').count, 200)
+
+
+class TestsForkSafety(unittest.TestCase):
+
+    def test_preloaded_state_in_child(self):
+        import json
+        import os
+
+        from geopayment.benchmarks.fixtures import BenchIPayProvider
+        from geopayment.providers import coalesce, forksafe, metrics, warmup
+        from geopayment.providers.limits import Limit
+        from geopayment.providers.transport import PooledTransport
+        from geopayment.simulator import IPaySimulator, SimulatorServer
+
+        if not hasattr(os, 'register_at_fork'):
+            self.skipTest('fork is not available')
+        transport = PooledTransport()
+        limit = Limit(concurrency=1)
+        self.addCleanup(transport.close)
+        self.addCleanup(warmup.reset)
+        self.addCleanup(metrics.disable)
+        self.addCleanup(metrics.REGISTRY.clear)
+        self.addCleanup(setattr, forksafe, 'inherit_tokens', True)
+
+        with SimulatorServer(IPaySimulator()) as server:
+
+            class PreloadedIPayProvider(BenchIPayProvider):
+                access = None
+                service_url = f'{server.url}/opay/api/v1/'
+
+            PreloadedIPayProvider.transport = transport
+            provider = PreloadedIPayProvider()
+            metrics.enable()
+            warmup.warm_up([provider], connections=2)
+            self.assertTrue(limit.try_enter())
+            # a call in flight in another thread of the parent
+            coalesce._flights['in flight'] = coalesce._Flight()
+            self.addCleanup(coalesce._flights.pop, 'in flight', None)
+            forksafe.inherit_tokens = False
+
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.close(read)
+                    pools = transport.session.get_adapter(
+                        server.url
+                    ).poolmanager.pools
+                    state = {
+                        'pools': len(pools.keys()),
+                        'token': 'access' in vars(provider),
+                        'slot': limit.try_enter(),
+                        'flights': len(coalesce._flights),
+                        'calls': len(metrics.CALLS.collect()),
+                        'ready': warmup.ready(),
+                    }
+                    state['auth'] = 'access_token' in provider.get_auth()
+                    os.write(write, json.dumps(state).encode('utf-8'))
+                finally:
+                    os._exit(0)
+            os.close(write)
+            with os.fdopen(read) as f:
+                state = json.loads(f.read() or '{}')
+            os.waitpid(pid, 0)
+
+            self.assertEqual(state, {
+                'pools': 0, 'token': False, 'slot': True, 'flights': 0,
+                'calls': 0, 'ready': False, 'auth': True,
+            })
+            # the parent keeps its connections, token and state
+            self.assertIn('access_token', provider.access)
+            self.assertFalse(limit.try_enter())
+            self.assertTrue(warmup.ready())
+            self.assertIn('access_token', provider.get_auth())
+
+
+class TestsJournal(unittest.TestCase):
+
+    def test_history_of_payments(self):
+        import tempfile
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers.journal import Journal
+
+        def respond(params):
+            if params['data']['command'] == 'v':
+                return 200, 'TRANSACTION_ID: NMQfTRLUTne3eywr9YnAU78Qxxw=', \
+                    None
+            return 200, 'RESULT: OK\nRESULT_CODE: 000\nCARD_NUMBER: ' \
+                        '4111111111111111', None
+
+        journal = Journal(tempfile.mkdtemp(), segment_size=2048,
+                          fsync_interval=0, index_capacity=8)
+        self.addCleanup(journal.close)
+
+        class JournaledTBCProvider(BenchTBCProvider):
+            transport = StubTransport(respond)
+
+        JournaledTBCProvider.journal = journal
+        provider = JournaledTBCProvider()
+        trans_id = provider.get_trans_id(
+            amount=Decimal('10.50'), currency='GEL'
+        )['TRANSACTION_ID']
+        provider.check_trans_status(trans_id=trans_id)
+        for i in range(30):
+            provider.check_trans_status(trans_id=f'other-{i}')
+        provider.refund_trans(trans_id=trans_id, amount=Decimal('1'))
+
+        history = journal.history(trans_id)
+        self.assertEqual(
+            [entry['m'] for entry in history],
+            ['get_trans_id', 'check_trans_status', 'refund_trans']
+        )
+        self.assertEqual(history[1]['rs']['CARD_NUMBER'], '***')
+        self.assertEqual(len(journal.history('other-7')), 1)
+        self.assertEqual(journal.history('unknown'), [])
+        self.assertGreater(len(journal._segments()), 2)
+        self.assertGreater(journal._generation, 0)
+
+        self.assertEqual(journal.verify()['records'], 33)
+        self.assertTrue(journal.verify()['ok'])
+        self.assertEqual(journal.reindex(), 31)
+        self.assertEqual(len(journal.history(trans_id)), 3)
+
+        path = journal._path('segment-000001.jsonl')
+        with open(path, 'rb') as f:
+            content = f.read()
+        with open(path, 'wb') as f:
+            f.write(content.replace(b'10.50', b'99.50', 1)
+                    if b'10.50' in content
+                    else content.replace(b'1050', b'9950', 1))
+        result = journal.verify()
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['location'], (1, 0))
+
+
+    def test_unrecorded_calls(self):
+        import tempfile
+        from unittest import mock
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers.journal import Journal, JournalError
+
+        def respond(params):
+            return 200, 'RESULT: OK\nRESULT_CODE: 000', None
+
+        journal = Journal(tempfile.mkdtemp(), fsync_interval=0)
+        self.addCleanup(journal.close)
+
+        class JournaledTBCProvider(BenchTBCProvider):
+            transport = StubTransport(respond)
+
+        JournaledTBCProvider.journal = journal
+        provider = JournaledTBCProvider()
+        full = mock.patch.object(
+            journal, 'append', side_effect=OSError(28, 'No space left')
+        )
+        with full, self.assertRaises(JournalError) as raised:
+            provider.check_trans_status(trans_id='1')
+        self.assertEqual(raised.exception.result['RESULT'], 'OK')
+
+        journal.strict = False
+        with full, self.assertLogs('geopayment.providers', 'ERROR'):
+            result = provider.check_trans_status(trans_id='1')
+        self.assertEqual(result['RESULT'], 'OK')
+
+
+class TestsSlowCalls(unittest.TestCase):
+
+    def tearDown(self):
+        from geopayment.providers import quantiles, slowcalls
+
+        slowcalls.disable()
+        slowcalls.clear()
+        quantiles.disable()
+        quantiles.reset()
+
+    def test_thresholds_and_capture_limits(self):
+        import json
+        import time
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers import slowcalls
+
+        def respond(params):
+            if params['data']['command'] == 'v':
+                time.sleep(0.03)
+                return 200, 'TRANSACTION_ID: NMQfTRLUTne3eywr9YnAU78Qxxw=', \
+                    None
+            return 200, 'RESULT: OK\nRESULT_CODE: 000', None
+
+        class WatchedTBCProvider(BenchTBCProvider):
+            transport = StubTransport(respond)
+
+        slowcalls.configure(
+            thresholds={'get_trans_id': 1.0,
+                        'WatchedTBCProvider.get_trans_id': 0.02},
+            default=1.0, capacity=2, rate=0.001, burst=3, max_bytes=64
+        )
+        provider = WatchedTBCProvider()
+        for _ in range(4):
+            provider.get_trans_id(amount=Decimal('10.50'), currency='GEL')
+            provider.check_trans_status(trans_id='NMQfTRLUTne3eywr9YnAU78Q')
+
+        self.assertEqual(slowcalls.stats(), {
+            'WatchedTBCProvider.get_trans_id': {'slow': 4, 'captured': 3}
+        })
+        captures = slowcalls.captures()
+        self.assertEqual(len(captures), 2)
+        capture = captures[-1]
+        self.assertEqual(capture['method'], 'get_trans_id')
+        self.assertEqual(capture['threshold'], 0.02)
+        self.assertGreaterEqual(capture['stages']['call'], 0.03)
+        self.assertGreater(capture['request_bytes'], 64)
+        self.assertTrue(capture['truncated'])
+        self.assertEqual(len(capture['request']), 64)
+        self.assertEqual(len(json.loads(slowcalls.dump())), 2)
+
+    def test_percentile_threshold(self):
+        import time
+
+        from geopayment.benchmarks.fixtures import BenchTBCProvider
+        from geopayment.providers import quantiles, slowcalls
+
+        def respond(params):
+            time.sleep(0.01)
+            return 200, 'RESULT: OK\nRESULT_CODE: 000', None
+
+        class WatchedTBCProvider(BenchTBCProvider):
+            transport = StubTransport(respond)
+
+        for _ in range(99):
+            quantiles.observe(
+                0.001, 'WatchedTBCProvider', 'check_trans_status'
+            )
+        quantiles.observe(5.0, 'WatchedTBCProvider', 'check_trans_status')
+        slowcalls.configure(percentile=0.5, min_samples=100)
+        WatchedTBCProvider().check_trans_status(trans_id='X')
+        self.assertEqual(
+            slowcalls.stats()['WatchedTBCProvider.check_trans_status'],
+            {'slow': 1, 'captured': 1}
+        )
+        self.assertLess(slowcalls.captures()[0]['threshold'], 0.002)
+        # percentile thresholds need the sketches
+        self.assertTrue(quantiles.enabled)
+
+    def test_percentile_refresh_off_the_call(self):
+        import time
+        from unittest import mock
+
+        from geopayment.providers import quantiles, slowcalls
+
+        slowcalls.configure(percentile=0.5, min_samples=10, refresh=60)
+        for _ in range(20):
+            quantiles.observe(0.5, 'P', 'm')
+        with mock.patch.object(
+                quantiles, 'collect', wraps=quantiles.collect) as collect:
+            for _ in range(100):
+                self.assertIsNone(slowcalls._threshold('P', 'm'))
+            # calls never read the sketches
+            self.assertEqual(collect.call_count, 0)
+
+        slowcalls.configure(percentile=0.5, min_samples=10, refresh=0.01)
+        for _ in range(20):
+            quantiles.observe(0.25, 'P', 'n')
+        deadline = time.monotonic() + 1
+        while slowcalls._threshold('P', 'n') is None and \
+                time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertAlmostEqual(slowcalls._threshold('P', 'n'), 0.25,
+                               delta=0.01)
+
+
+class TestsFaults(unittest.TestCase):
+
+    def test_seeded_schedules(self):
+        from geopayment.providers.faults import Fault, FaultTransport
+
+        inner = StubTransport(lambda params: (200, 'RESULT: OK', None))
+
+        def run(seed):
+            transport = FaultTransport(inner, [
+                Fault('status', command='c', status=429, every=3),
+                Fault('malformed', endpoint='Handler$', probability=0.3),
+                Fault('reset', calls=[2], http_method='get'),
+            ], seed=seed)
+            kinds = []
+            for i in range(60):
+                before = sum(transport.injected.values())
+                response = transport.request(
+                    method='post', url='https://bank/ecomm2/Handler',
+                    data={'command': 'c' if i % 2 else 'v'}
+                )
+                if sum(transport.injected.values()) > before:
+                    kinds.append((response.status_code, response.text))
+            return transport, kinds
+
+        transport, kinds = run(7)
+        self.assertEqual(transport.injected['status'], 10)
+        self.assertEqual(transport.injected['reset'], 0)
+        self.assertEqual(transport.calls, 60)
+        self.assertEqual(run(7)[1], kinds)
+        self.assertNotEqual(run(8)[1], kinds)
+
+        transport.reseed()
+        self.assertEqual(transport.injected, {})
+        with self.assertRaises(ValueError):
+            Fault('drop')
+
+    def test_provider_survives_faults(self):
+        from geopayment.benchmarks.fixtures import (
+            BenchIPayProvider,
+            BenchTBCProvider,
+        )
+        from geopayment.providers.faults import (
+            MALFORMED_BODIES,
+            Fault,
+            FaultTransport,
+        )
+
+        tbc = StubTransport(
+            lambda params: (200, 'RESULT: OK\nRESULT_CODE: 000', None)
+        )
+        faults = FaultTransport.from_config({'seed': 1, 'faults': [
+            {'kind': 'connect_timeout', 'calls': [1], 'delay': 0},
+            {'kind': 'reset', 'calls': [2]},
+            {'kind': 'status', 'calls': [3], 'status': 429,
+             'headers': {'Retry-After': '1'}},
+            {'kind': 'stall', 'calls': [4], 'delay': 0.05},
+            {'kind': 'malformed', 'after': 4},
+        ]}, tbc)
+
+        class ChaosTBCProvider(BenchTBCProvider):
+            transport = faults
+
+        provider = ChaosTBCProvider()
+        results = [
+            provider.check_trans_status(trans_id='X', timeout=(1, 0.01))
+            for _ in range(4 + len(MALFORMED_BODIES) * 2)
+        ]
+        self.assertNotIn('HTTP_STATUS_CODE', results[0])
+        self.assertIn('connect timeout', results[0]['ERROR'])
+        self.assertIn('reset', results[1]['ERROR'])
+        self.assertEqual(results[2]['HTTP_STATUS_CODE'], 429)
+        self.assertIn('read timeout', results[3]['ERROR'])
+        for result in results[4:]:
+            self.assertEqual(result['HTTP_STATUS_CODE'], 200)
+            self.assertIn(result['RESULT'], MALFORMED_BODIES)
+            self.assertIn('ERROR', result)
+        self.assertEqual(faults.injected['malformed'], len(results) - 4)
+
+        ipay = StubTransport(lambda params: (
+            200, {'order_id': 'b2a0a1e4', 'status': 'success'}, None
+        ))
+
+        class TruncatedIPayProvider(BenchIPayProvider):
+            transport = FaultTransport(ipay, [
+                Fault('truncate', fraction=0.5)
+            ])
+
+        result = TruncatedIPayProvider().checkout_status(
+            access_token='token', order_id='b2a0a1e4'
+        )
+        self.assertEqual(result['HTTP_STATUS_CODE'], 200)
+        self.assertTrue(result['RESULT'].startswith('{"order_id"'))
+        self.assertIn('ERROR', result)
+
+    def test_malformed_results(self):
+        from geopayment.loadtest.flows import error_kind
+        from geopayment.providers.metrics import result_code
+        from geopayment.providers.outbox import is_retryable, is_unknown
+
+        malformed = {'RESULT': 'RESULT OK', 'ERROR': 'dictionary update',
+                     'HTTP_STATUS_CODE': 200}
+        self.assertEqual(result_code(malformed), 'malformed_response')
+        self.assertEqual(error_kind(malformed), 'malformed_response')
+        self.assertFalse(is_retryable(malformed))
+        unreachable = dict(malformed, HTTP_STATUS_CODE='N/A')
+        self.assertEqual(result_code(unreachable), 'transport_error')
+        # it may have reached the bank
+        self.assertFalse(is_retryable(unreachable))
+        self.assertTrue(is_unknown(unreachable))
+        self.assertTrue(is_retryable(dict(unreachable, SENT=False)))
+
+
+class TestsBenchmarks(unittest.TestCase):
+
+    def test_run_and_compare(self):
+        from geopayment.benchmarks import hotpaths  # noqa: F401
+        from geopayment.benchmarks.runner import compare, run
+
+        results = run(pattern='get_currency_code', min_time=0.001, repeat=1)
+        self.assertEqual(len(results['results']), 2)
+        rows = compare(results, results)
+        self.assertFalse(any(r['regression'] for r in rows))
+
+
+class TestsLazyImports(unittest.TestCase):
+
+    def test_entry_points_do_not_load_heavy_modules(self):
+        from geopayment.benchmarks.imports import ENTRY_POINTS, measure
+
+        for statement, forbidden in ENTRY_POINTS:
+            result = measure(statement, forbidden, repeat=1)
+            self.assertEqual(result['leaked'], [], statement)
+
+
 if __name__ == '__main__':
     unittest.main()